@@ -0,0 +1,97 @@
+import collections
+import contextlib
+import logging
+import threading
+
+from ckan import model
+
+log = logging.getLogger(__name__)
+
+# Seconds without any object of a job after which a process flushes what it
+# accumulated for the job
+DEFAULT_IDLE_TIMEOUT = 60
+
+
+class JobActivity(object):
+    '''
+    Track the harvest jobs whose objects the current process is working on,
+    so that what the process accumulates for a job (metrics, queued index
+    updates, ...) is flushed once the process is done with the job, whether
+    or not it handled the last object of the job.
+
+    A job is done for the process when `finish` is called, or after
+    `idle_timeout` seconds without any of its objects. `detach(job_id)` is
+    then called under the tracker lock, so that no object of the job starts
+    meanwhile, to take the state of the job out of the process registries;
+    `flush(job_id, state)` is called next, outside the lock.
+    '''
+
+    def __init__(self, detach, flush, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.detach = detach
+        self.flush = flush
+        self.idle_timeout = idle_timeout
+        self._active = collections.Counter()
+        self._finishing = set()
+        self._timers = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def working(self, job_id):
+        ''' Mark the block as the processing of an object of the job '''
+        with self._lock:
+            self._active[job_id] += 1
+            timer = self._timers.pop(job_id, None)
+            if timer is not None:
+                timer.cancel()
+        try:
+            yield
+        finally:
+            state = finished = None
+            with self._lock:
+                self._active[job_id] -= 1
+                if not self._active[job_id]:
+                    del self._active[job_id]
+                    if job_id in self._finishing:
+                        self._finishing.discard(job_id)
+                        state, finished = self.detach(job_id), True
+                    else:
+                        self._arm(job_id)
+            if finished:
+                self.flush(job_id, state)
+
+    def finish(self, job_id):
+        '''
+        Flush the job now, or as soon as the objects of the job being
+        processed by other threads are done
+        '''
+        with self._lock:
+            if self._active[job_id]:
+                self._finishing.add(job_id)
+                return
+            del self._active[job_id]
+            timer = self._timers.pop(job_id, None)
+            if timer is not None:
+                timer.cancel()
+            state = self.detach(job_id)
+        self.flush(job_id, state)
+
+    def _arm(self, job_id):
+        timer = threading.Timer(self.idle_timeout, self._idle, args=(job_id,))
+        timer.daemon = True
+        self._timers[job_id] = timer
+        timer.start()
+
+    def _idle(self, job_id):
+        with self._lock:
+            # the timer may have been replaced or cancelled meanwhile
+            if self._timers.get(job_id) is not threading.current_thread():
+                return
+            del self._timers[job_id]
+            state = self.detach(job_id)
+        log.debug(f'No object of job {job_id} for {self.idle_timeout}s, flushing it')
+        try:
+            self.flush(job_id, state)
+        except Exception:
+            log.exception(f'Could not flush job {job_id}')
+        finally:
+            model.Session.remove()
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+DEFAULT_MAX_AGE = 30 * 24 * 3600
+
+# Entries written between two eviction passes
+EVICTION_INTERVAL = 500
+
+
+class ResponseCache(object):
+    '''
+    On-disk cache of HTTP responses keyed by URL.
+
+    Each entry stores the ETag and Last-Modified headers of the response
+    together with its body, so that callers can revalidate it with a
+    conditional request and reuse the body on a 304 answer. Entries older
+    than `max_age` seconds are evicted, then the least recently used ones
+    until the cache fits in `max_size` bytes.
+    '''
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE, max_age=DEFAULT_MAX_AGE):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key[:2], f'{key}.json')
+
+    def get(self, url):
+        ''' Return the cached entry for the URL, or None '''
+        path = self._path(url)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') != url or time.time() - entry.get('stored', 0) > self.max_age:
+            return None
+        return entry
+
+    def conditional_headers(self, entry):
+        ''' Return the headers revalidating a cached entry '''
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def hit(self, url):
+        ''' Record a successful revalidation and mark the entry as recently used '''
+        with self._lock:
+            self.hits += 1
+        try:
+            os.utime(self._path(url))
+        except OSError:
+            pass
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def set(self, url, body, etag=None, last_modified=None):
+        ''' Store a response; responses without validators are not worth caching '''
+        if not etag and not last_modified:
+            return
+        path = self._path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {'url': url, 'etag': etag, 'last_modified': last_modified,
+                 'stored': time.time(), 'body': body}
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % EVICTION_INTERVAL == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        ''' Drop expired entries, then the least recently used ones beyond max_size '''
+        now = time.time()
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        removed = 0
+        total_size = 0
+        kept = []
+        for mtime, size, path in entries:
+            if now - mtime > self.max_age:
+                removed += self._remove(path)
+            else:
+                kept.append((mtime, size, path))
+                total_size += size
+
+        for mtime, size, path in sorted(kept):
+            if total_size <= self.max_size:
+                break
+            removed += self._remove(path)
+            total_size -= size
+
+        with self._lock:
+            self.evictions += removed
+        if removed:
+            log.debug(f'Evicted {removed} entries from the response cache {self.directory}')
+        return removed
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return 1
+        except OSError:
+            return 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(directory, max_size=DEFAULT_MAX_SIZE, max_age=DEFAULT_MAX_AGE):
+    ''' Return the cache shared by every client using the same directory '''
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = ResponseCache(directory, max_size, max_age)
+        return _caches[directory]
@@ -0,0 +1,194 @@
+import click
+
+from ckan import model
+from ckan.plugins import toolkit
+
+from ckanext.harvest.logic import HarvestJobExists, HarvestSourceInactiveError
+from ckanext.harvest.model import HarvestJob, HarvestSource
+from ckanext.harvest.queue import get_harvester
+
+from ckanext.dataverse.engine import DEFAULT_CONCURRENCY, AsyncHarvestEngine
+from ckanext.dataverse.harvesters.dataverse_harvester import DataVerseHarvester, DEFAULT_IMPORT_BATCH_SIZE
+from ckanext.dataverse.history import DEFAULT_COMPACT_BATCH_SIZE, DEFAULT_KEEP_REVISIONS, compact_history, delete_orphans
+from ckanext.dataverse.scheduler import DEFAULT_GATHERS_PER_HOST, MultiSourceGather
+
+
+def get_commands():
+    return [dataverse]
+
+
+@click.group(short_help='Dataverse harvesting commands')
+def dataverse():
+    pass
+
+
+def _get_context():
+    site_user = toolkit.get_action('get_site_user')({'model': model, 'ignore_auth': True}, {})
+    return {'model': model, 'session': model.Session, 'user': site_user['name'], 'ignore_auth': True}
+
+
+def _get_source(source_id_or_name):
+    try:
+        source_dict = toolkit.get_action('harvest_source_show')(_get_context(), {'id': source_id_or_name})
+    except toolkit.ObjectNotFound:
+        raise click.ClickException(f'Harvest source {source_id_or_name} not found')
+    return HarvestSource.get(source_dict['id'])
+
+
+def _get_harvester(source):
+    harvester = get_harvester(source.type)
+    if not isinstance(harvester, DataVerseHarvester):
+        raise click.ClickException(f'Harvest source {source.id} is not harvested by a Dataverse harvester')
+    return harvester
+
+
+def _get_dataverse_sources(source_ids_or_names):
+    ''' Return the given harvest sources, or all the active Dataverse sources '''
+    if source_ids_or_names:
+        sources = [_get_source(source_id_or_name) for source_id_or_name in source_ids_or_names]
+        for source in sources:
+            _get_harvester(source)
+        return sources
+    return [source for source in model.Session.query(HarvestSource).filter(HarvestSource.active == True)
+            if isinstance(get_harvester(source.type), DataVerseHarvester)]
+
+
+def _create_job(source):
+    job_dict = toolkit.get_action('harvest_job_create')(_get_context(), {'source_id': source.id, 'run': False})
+    return HarvestJob.get(job_dict['id'])
+
+
+@dataverse.command('bulk-import', short_help='Harvest a source with the bulk import path')
+@click.argument('source_id_or_name')
+@click.option('--job-id', help='Import the pending objects of an existing job instead of running a new one')
+@click.option('--batch-size', type=int, default=DEFAULT_IMPORT_BATCH_SIZE, show_default=True,
+              help='Number of objects imported per transaction')
+def bulk_import(source_id_or_name, job_id, batch_size):
+    '''
+    Gather a Dataverse source and import its datasets in batches, in the
+    current process and without going through the harvest queues.
+    '''
+    source = _get_source(source_id_or_name)
+    harvester = _get_harvester(source)
+
+    if job_id:
+        job = HarvestJob.get(job_id)
+        if job is None or job.source_id != source.id:
+            raise click.ClickException(f'Job {job_id} not found for source {source.id}')
+        imported, errored = harvester.bulk_import(job, batch_size)
+    else:
+        job = _create_job(source)
+        imported, errored = harvester.run_bulk_job(job, batch_size)
+
+    click.secho(f'Job {job.id}: {imported} objects imported, {errored} errors',
+                fg='green' if not errored else 'yellow')
+
+
+@dataverse.command('harvest-async', short_help='Harvest a source with the asyncio engine')
+@click.argument('source_id_or_name')
+@click.option('--concurrency', type=int, default=DEFAULT_CONCURRENCY, show_default=True,
+              help='Number of dataset requests in flight at once')
+@click.option('--batch-size', type=int, default=DEFAULT_IMPORT_BATCH_SIZE, show_default=True,
+              help='Number of objects imported per transaction')
+def harvest_async(source_id_or_name, concurrency, batch_size):
+    '''
+    Gather a Dataverse source, then fetch its datasets concurrently while
+    importing them in batches, in the current process and without going
+    through the harvest queues.
+    '''
+    if concurrency < 1:
+        raise click.BadParameter('should be a positive integer', param_hint='--concurrency')
+    source = _get_source(source_id_or_name)
+    harvester = _get_harvester(source)
+
+    job = _create_job(source)
+    imported, errored = AsyncHarvestEngine(harvester, job.id, concurrency, batch_size).run()
+
+    click.secho(f'Job {job.id}: {imported} objects imported, {errored} errors',
+                fg='green' if not errored else 'yellow')
+
+
+@dataverse.command('diff', short_help='Show what a harvest of a source would change, without running it')
+@click.argument('source_id_or_name')
+@click.option('--config', 'source_config', help='Source configuration JSON to use instead of the stored one')
+@click.option('--guids', is_flag=True, help='Also list the GUIDs of the new, changed and deleted records')
+def diff(source_id_or_name, source_config, guids):
+    '''
+    List the remote records of a Dataverse source and compare them with its
+    current harvest objects, reporting how many records a harvest would
+    create, update, leave unchanged and delete. Nothing is written to the
+    database or the search index.
+    '''
+    source = _get_source(source_id_or_name)
+    harvester = _get_harvester(source)
+    if source_config:
+        try:
+            harvester.validate_config(source_config)
+        except (KeyError, ValueError) as e:
+            raise click.BadParameter(str(e), param_hint='--config')
+
+    result = harvester.diff(source, source_config, list_guids=guids)
+
+    if guids:
+        for status in ('new', 'change', 'delete'):
+            for guid in result['guids'][status]:
+                click.echo(f'{status}\t{guid}')
+    click.secho(f'Source {source.id}: {result["new"]} new, {result["change"]} changed, '
+                f'{result["unchanged"]} unchanged, {result["delete"]} deleted records', fg='green')
+
+
+@dataverse.command('gather', short_help='Gather several Dataverse sources at once')
+@click.argument('source_ids_or_names', nargs=-1)
+@click.option('--per-host', type=int, default=DEFAULT_GATHERS_PER_HOST, show_default=True,
+              help='Number of gathers run at once against the same Dataverse installation')
+@click.option('--workers', type=int, help='Number of gathers run at once in total [default: per host x hosts]')
+def gather(source_ids_or_names, per_host, workers):
+    '''
+    Create a job for each of the given Dataverse sources (all the active
+    ones by default) and gather them in the current process, one host
+    alongside the others, sending the gathered objects to the fetch queue.
+    Sources with a job already in progress are skipped.
+    '''
+    if per_host < 1:
+        raise click.BadParameter('should be a positive integer', param_hint='--per-host')
+    if workers is not None and workers < 1:
+        raise click.BadParameter('should be a positive integer', param_hint='--workers')
+
+    jobs = []
+    for source in _get_dataverse_sources(source_ids_or_names):
+        try:
+            jobs.append((_get_harvester(source), _create_job(source)))
+        except (HarvestJobExists, HarvestSourceInactiveError) as e:
+            click.secho(f'Source {source.id} skipped: {e}', fg='yellow')
+
+    results = MultiSourceGather(jobs, per_host, workers).run()
+
+    for _harvester, job in jobs:
+        queued = results.get(job.id)
+        if queued is None:
+            click.secho(f'Job {job.id} (source {job.source_id}): gather failed', fg='red')
+        else:
+            click.echo(f'Job {job.id} (source {job.source_id}): {queued} objects queued')
+
+
+@dataverse.command('compact', short_help='Delete old revisions of the harvest objects of Dataverse sources')
+@click.argument('source_ids_or_names', nargs=-1)
+@click.option('--keep', type=int, default=DEFAULT_KEEP_REVISIONS, show_default=True,
+              help='Number of non-current revisions kept for each GUID')
+@click.option('--batch-size', type=int, default=DEFAULT_COMPACT_BATCH_SIZE, show_default=True,
+              help='Number of objects deleted per transaction')
+def compact(source_ids_or_names, keep, batch_size):
+    '''
+    Delete the old non-current harvest objects of the given Dataverse
+    sources (all of them by default), keeping the current object and the
+    most recent revisions of every GUID, then the orphaned object extras.
+    '''
+    if keep < 0:
+        raise click.BadParameter('should be a non negative integer', param_hint='--keep')
+
+    for source in _get_dataverse_sources(source_ids_or_names):
+        deleted = compact_history(source.id, keep, batch_size)
+        click.echo(f'Source {source.id}: {deleted} old harvest objects deleted')
+
+    extras, errors = delete_orphans()
+    click.secho(f'{extras} orphaned object extras and {errors} orphaned object errors deleted', fg='green')
@@ -0,0 +1,286 @@
+import contextlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ckanext.dataverse.metrics import activate as activate_metrics, current as current_metrics
+from ckanext.dataverse.streaming import DEFAULT_CHUNK_SIZE, SearchResultStream
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 60
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_POOL_SIZE = 10
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RateLimiter(object):
+    '''
+    Thread safe limiter spacing calls evenly so that no more than
+    `requests_per_second` calls are let through every second
+    '''
+
+    def __init__(self, requests_per_second=None):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0
+        self._lock = threading.Lock()
+        self._next_slot = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _create_session(pool_size, max_retries, backoff_factor):
+    ''' Return a keep-alive session retrying with exponential backoff on connection errors and 429/5xx answers '''
+    retry = Retry(total=max_retries, connect=max_retries, read=max_retries,
+                  status=max_retries, backoff_factor=backoff_factor,
+                  status_forcelist=RETRY_STATUSES, respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.headers['Accept'] = 'application/json'
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class HostPool(object):
+    '''
+    HTTP resources shared by every client of a host, whatever the harvest
+    source: at most `max_connections` requests in flight at once, keep-alive
+    sessions (one per retry setting) and rate limiters (one per rate).
+    '''
+
+    def __init__(self, host, max_connections=DEFAULT_POOL_SIZE):
+        self.host = host
+        self.max_connections = max_connections
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self._sessions = {}
+        self._rate_limiters = {}
+        self._lock = threading.Lock()
+
+    def get_session(self, max_retries, backoff_factor):
+        with self._lock:
+            key = (max_retries, backoff_factor)
+            if key not in self._sessions:
+                self._sessions[key] = _create_session(self.max_connections, max_retries, backoff_factor)
+            return self._sessions[key]
+
+    def get_rate_limiter(self, requests_per_second):
+        with self._lock:
+            if requests_per_second not in self._rate_limiters:
+                self._rate_limiters[requests_per_second] = RateLimiter(requests_per_second)
+            return self._rate_limiters[requests_per_second]
+
+
+class DataverseClient(object):
+    '''
+    Client for the Dataverse native and Search APIs.
+
+    Requests go through a single keep-alive `requests.Session` with a
+    connection pool, are spaced by a rate limiter and retried with
+    exponential backoff on connection errors and on 429/5xx answers. When a
+    ResponseCache is given, cached responses are revalidated with
+    conditional requests.
+
+    With a HostPool (as built by get_client), the session and the rate
+    limiter are the ones of the host for the same retry settings and rate,
+    shared with the clients of other sources, and the requests wait for one
+    of the connection slots of the host. Without one, the client has its
+    own session and rate limiter.
+    '''
+
+    def __init__(self, base_url, requests_per_second=None, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 cache=None, host_pool=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.cache = cache
+        self.host_pool = host_pool
+        if host_pool is not None:
+            self.rate_limiter = host_pool.get_rate_limiter(requests_per_second)
+            self.pool_size = host_pool.max_connections
+            self.session = host_pool.get_session(max_retries, backoff_factor)
+        else:
+            self.rate_limiter = RateLimiter(requests_per_second)
+            self.pool_size = pool_size
+            self.session = _create_session(pool_size, max_retries, backoff_factor)
+
+    def _acquire_slot(self):
+        ''' Wait for a connection slot of the host, if the client has a HostPool '''
+        if self.host_pool is not None:
+            self.host_pool.slots.acquire()
+
+    def _release_slot(self):
+        if self.host_pool is not None:
+            self.host_pool.slots.release()
+
+    @contextlib.contextmanager
+    def _slot(self):
+        self._acquire_slot()
+        try:
+            yield
+        finally:
+            self._release_slot()
+
+    def fetch_json(self, path, params=None):
+        '''
+        Return the decoded JSON body of a GET request and whether it was
+        served from the cache after a 304 Not Modified answer
+        '''
+        request = self.session.prepare_request(requests.Request('GET', f'{self.base_url}{path}', params=params))
+        url = request.url
+
+        entry = self.cache.get(url) if self.cache else None
+        if entry:
+            request.headers.update(self.cache.conditional_headers(entry))
+
+        with self._slot():
+            self.rate_limiter.wait()
+            log.debug(f'GET {url}')
+            started = time.perf_counter()
+            response = self.session.send(request, timeout=self.timeout)
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.record_http(response.status_code, len(response.content), time.perf_counter() - started)
+
+        if entry and response.status_code == 304:
+            self.cache.hit(url)
+            return json.loads(entry['body']), True
+
+        response.raise_for_status()
+        if self.cache:
+            self.cache.miss()
+            self.cache.set(url, response.text,
+                           etag=response.headers.get('ETag'),
+                           last_modified=response.headers.get('Last-Modified'))
+        return response.json(), False
+
+    def get_json(self, path, params=None):
+        return self.fetch_json(path, params)[0]
+
+    def search(self, params):
+        ''' Return the `data` object of a Search API answer '''
+        content = self.get_json('/api/search', params)
+        return content.get('data', content)
+
+    def stream_search(self, params, chunk_size=DEFAULT_CHUNK_SIZE):
+        '''
+        Return a SearchResultStream over a Search API answer: its items are
+        parsed one at a time while the body is downloaded. Search answers
+        are not cached.
+        '''
+        request = self.session.prepare_request(requests.Request('GET', f'{self.base_url}/api/search', params=params))
+        # the connection slot is held until the body is read
+        self._acquire_slot()
+        try:
+            self.rate_limiter.wait()
+            log.debug(f'GET {request.url} (streamed)')
+            started = time.perf_counter()
+            response = self.session.send(request, timeout=self.timeout, stream=True)
+        except BaseException:
+            self._release_slot()
+            raise
+        metrics = current_metrics()
+
+        def _body():
+            size = 0
+            try:
+                for chunk in response.iter_content(chunk_size):
+                    size += len(chunk)
+                    yield chunk
+            finally:
+                response.close()
+                self._release_slot()
+                if metrics is not None:
+                    metrics.record_http(response.status_code, size, time.perf_counter() - started)
+
+        if not response.ok:
+            # consume the body so that the metrics are recorded
+            for _chunk in _body():
+                pass
+            response.raise_for_status()
+        return SearchResultStream(_body())
+
+    def get_dataverse(self, identifier):
+        ''' Return a dataverse (collection) by id or alias '''
+        content = self.get_json(f'/api/dataverses/{identifier}')
+        return content.get('data', content)
+
+    def get_dataverse_contents(self, identifier):
+        ''' Return the datasets and sub-dataverses directly under a dataverse '''
+        content = self.get_json(f'/api/dataverses/{identifier}/contents')
+        return content.get('data', content)
+
+    def get_dataset(self, persistent_id):
+        '''
+        Return the native API representation of the latest version of a
+        dataset, and whether it is unchanged since it was cached
+        '''
+        content, not_modified = self.fetch_json('/api/datasets/:persistentId/', {'persistentId': persistent_id})
+        return content.get('data', content), not_modified
+
+    def get_datasets(self, persistent_ids, workers):
+        '''
+        Fetch several datasets with a bounded thread pool; return a dict
+        mapping each persistent id to the result of `get_dataset` or to the
+        raised exception
+        '''
+        metrics = current_metrics()
+
+        def _fetch(persistent_id):
+            try:
+                with activate_metrics(metrics):
+                    return persistent_id, self.get_dataset(persistent_id)
+            except Exception as e:
+                log.warning(f'Could not fetch dataset {persistent_id}: {e}')
+                return persistent_id, e
+
+        with ThreadPoolExecutor(max_workers=min(workers, self.pool_size)) as executor:
+            return dict(executor.map(_fetch, persistent_ids))
+
+
+_clients = {}
+_host_pools = {}
+_clients_lock = threading.Lock()
+
+
+def get_host_pool(base_url, max_connections=DEFAULT_POOL_SIZE):
+    '''
+    Return the HostPool of the host of a URL, created with `max_connections`
+    slots by the first caller
+    '''
+    host = urlsplit(base_url).netloc.lower()
+    with _clients_lock:
+        if host not in _host_pools:
+            _host_pools[host] = HostPool(host, max_connections)
+        return _host_pools[host]
+
+
+def get_client(base_url, max_host_connections=DEFAULT_POOL_SIZE, **kwargs):
+    '''
+    Return a client shared by every caller using the same base URL and
+    settings, so that connections are kept alive between harvest objects.
+    Clients of the same host share its HostPool.
+    '''
+    host_pool = get_host_pool(base_url, max_host_connections)
+    key = (base_url.rstrip('/'), tuple(sorted(kwargs.items())))
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = DataverseClient(base_url, host_pool=host_pool, **kwargs)
+        return _clients[key]
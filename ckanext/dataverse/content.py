@@ -0,0 +1,57 @@
+import base64
+import json
+import zlib
+
+# Prefix of the zlib compressed, base64 encoded harvest object contents;
+# contents without it are plain JSON
+COMPRESSED_MARKER = 'dvz1:'
+
+COMPRESSION_LEVEL = 6
+
+
+def canonical_json(content):
+    ''' Serialize a document as canonical JSON: sorted keys, no whitespace '''
+    return json.dumps(content, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+def trim_content(content, fields):
+    '''
+    Return a copy of a document keeping only the given fields.
+
+    `fields` is a dict whose keys are the members to keep and whose values
+    are either True, to keep the whole member, or a nested `fields` dict;
+    lists are trimmed item by item. None keeps the whole document.
+    '''
+    if fields is None or fields is True:
+        return content
+    if isinstance(content, list):
+        return [trim_content(item, fields) for item in content]
+    if not isinstance(content, dict):
+        return content
+    return {key: trim_content(content[key], spec) for key, spec in fields.items() if key in content}
+
+
+def encode_content(content, compress=False):
+    '''
+    Return the stored form of a harvest object content: canonical JSON,
+    zlib compressed and prefixed with COMPRESSED_MARKER when `compress` is
+    set
+    '''
+    text = canonical_json(content)
+    if not compress:
+        return text
+    compressed = zlib.compress(text.encode('utf-8'), COMPRESSION_LEVEL)
+    return COMPRESSED_MARKER + base64.b64encode(compressed).decode('ascii')
+
+
+def decode_content(text):
+    ''' Return the JSON text of a stored harvest object content, compressed or not '''
+    if text and text.startswith(COMPRESSED_MARKER):
+        compressed = base64.b64decode(text[len(COMPRESSED_MARKER):])
+        return zlib.decompress(compressed).decode('utf-8')
+    return text
+
+
+def load_content(text):
+    ''' Return the document stored as a harvest object content '''
+    return json.loads(decode_content(text))
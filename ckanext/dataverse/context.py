@@ -0,0 +1,112 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from ckan import logic
+from ckan import model
+from ckan import plugins as p
+from ckan.common import config
+from ckan.lib.navl.validators import not_empty
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONTEXT_TTL = 300
+
+
+class HarvestContext(object):
+    '''
+    Everything the import of an object needs from its harvest source and
+    the site, resolved once: the parsed source configuration, the owner
+    organization of the source, the harvesting user and the package schemas
+    '''
+
+    def __init__(self, source_id, config, owner_org, user_name, site_user_name):
+        self.source_id = source_id
+        self.config = config
+        self.owner_org = owner_org
+        self.user_name = user_name
+        self.ignore_auth = user_name == site_user_name
+        self.create_schema, self.update_schema = build_package_schemas()
+        self.loaded = time.monotonic()
+
+    def action_context(self, **kwargs):
+        ''' Return a fresh context for an action call made on behalf of the harvester '''
+        context = {'model': model, 'session': model.Session, 'user': self.user_name}
+        if self.ignore_auth:
+            context['ignore_auth'] = True
+        context.update(kwargs)
+        return context
+
+
+def build_package_schemas():
+    ''' Return the create and update package schemas used by the import stage '''
+    # The default package schema does not like Upper case tags
+    tag_schema = logic.schema.default_tags_schema()
+    tag_schema['name'] = [not_empty, str]
+
+    create_schema = logic.schema.default_create_package_schema()
+    create_schema['tags'] = tag_schema
+    # We need to explicitly provide a package ID, otherwise ckanext-spatial
+    # won't be be able to link the extent to the package.
+    create_schema['id'] = [str]
+
+    update_schema = logic.schema.default_update_package_schema()
+    update_schema['tags'] = tag_schema
+
+    return create_schema, update_schema
+
+
+def get_harvest_user_name():
+    '''
+    Return the name of the user performing the harvesting actions, and the
+    name of the site user.
+
+    By default this is the internal site admin user. This is the
+    recommended setting, but if necessary it can be overridden with the
+    `ckanext.spatial.harvest.user_name` config option.
+    '''
+    site_user = p.toolkit.get_action('get_site_user')({'model': model, 'ignore_auth': True}, {})
+    user_name = config.get('ckanext.spatial.harvest.user_name') or site_user['name']
+    return user_name, site_user['name']
+
+
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+
+def get_harvest_context(source):
+    '''
+    Return the HarvestContext of a harvest source, cached per process.
+
+    Entries are keyed by source id and configuration hash, so that editing
+    the configuration invalidates them at once; they expire after
+    `ckanext.dataverse.context_ttl` seconds to pick up other changes to the
+    source, such as its organization.
+    '''
+    config_str = source.config or ''
+    key = (source.id, hashlib.sha1(config_str.encode('utf-8')).hexdigest())
+    ttl = int(config.get('ckanext.dataverse.context_ttl', DEFAULT_CONTEXT_TTL))
+
+    with _contexts_lock:
+        context = _contexts.get(key)
+    if context is not None and time.monotonic() - context.loaded < ttl:
+        return context
+
+    source_dataset = model.Package.get(source.id)
+    user_name, site_user_name = get_harvest_user_name()
+    context = HarvestContext(
+        source.id,
+        json.loads(config_str) if config_str else {},
+        source_dataset.owner_org if source_dataset else None,
+        user_name,
+        site_user_name,
+    )
+    log.debug(f'Loaded harvest context for source {source.id}')
+
+    with _contexts_lock:
+        for stale_key in [k for k in _contexts if k[0] == source.id]:
+            del _contexts[stale_key]
+        _contexts[key] = context
+    return context
@@ -0,0 +1,202 @@
+import asyncio
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from ckan import model
+from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestObjectError
+
+from ckanext.dataverse.content import load_content
+from ckanext.dataverse.harvesters.dataverse_harvester import DEFAULT_IMPORT_BATCH_SIZE
+from ckanext.dataverse.metrics import activate as activate_metrics, get_metrics, timed
+
+log = logging.getLogger(__name__)
+
+# Dataset requests in flight at once
+DEFAULT_CONCURRENCY = 16
+
+
+class AsyncHarvestEngine(object):
+    '''
+    Run a whole Dataverse harvest job in the current process with an
+    asyncio event loop, without the harvest queues.
+
+    Network calls and database work are kept apart so that neither waits
+    for the other:
+
+    * the gather stage runs first (its Search API pagination is concurrent
+      with the `search_workers` source option);
+    * the datasets of the gathered objects are then fetched concurrently,
+      at most `concurrency` requests at once, through the pooled and rate
+      limited client of the source; the file metadata comes with them;
+    * fetched objects are handed `batch_size` at a time to a single database
+      thread, which stores them and imports them with the bulk import path
+      of the harvester while the next batch is being fetched.
+
+    The blocking client and the CKAN actions are driven from executor
+    threads, so no asyncio HTTP library is needed. The job is given by id
+    and loaded by the database thread. Whatever happens, the job ends up
+    'Finished'; an error stopping the run is saved as a gather error of the
+    job and raised again.
+    '''
+
+    def __init__(self, harvester, harvest_job_id, concurrency=DEFAULT_CONCURRENCY,
+                 batch_size=DEFAULT_IMPORT_BATCH_SIZE):
+        self.harvester = harvester
+        self.harvest_job_id = harvest_job_id
+        self.harvest_job = None
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.metrics = get_metrics(harvest_job_id)
+        self.imported = 0
+        self.errored = 0
+
+    def run(self):
+        ''' Run the job; return the number of imported and errored objects '''
+        return asyncio.run(self._run())
+
+    async def _run(self):
+        # the database session is per thread: all the database work of the
+        # job goes through the same single thread
+        self._db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dataverse-db')
+        self._http_executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='dataverse-http')
+        try:
+            try:
+                objects = await self._in_db(self._gather)
+                if objects:
+                    await self._fetch_and_import(objects)
+            except Exception as e:
+                log.exception(f'Error running job {self.harvest_job_id}')
+                await self._in_db(self._save_error, e)
+                raise
+            finally:
+                await self._in_db(self._finish)
+        finally:
+            self._http_executor.shutdown(wait=True)
+            self._db_executor.shutdown(wait=True)
+        return self.imported, self.errored
+
+    def _in_db(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._db_executor, func, *args)
+
+    def _gather(self):
+        '''
+        Run the gather stage; return the gathered objects as (id, GUID,
+        whether the dataset has to be fetched) tuples
+        '''
+        job = self.harvest_job = HarvestJob.get(self.harvest_job_id)
+        job.status = 'Running'
+        job.gather_started = datetime.datetime.utcnow()
+        job.save()
+
+        ids = self.harvester.gather_stage(job)
+
+        job.gather_finished = datetime.datetime.utcnow()
+        job.save()
+        if not ids:
+            return []
+
+        self.client = self.harvester._get_client(job.source.url)
+        objects = []
+        for start in range(0, len(ids), 1000):
+            query = model.Session.query(HarvestObject.id, HarvestObject.guid, HarvestObject.content). \
+                filter(HarvestObject.id.in_(ids[start:start + 1000]))
+            for object_id, guid, content in query:
+                objects.append((object_id, guid, bool(content) and 'dataset' not in load_content(content)))
+        return objects
+
+    async def _fetch_and_import(self, objects):
+        batch_size = self.batch_size
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        fetched = []
+        workers = [asyncio.create_task(self._fetch_worker(queue, fetched)) for _ in range(self.concurrency)]
+
+        importing = None
+        try:
+            for object_id, guid, to_fetch in objects:
+                if to_fetch:
+                    await queue.put((object_id, guid))
+                else:
+                    fetched.append((object_id, None))
+                if len(fetched) >= batch_size:
+                    batch, fetched[:] = list(fetched), []
+                    # one batch is imported while the next one is fetched
+                    if importing:
+                        await importing
+                    importing = self._in_db(self._import_batch, batch)
+            await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        if importing:
+            await importing
+        if fetched:
+            await self._in_db(self._import_batch, list(fetched))
+
+    async def _fetch_worker(self, queue, fetched):
+        loop = asyncio.get_running_loop()
+        while True:
+            object_id, guid = await queue.get()
+            try:
+                result = await loop.run_in_executor(self._http_executor, self._fetch_dataset, guid)
+            except Exception as e:
+                log.warning(f'Could not fetch dataset {guid}: {e}')
+                result = e
+            fetched.append((object_id, result))
+            queue.task_done()
+
+    def _fetch_dataset(self, guid):
+        with activate_metrics(self.metrics), timed('fetch'):
+            return self.client.get_dataset(guid)
+
+    def _import_batch(self, batch):
+        '''
+        Store the fetched datasets of a batch of objects, then import the
+        objects with the bulk import path of the harvester
+        '''
+        results = dict(batch)
+        objects = model.Session.query(HarvestObject).filter(HarvestObject.id.in_(list(results))).all()
+        to_import = []
+        now = datetime.datetime.utcnow()
+        for harvest_object in objects:
+            result = results[harvest_object.id]
+            if isinstance(result, Exception):
+                model.Session.add(HarvestObjectError(message=f'Could not fetch dataset {harvest_object.guid}: {result}',
+                                                     object=harvest_object, stage='Fetch'))
+                harvest_object.state = 'ERROR'
+                harvest_object.import_finished = now
+                self.errored += 1
+                continue
+            if result is not None:
+                content = load_content(harvest_object.content)
+                content['dataset'] = result[0]
+                harvest_object.content, hash_ = self.harvester._encode_content(content)
+                self.harvester._set_object_extra(harvest_object, 'content_hash', hash_)
+            to_import.append(harvest_object.id)
+        model.Session.commit()
+
+        if to_import:
+            imported, errored = self.harvester._import_batch(self.harvest_job, to_import, self.metrics)
+            self.imported += imported
+            self.errored += errored
+        log.info(f'Job {self.harvest_job.id}: {self.imported} objects imported, {self.errored} errors')
+
+    def _save_error(self, error):
+        model.Session.rollback()
+        job = HarvestJob.get(self.harvest_job_id)
+        if job is not None:
+            self.harvester._save_gather_error(f'Error running job {self.harvest_job_id}: {error}', job)
+
+    def _finish(self):
+        model.Session.rollback()
+        job = self.harvest_job = HarvestJob.get(self.harvest_job_id)
+        if job is None:
+            return
+        try:
+            self.harvester._finish_job(job.id, self.metrics)
+        finally:
+            job.status = 'Finished'
+            job.finished = datetime.datetime.utcnow()
+            job.save()
@@ -1,27 +1,109 @@
+import collections
+import contextlib
+import datetime
 import hashlib
 import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import uuid
-from urllib.request import urlopen
 
 from ckan import logic
 from ckan import model
 from ckan import plugins as p
 from ckan.common import config
 from ckan.model import Session
+from ckan.model.types import make_uuid
 
 from ckan.plugins.core import SingletonPlugin, implements
 
 from ckanext.harvest.interfaces import IHarvester
 from ckanext.harvest.harvesters.base import HarvesterBase
-from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestGatherError, HarvestJob, HarvestObject, HarvestObjectError
 from ckanext.harvest.model import HarvestObjectExtra as HOExtra
 
+from ckan.lib import plugins as lib_plugins
 from ckan.lib.search.index import PackageSearchIndex
 from ckan.lib.helpers import json
-from ckan.lib.navl.validators import not_empty
+
+from sqlalchemy import and_, exists, func, or_
+from sqlalchemy.orm import aliased, defer
+
+from ckanext.dataverse import model as dataverse_model
+from ckanext.dataverse.activity import DEFAULT_IDLE_TIMEOUT, JobActivity
+from ckanext.dataverse.cache import get_cache
+from ckanext.dataverse.client import get_client
+from ckanext.dataverse.content import canonical_json, decode_content, encode_content, load_content, trim_content
+from ckanext.dataverse.context import get_harvest_context
+from ckanext.dataverse.indexing import (
+    DEFAULT_INDEX_BATCH_SIZE, automatic_indexing_disabled, delete_from_index, get_indexer,
+)
+from ckanext.dataverse.metrics import (
+    activate as activate_metrics, current as current_metrics, discard_metrics, get_metrics, merge_summaries, timed,
+)
+from ckanext.dataverse.model import DataverseHarvestJob
+from ckanext.dataverse.names import discard_name_index, get_name_index
+from ckanext.dataverse.profiling import (
+    PROFILE_WRITE_INTERVAL, discard_profile, get_profile, get_profile_dir, profiling_enabled,
+)
 
 log = logging.getLogger(__name__)
 
+_job_activity = None
+_job_activity_lock = threading.Lock()
+
+
+def content_hash(content):
+    '''
+    Return the hash of a harvested document serialized as canonical JSON
+    (sorted keys, no whitespace), so that equal documents hash the same
+    whatever their key order
+    '''
+    return hashlib.sha1(canonical_json(content).encode('utf-8')).hexdigest()
+
+
+# Dataverse caps the Search API page size at 1000 items
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Number of HarvestObjects inserted per gather transaction
+DEFAULT_BATCH_SIZE = 500
+
+# Days between two full gathers when harvesting incrementally
+DEFAULT_FULL_HARVEST_INTERVAL = 7
+
+SOLR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Sharded gathers
+DEFAULT_SHARD_WORKERS = 4
+DEFAULT_SHARD_RETRIES = 3
+
+# Checkpoint key of the offset of an unsharded listing
+UNSHARDED_CURSOR = '*'
+
+# Packages deleted or purged per transaction with `bulk_delete`
+DEFAULT_DELETE_BATCH_SIZE = 500
+
+# Objects imported per transaction by bulk_import
+DEFAULT_IMPORT_BATCH_SIZE = 200
+
+# Fetched/imported objects between two saves of the job metrics
+METRICS_FLUSH_INTERVAL = 100
+
+# HarvestObjectExtra keys written by the gather stage besides `status`
+OBJECT_EXTRAS = ('content_hash', 'remote_modified')
+
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+
+# Requests in flight at once to a Dataverse installation, all sources included
+DEFAULT_MAX_HOST_CONNECTIONS = 10
+
+# HTTP response cache limits, in megabytes and days
+DEFAULT_CACHE_MAX_SIZE = 512
+DEFAULT_CACHE_MAX_AGE = 30
+
 
 class DataVerseHarvester(HarvesterBase, SingletonPlugin):
     '''
@@ -33,9 +115,23 @@ class DataVerseHarvester(HarvesterBase, SingletonPlugin):
 
     implements(IHarvester)
 
-    _user_name = None
+    # The plugin is a singleton shared by every worker thread of the
+    # process: per-call state such as the source configuration is kept
+    # per thread
+    _local = threading.local()
+
+    # Members of the harvested documents kept in the harvest objects, as a
+    # nested dict (see content.trim_content); None keeps whole documents.
+    # Subclasses list what create_package_dict and attach_resources use
+    content_fields = None
 
-    source_config = {}
+    @property
+    def source_config(self):
+        return getattr(self._local, 'source_config', {})
+
+    @source_config.setter
+    def source_config(self, value):
+        self._local.source_config = value
 
     def harvester_name(self):
         raise NotImplementedError
@@ -73,147 +169,1038 @@ class DataVerseHarvester(HarvesterBase, SingletonPlugin):
                 if not isinstance(source_config_obj['filter'], str):
                     raise ValueError('"filter" should be a string')
 
+            if 'page_size' in source_config_obj:
+                page_size = source_config_obj['page_size']
+                if not isinstance(page_size, int) or not 0 < page_size <= MAX_PAGE_SIZE:
+                    raise ValueError(f'"page_size" should be an integer between 1 and {MAX_PAGE_SIZE}')
+
+            if 'batch_size' in source_config_obj:
+                batch_size = source_config_obj['batch_size']
+                if not isinstance(batch_size, int) or batch_size < 1:
+                    raise ValueError('"batch_size" should be a positive integer')
+
+            if 'incremental' in source_config_obj:
+                if not isinstance(source_config_obj['incremental'], bool):
+                    raise ValueError('"incremental" should be a boolean')
+
+            if 'full_harvest_interval' in source_config_obj:
+                interval = source_config_obj['full_harvest_interval']
+                if not isinstance(interval, int) or interval < 0:
+                    raise ValueError('"full_harvest_interval" should be a non negative integer')
+
+            for key in ('http_cache', 'skip_unchanged', 'deferred_indexing', 'shard_by_subdataverse',
+                        'resume_gather', 'stream_search', 'compress_content', 'bulk_delete', 'purge_deleted',
+                        'profile_import'):
+                if key in source_config_obj:
+                    if not isinstance(source_config_obj[key], bool):
+                        raise ValueError(f'"{key}" should be a boolean')
+
+            if 'shards' in source_config_obj:
+                shards = source_config_obj['shards']
+                if not isinstance(shards, list) or not all(isinstance(alias, str) for alias in shards):
+                    raise ValueError('"shards" should be a list of dataverse aliases')
+
+            if 'root_dataverse' in source_config_obj:
+                if not isinstance(source_config_obj['root_dataverse'], str):
+                    raise ValueError('"root_dataverse" should be a string')
+
+            for key in ('shard_workers', 'search_workers'):
+                if key in source_config_obj:
+                    if not isinstance(source_config_obj[key], int) or source_config_obj[key] < 1:
+                        raise ValueError(f'"{key}" should be a positive integer')
+
+            for key in ('fetch_workers', 'max_retries', 'shard_retries'):
+                if key in source_config_obj:
+                    if not isinstance(source_config_obj[key], int) or source_config_obj[key] < 0:
+                        raise ValueError(f'"{key}" should be a non negative integer')
+
+            for key in ('index_batch_size', 'delete_batch_size'):
+                if key in source_config_obj:
+                    if not isinstance(source_config_obj[key], int) or source_config_obj[key] < 1:
+                        raise ValueError(f'"{key}" should be a positive integer')
+
+            for key in ('requests_per_second', 'backoff_factor'):
+                if key in source_config_obj:
+                    value = source_config_obj[key]
+                    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+                        raise ValueError(f'"{key}" should be a positive number')
+
         except ValueError as e:
             raise e
 
         return source_config
 
-    def _get_resources(self, url):
-        """ return name, descriptions and subjects """
-        filter_str = self.source_config('filter', '*')
-        final_url = f'{url}/api/search?q={filter_str}'
-        log.info(f'Retrieving data from URL {url}')
-        request = urlopen(final_url)
-        content = request.read()
+    def _get_pages(self, url, since=None, shard=None, start=0):
+        """
+        Walk the Dataverse Search API and yield one list per result page;
+        each entry is a dict holding name, description, subjects, guid and
+        the remote modification date.
+
+        When `since` is given only datasets modified after that datetime are
+        listed. `shard` restricts the listing to a part of the installation
+        (see _get_shards) and `start` is the offset of the first item.
+
+        Pages are yielded as soon as they are read, so the caller never
+        needs to hold the whole catalogue in memory. With `search_workers`,
+        the pages following the first one are requested concurrently and
+        yielded in order.
+        """
+        filter_str = self.source_config.get('filter', '*')
+        page_size = self.source_config.get('page_size', DEFAULT_PAGE_SIZE)
+
+        # a stable order lets an interrupted listing resume from its offset
+        params = {'q': filter_str, 'per_page': page_size, 'sort': 'date', 'order': 'asc', 'fq': []}
+        if since:
+            params['fq'].append(f'dateSort:[{since.strftime(SOLR_DATE_FORMAT)} TO *]')
+        if shard:
+            params['fq'].extend(shard.get('fq', []))
+            if shard.get('subtree'):
+                params['subtree'] = shard['subtree']
+
+        client = self._get_client(url)
+        workers = self.source_config.get('search_workers', 1)
+        while True:
+            log.info(f'Retrieving data from URL {url} ({shard["name"] if shard else "all"}, start={start})')
+            page, total_count = self._search_page(client, dict(params, start=start))
+            yield page
+
+            start += len(page)
+            if not page or start >= total_count:
+                break
+            if workers > 1:
+                yield from self._get_pages_concurrently(client, params, start, total_count, workers)
+                break
+
+    def _search_page(self, client, params):
+        ''' Request a Search API page; return its documents and the total count of the listing '''
+        id_field_name = self.source_config['id_field_name']
+        with timed('gather.search'):
+            if self.source_config.get('stream_search', False):
+                # items are trimmed as soon as they are parsed, the full
+                # answer is never held in memory
+                result = client.stream_search(params)
+                page = [self._get_search_doc(item, id_field_name) for item in result]
+                data = result.data
+            else:
+                data = client.search(params)
+                page = [self._get_search_doc(item, id_field_name) for item in data.get('items', [])]
+        return page, data.get('total_count', 0)
 
-        json_content = json.loads(content)
+    def _get_pages_concurrently(self, client, params, start, total_count, workers):
+        '''
+        Yield the pages of a listing from offset `start` to `total_count`,
+        keeping up to `workers` page requests in flight
+        '''
+        source_config = self.source_config
+        metrics = current_metrics()
+
+        def _search(offset):
+            self.source_config = source_config
+            with activate_metrics(metrics):
+                return self._search_page(client, dict(params, start=offset))[0]
+
+        in_flight = collections.deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for offset in range(start, total_count, params['per_page']):
+                in_flight.append(executor.submit(_search, offset))
+                if len(in_flight) >= workers:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+
+    @staticmethod
+    def _get_search_doc(item, id_field_name):
+        ''' Return the gathered document of a Search API item '''
+        name = item.get('name')
+        description = item.get('description')
+        subjects = item.get('subjects')
+        doc_id = item.get(id_field_name)
+        modified = item.get('updatedAt')
+        log.debug(f'Data: found {name} {description} {subjects}')
+        return {'name': name, 'description': description, 'subjects': subjects, 'guid': doc_id,
+                'modified': modified}
+
+    def _get_shards(self, url):
+        '''
+        Return the shards the gather of a source is split into, as dicts
+        holding a name and the Search API `subtree` and `fq` restricting the
+        listing to the shard.
+
+        Shards are either the sub-dataverses listed in the `shards` option,
+        or, with `shard_by_subdataverse`, every sub-dataverse directly under
+        `root_dataverse` (each covering its own subtree) plus a shard for the
+        datasets of the root dataverse itself.
+        '''
+        if self.source_config.get('shards'):
+            return [{'name': alias, 'subtree': alias} for alias in self.source_config['shards']]
+
+        client = self._get_client(url)
+        root = self.source_config.get('root_dataverse', ':root')
+        root_alias = client.get_dataverse(root)['alias']
+        shards = []
+        for item in client.get_dataverse_contents(root):
+            if item.get('type') == 'dataverse':
+                alias = client.get_dataverse(item['id'])['alias']
+                shards.append({'name': alias, 'subtree': alias})
+        shards.append({'name': f'{root_alias} (own datasets)', 'subtree': root_alias,
+                       'fq': [f'identifierOfDataverse:{root_alias}']})
+        log.info(f'Gathering {url} in {len(shards)} shards')
+        return shards
+
+    def _get_sharded_pages(self, url, since=None, offsets=None):
+        '''
+        Walk every shard of the source concurrently with `shard_workers`
+        threads and yield (shard name, page) tuples as pages arrive; a shard
+        starts at its offset in `offsets`, if any.
 
-        items = json_content['items']
-        ret = []
-        guids = []
+        A failing shard is resumed from its last page up to `shard_retries`
+        times without affecting the other shards; if it still fails, the
+        error is raised and the other shards are stopped.
+        '''
+        shards = self._get_shards(url)
+        workers = min(self.source_config.get('shard_workers', DEFAULT_SHARD_WORKERS), len(shards))
+        retries = self.source_config.get('shard_retries', DEFAULT_SHARD_RETRIES)
+        source_config = self.source_config
+        metrics = current_metrics()
+        offsets = offsets or {}
+
+        pages = queue.Queue(maxsize=workers * 2)
+        stop = threading.Event()
+        finished = object()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
 
-        for item in items:
-            name = item.get('name')
-            description = item.get('description')
-            subjects = item.get('subjects')
-            doc_id = item.get(self.source_config['id_field_name'])
-            log.info(f'Data: found {name} {description} {subjects}')
-            guids.append(doc_id)
-            ret.append({'name': name, 'description': description, 'subjects': subjects, 'guid': global_id})
+        def _walk(shard):
+            self.source_config = source_config
+            start = offsets.get(shard['name'], 0)
+            attempt = 0
+            with activate_metrics(metrics):
+                while True:
+                    try:
+                        for page in self._get_pages(url, since, shard, start):
+                            if not _put((shard['name'], page)):
+                                return
+                            start += len(page)
+                        return
+                    except Exception as e:
+                        attempt += 1
+                        if attempt > retries:
+                            raise RuntimeError(f'Shard {shard["name"]} failed at offset {start}: {e}')
+                        log.warning(f'Shard {shard["name"]} failed at offset {start} ({e}), '
+                                    f'retrying ({attempt}/{retries})')
+                        time.sleep(min(2 ** attempt, 30))
+
+        def _run(shard):
+            try:
+                _walk(shard)
+            except Exception as e:
+                _put(e)
+            finally:
+                _put(finished)
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        for shard in shards:
+            executor.submit(_run, shard)
+        try:
+            remaining = len(shards)
+            while remaining:
+                item = pages.get()
+                if item is finished:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+            executor.shutdown(wait=True)
 
-        return guids, ret
+    def _iter_pages(self, url, since=None, offsets=None):
+        '''
+        Yield (cursor, page) tuples for the whole listing of the source,
+        sharded or not, starting each cursor at its offset in `offsets`
+        '''
+        offsets = offsets or {}
+        if self.source_config.get('shards') or self.source_config.get('shard_by_subdataverse'):
+            yield from self._get_sharded_pages(url, since, offsets)
+        else:
+            for page in self._get_pages(url, since, start=offsets.get(UNSHARDED_CURSOR, 0)):
+                yield UNSHARDED_CURSOR, page
+
+    def _get_client(self, url):
+        ''' Return the pooled, rate limited HTTP client for the source URL '''
+        return get_client(
+            url,
+            max_host_connections=int(config.get('ckanext.dataverse.max_connections_per_host',
+                                                DEFAULT_MAX_HOST_CONNECTIONS)),
+            requests_per_second=self.source_config.get('requests_per_second'),
+            max_retries=self.source_config.get('max_retries', DEFAULT_MAX_RETRIES),
+            backoff_factor=self.source_config.get('backoff_factor', DEFAULT_BACKOFF_FACTOR),
+            cache=self._get_response_cache(),
+        )
+
+    def _get_response_cache(self):
+        '''
+        Return the on-disk response cache configured with
+        `ckanext.dataverse.cache_dir`, or None when caching is disabled
+        '''
+        cache_dir = config.get('ckanext.dataverse.cache_dir')
+        if not cache_dir or not self.source_config.get('http_cache', True):
+            return None
+        return get_cache(
+            cache_dir,
+            max_size=int(config.get('ckanext.dataverse.cache_max_size', DEFAULT_CACHE_MAX_SIZE)) * 1024 * 1024,
+            max_age=int(config.get('ckanext.dataverse.cache_max_age', DEFAULT_CACHE_MAX_AGE)) * 24 * 3600,
+        )
+
+    def _prefetch_datasets(self, url, page_index, guids):
+        '''
+        Fetch the full dataset metadata of the given GUIDs concurrently and
+        store it in their page documents under the `dataset` key.
+
+        Failed fetches are left out: the fetch stage will retry them.
+        '''
+        workers = self.source_config.get('fetch_workers', 0)
+        if not workers or not guids:
+            return
+        datasets = self._get_client(url).get_datasets(guids, workers)
+        for guid, result in datasets.items():
+            if not isinstance(result, Exception):
+                page_index[guid]['dataset'] = result[0]
+
+    def _find_unchanged(self, guids, page_index, fingerprints):
+        '''
+        Return the GUIDs whose document has the same remote modification date
+        as the current harvest object, or the same content hash once trimmed
+        to `content_fields` as the objects are stored
+        '''
+        unchanged = set()
+        for guid in guids:
+            doc = page_index[guid]
+            stored_modified, stored_hash = fingerprints.get(guid, (None, None))
+            if (stored_modified and stored_modified == doc.get('modified')) \
+                    or (stored_hash and stored_hash == content_hash(trim_content(doc, self.content_fields))):
+                unchanged.add(guid)
+        return unchanged
+
+    def _get_current_objects(self, harvest_job):
+        '''
+        Return two dicts indexing the current objects of the source by GUID:
+        one with their package id and one with their (remote modification
+        date, content hash) fingerprint
+        '''
+        modified_extra = aliased(HOExtra)
+        hash_extra = aliased(HOExtra)
+        query = model.Session.query(HarvestObject.guid, HarvestObject.package_id,
+                                    modified_extra.value, hash_extra.value). \
+            outerjoin(modified_extra, and_(modified_extra.harvest_object_id == HarvestObject.id,
+                                           modified_extra.key == 'remote_modified')). \
+            outerjoin(hash_extra, and_(hash_extra.harvest_object_id == HarvestObject.id,
+                                       hash_extra.key == 'content_hash')). \
+            filter(HarvestObject.current == True). \
+            filter(HarvestObject.harvest_source_id == harvest_job.source.id)
+
+        guid_to_package_id = {}
+        fingerprints = {}
+        for guid, package_id, modified, hash_ in query:
+            guid_to_package_id[guid] = package_id
+            if modified or hash_:
+                fingerprints[guid] = (modified, hash_)
+        return guid_to_package_id, fingerprints
+
+    def _get_high_water_mark(self, harvest_job):
+        '''
+        Return the start time of the last successful job of the source,
+        i.e. a finished job without gather errors nor object errors, or None.
+
+        Records whose fetch or import failed are not modified again
+        upstream, so a job with object errors cannot be a starting point:
+        the next incremental gather lists them again.
+        '''
+        has_gather_errors = exists().where(HarvestGatherError.harvest_job_id == HarvestJob.id)
+        has_object_errors = exists().where(and_(HarvestObjectError.harvest_object_id == HarvestObject.id,
+                                                HarvestObject.harvest_job_id == HarvestJob.id))
+        return model.Session.query(func.max(HarvestJob.gather_started)). \
+            filter(HarvestJob.source_id == harvest_job.source.id). \
+            filter(HarvestJob.id != harvest_job.id). \
+            filter(HarvestJob.status == 'Finished'). \
+            filter(~has_gather_errors). \
+            filter(~has_object_errors). \
+            scalar()
+
+    def _get_last_full_harvest(self, harvest_job):
+        ''' Return the start time of the last finished full gather of the source, or None '''
+        return model.Session.query(func.max(HarvestJob.gather_started)). \
+            join(DataverseHarvestJob, DataverseHarvestJob.harvest_job_id == HarvestJob.id). \
+            filter(HarvestJob.source_id == harvest_job.source.id). \
+            filter(HarvestJob.id != harvest_job.id). \
+            filter(HarvestJob.status == 'Finished'). \
+            filter(DataverseHarvestJob.mode == 'full'). \
+            scalar()
+
+    def _get_gather_mode(self, harvest_job):
+        '''
+        Return the gather mode of the job and, for incremental gathers, the
+        datetime from which modified datasets are listed.
+
+        A full gather is run when incremental harvesting is disabled, when
+        there is no previous successful job, or when the last full gather is
+        older than `full_harvest_interval` days: only full gathers detect
+        remote deletions.
+        '''
+        if not self.source_config.get('incremental'):
+            return 'full', None
+
+        since = self._get_high_water_mark(harvest_job)
+        if not since:
+            return 'full', None
+
+        interval = self.source_config.get('full_harvest_interval', DEFAULT_FULL_HARVEST_INTERVAL)
+        last_full = self._get_last_full_harvest(harvest_job)
+        if not last_full or datetime.datetime.utcnow() - last_full > datetime.timedelta(days=interval):
+            return 'full', None
+
+        return 'incremental', since
+
+    @staticmethod
+    def _index_page(page, seen_guids):
+        """
+        Return a GUID-keyed dict of the page documents, dropping items
+        without GUID and GUIDs already met in previous pages
+        """
+        page_index = {}
+        for doc in page:
+            guid = doc.get('guid')
+            if guid and guid not in seen_guids:
+                page_index[guid] = doc
+        return page_index
+
+    @staticmethod
+    def _classify_page(page_index, guids_in_db):
+        """
+        Split the GUIDs of an indexed page into new and changed ones.
+
+        Both arguments are hashed collections, so the classification is
+        linear in the page size.
+        """
+        page_guids = page_index.keys()
+        new = page_guids - guids_in_db
+        change = page_guids & guids_in_db
+        return new, change
+
+    def _persist_objects(self, harvest_job, rows):
+        """
+        Insert a batch of HarvestObjects and their status extra with two
+        executemany statements and a single commit.
+
+        Each row is a dict holding guid, status and optionally content,
+        package_id and the values of the OBJECT_EXTRAS keys. Return the ids
+        of the new objects.
+        """
+        if not rows:
+            return []
+
+        gathered = datetime.datetime.utcnow()
+        objects = []
+        extras = []
+        for row in rows:
+            object_id = make_uuid()
+            objects.append({
+                'id': object_id,
+                'guid': row['guid'],
+                'content': row.get('content'),
+                'package_id': row.get('package_id'),
+                'harvest_job_id': harvest_job.id,
+                'harvest_source_id': harvest_job.source.id,
+                'state': 'WAITING',
+                'current': False,
+                'gathered': gathered,
+            })
+            for key in ('status',) + OBJECT_EXTRAS:
+                if row.get(key):
+                    extras.append({
+                        'id': make_uuid(),
+                        'harvest_object_id': object_id,
+                        'key': key,
+                        'value': row[key],
+                    })
+
+        model.Session.bulk_insert_mappings(HarvestObject, objects)
+        model.Session.bulk_insert_mappings(HOExtra, extras)
+        model.Session.commit()
+
+        return [obj['id'] for obj in objects]
+
+    def _flag_deleted_as_not_current(self, harvest_job):
+        """
+        Flip `current` off, in a single statement, for every current object
+        of the source whose GUID was gathered as deleted by this job
+        """
+        deleted_guids = model.Session.query(HarvestObject.guid). \
+            join(HOExtra, HOExtra.harvest_object_id == HarvestObject.id). \
+            filter(HarvestObject.harvest_job_id == harvest_job.id). \
+            filter(HOExtra.key == 'status'). \
+            filter(HOExtra.value == 'delete')
+
+        model.Session.query(HarvestObject). \
+            filter(HarvestObject.harvest_source_id == harvest_job.source.id). \
+            filter(HarvestObject.current == True). \
+            filter(HarvestObject.guid.in_(deleted_guids)). \
+            update({'current': False}, synchronize_session=False)
+        model.Session.commit()
+
+    def _save_checkpoint(self, job_info, since, offsets, stats):
+        '''
+        Record in the job info the listing offsets and stats reached by the
+        gather; the caller commits it together with the gathered objects
+        '''
+        job_info.set_data(dict(job_info.get_data(), checkpoint={
+            'since': since and since.strftime(SOLR_DATE_FORMAT),
+            'offsets': offsets,
+            'stats': stats,
+        }))
+
+    def _get_checkpoint(self, harvest_job, job_info):
+        '''
+        Return the checkpoint the gather of the job should resume from, or
+        None.
+
+        That is the checkpoint of the job itself, when its gather is run
+        again after being interrupted, or the one left by the previous job of
+        the source if its gather failed: the objects that job had gathered
+        but never queued are then moved to the current job.
+        '''
+        checkpoint = job_info.get_data().get('checkpoint')
+        if checkpoint:
+            return checkpoint
+
+        previous = model.Session.query(DataverseHarvestJob). \
+            filter(DataverseHarvestJob.harvest_source_id == harvest_job.source.id). \
+            filter(DataverseHarvestJob.harvest_job_id != harvest_job.id). \
+            order_by(DataverseHarvestJob.created.desc()). \
+            first()
+        if previous is None or model.Session.query(HarvestJob.status). \
+                filter(HarvestJob.id == previous.harvest_job_id).scalar() != 'Finished':
+            return None
+        data = previous.get_data()
+        checkpoint = data.pop('checkpoint', None)
+        if not checkpoint:
+            return None
+
+        log.info(f'Job {harvest_job.id} takes over the interrupted gather of job {previous.harvest_job_id}')
+        model.Session.query(HarvestObject). \
+            filter(HarvestObject.harvest_job_id == previous.harvest_job_id). \
+            filter(HarvestObject.state == 'WAITING'). \
+            update({'harvest_job_id': harvest_job.id}, synchronize_session=False)
+        previous.set_data(data)
+        job_info.set_data(dict(job_info.get_data(), checkpoint=checkpoint))
+        model.Session.commit()
+        return checkpoint
+
+    def _get_gathered_objects(self, harvest_job):
+        ''' Return the ids and the set of GUIDs of the objects already gathered by the job '''
+        ids = []
+        guids = set()
+        query = model.Session.query(HarvestObject.id, HarvestObject.guid). \
+            filter(HarvestObject.harvest_job_id == harvest_job.id)
+        for object_id, guid in query:
+            ids.append(object_id)
+            guids.add(guid)
+        return ids, guids
+
+    def _delete_in_bulk(self, harvest_job, object_ids):
+        '''
+        Delete, or purge with `purge_deleted`, the packages of the given
+        delete objects, `delete_batch_size` packages per transaction, and
+        remove them from the search index with a single Solr commit per
+        batch; the objects are marked as complete.
+
+        Return the ids of the objects of the batches that failed, to be
+        imported one by one.
+        '''
+        purge = self.source_config.get('purge_deleted', False)
+        batch_size = self.source_config.get('delete_batch_size', DEFAULT_DELETE_BATCH_SIZE)
+        remaining = []
+        for start in range(0, len(object_ids), batch_size):
+            batch = object_ids[start:start + batch_size]
+            package_ids = [package_id for (package_id,) in model.Session.query(HarvestObject.package_id).
+                           filter(HarvestObject.id.in_(batch)).
+                           filter(HarvestObject.package_id != None)]
+            try:
+                with timed('gather.delete'):
+                    if purge:
+                        self._purge_packages(harvest_job.id, package_ids)
+                    else:
+                        self._soft_delete_packages(package_ids)
+                    model.Session.query(HarvestObject).filter(HarvestObject.id.in_(batch)). \
+                        update({'state': 'COMPLETE', 'report_status': 'deleted',
+                                'import_finished': datetime.datetime.utcnow()}, synchronize_session=False)
+                    model.Session.commit()
+            except Exception as e:
+                model.Session.rollback()
+                log.warning(f'Could not delete {len(batch)} packages in bulk for job {harvest_job.id} ({e}), '
+                            f'they will be deleted one by one')
+                remaining.extend(batch)
+                continue
+
+            with timed('gather.index'):
+                delete_from_index(package_ids)
+            log.info(f'{"Purged" if purge else "Deleted"} {len(package_ids)} packages of job {harvest_job.id}')
+        return remaining
+
+    def _soft_delete_packages(self, package_ids):
+        '''
+        Flag packages and their group memberships as deleted with two
+        statements, as package_delete does for a single package; plugin
+        hooks are not called and no activity is recorded
+        '''
+        if not package_ids:
+            return
+        model.Session.query(model.Package). \
+            filter(model.Package.id.in_(package_ids)). \
+            filter(model.Package.state != 'deleted'). \
+            update({'state': 'deleted', 'metadata_modified': datetime.datetime.utcnow()},
+                   synchronize_session=False)
+        model.Session.query(model.Member). \
+            filter(model.Member.table_name == 'package'). \
+            filter(model.Member.table_id.in_(package_ids)). \
+            update({'state': 'deleted'}, synchronize_session=False)
+
+    def _purge_packages(self, harvest_job_id, package_ids):
+        '''
+        Purge packages as dataset_purge does, without committing, together
+        with the harvest objects of previous jobs pointing to them; the
+        objects of the given job are kept, detached from the packages
+        '''
+        if not package_ids:
+            return
+        stale_ids = [object_id for (object_id,) in model.Session.query(HarvestObject.id).
+                     filter(HarvestObject.package_id.in_(package_ids)).
+                     filter(HarvestObject.harvest_job_id != harvest_job_id)]
+        if stale_ids:
+            model.Session.query(HOExtra). \
+                filter(HOExtra.harvest_object_id.in_(stale_ids)). \
+                delete(synchronize_session=False)
+            model.Session.query(HarvestObjectError). \
+                filter(HarvestObjectError.harvest_object_id.in_(stale_ids)). \
+                delete(synchronize_session=False)
+            model.Session.query(HarvestObject). \
+                filter(HarvestObject.id.in_(stale_ids)). \
+                delete(synchronize_session=False)
+        model.Session.query(HarvestObject). \
+            filter(HarvestObject.package_id.in_(package_ids)). \
+            update({'package_id': None}, synchronize_session=False)
+
+        model.Session.query(model.Member). \
+            filter(model.Member.table_name == 'package'). \
+            filter(model.Member.table_id.in_(package_ids)). \
+            delete(synchronize_session=False)
+        model.Session.query(model.PackageRelationship). \
+            filter(or_(model.PackageRelationship.subject_package_id.in_(package_ids),
+                       model.PackageRelationship.object_package_id.in_(package_ids))). \
+            delete(synchronize_session=False)
+        for package in model.Session.query(model.Package).filter(model.Package.id.in_(package_ids)):
+            package.purge()
+        model.Session.flush()
 
     def gather_stage(self, harvest_job):
+        dataverse_model.setup()
+        metrics = get_metrics(harvest_job.id)
+        with activate_metrics(metrics), metrics.timed('gather'):
+            ids = self._gather_stage(harvest_job)
+        metrics.incr('gather.objects', len(ids or []))
+        self._save_metrics(harvest_job.id, metrics, 'gather')
+        # the gather consumer does not fetch nor import the objects
+        discard_metrics(harvest_job.id)
+        return ids
+
+    def _gather_stage(self, harvest_job):
         log = logging.getLogger(__name__ + '.gather')
         log.debug(f'{self.harvester_name()} gather_stage for job: {harvest_job}')
         # Get source URL
         url = harvest_job.source.url
 
         self._set_source_config(harvest_job.source.config)
+        batch_size = self.source_config.get('batch_size', DEFAULT_BATCH_SIZE)
+
+        job_info = DataverseHarvestJob.get_or_create(harvest_job)
+        checkpoint = None
+        if self.source_config.get('resume_gather', True):
+            checkpoint = self._get_checkpoint(harvest_job, job_info)
+        if checkpoint:
+            # the records listed before the checkpoint are not known any
+            # more, so a resumed gather cannot detect deletions
+            mode = 'resumed'
+            since = checkpoint['since'] and datetime.datetime.strptime(checkpoint['since'], SOLR_DATE_FORMAT)
+            offsets = checkpoint['offsets']
+            stats = checkpoint['stats']
+            log.info(f'Resuming the gather of job {harvest_job.id} at {offsets}')
+        else:
+            mode, since = self._get_gather_mode(harvest_job)
+            offsets = {}
+            stats = {'new': 0, 'change': 0, 'unchanged': 0, 'delete': 0}
+        job_info.mode = mode
+        model.Session.commit()
+        if since:
+            log.info(f'Incremental gather of datasets modified since {since} for job {harvest_job.id}')
+
+        skip_unchanged = self.source_config.get('skip_unchanged', True)
+        with timed('gather.current_objects'):
+            guid_to_package_id, fingerprints = self._get_current_objects(harvest_job)
+        guids_in_db = guid_to_package_id.keys()
 
+        # Only the GUIDs are kept for the whole run, to detect deletions;
+        # documents are persisted and released batch by batch. The objects
+        # persisted before a checkpoint are part of the job already
+        ids, guids_in_harvest = self._get_gathered_objects(harvest_job)
+
+        pending = []
         try:
-            local_guids, data = self._get_resources(url)
+            for cursor, page in self._iter_pages(url, since, offsets):
+                page_index = self._index_page(page, guids_in_harvest)
+                new, change = self._classify_page(page_index, guids_in_db)
+                guids_in_harvest.update(page_index)
+
+                # Unchanged records are not enqueued at all: their current
+                # object stays current
+                if skip_unchanged:
+                    unchanged = self._find_unchanged(change, page_index, fingerprints)
+                    change -= unchanged
+                with timed('gather.prefetch'):
+                    self._prefetch_datasets(url, page_index, list(new | change))
+                if skip_unchanged:
+                    # prefetched documents hash like the fetched objects
+                    prefetched_unchanged = self._find_unchanged(change, page_index, fingerprints)
+                    change -= prefetched_unchanged
+                    stats['unchanged'] += len(unchanged) + len(prefetched_unchanged)
+
+                for guid in new:
+                    doc = page_index[guid]
+                    content, hash_ = self._encode_content(doc)
+                    pending.append({'guid': guid, 'status': 'new',
+                                    'content': content,
+                                    'content_hash': hash_,
+                                    'remote_modified': doc.get('modified')})
+
+                for guid in change:
+                    doc = page_index[guid]
+                    content, hash_ = self._encode_content(doc)
+                    pending.append({'guid': guid, 'status': 'change',
+                                    'content': content,
+                                    'content_hash': hash_,
+                                    'remote_modified': doc.get('modified'),
+                                    'package_id': guid_to_package_id[guid]})
+                stats['new'] += len(new)
+                stats['change'] += len(change)
+                offsets[cursor] = offsets.get(cursor, 0) + len(page)
+
+                if len(pending) >= batch_size:
+                    # the checkpoint is committed along with the objects
+                    self._save_checkpoint(job_info, since, offsets, stats)
+                    with timed('gather.persist'):
+                        ids.extend(self._persist_objects(harvest_job, pending))
+                    pending = []
+
+            with timed('gather.persist'):
+                ids.extend(self._persist_objects(harvest_job, pending))
         except Exception as e:
-            self._save_gather_error(f'Error harvesting {self.harvester_name()}: {harvest_job}')
+            model.Session.rollback()
+            self._save_gather_error(f'Error harvesting {self.harvester_name()}: {e}', harvest_job)
             return None
 
-        query = model.Session.query(HarvestObject.guid, HarvestObject.package_id). \
-            filter(HarvestObject.current == True). \
-            filter(HarvestObject.harvest_source_id == harvest_job.source.id)
-        guid_to_package_id = {}
-
-        for guid, package_id in query:
-            guid_to_package_id[guid] = package_id
-
-        guids_in_db = set(guid_to_package_id.keys())
+        cache = self._get_response_cache()
+        if cache:
+            log.info(f'HTTP response cache for job {harvest_job.id}: {cache.stats()}')
 
-        guids_in_harvest = local_guids
-
-        new = guids_in_harvest - guids_in_db
-        delete = guids_in_db - guids_in_harvest
-        change = guids_in_db & guids_in_harvest
-
-        ids = []
-        for guid in new:
-            doc = dict()
-            for d in data:
-                if d['guid'] == guid:
-                    doc = d
-                    break
-
-            obj = HarvestObject(guid=guid, job=harvest_job, content=doc,
-                                extras=[HOExtra(key='status', value='new')])
-            obj.save()
-            ids.append(obj.id)
-
-        for guid in change:
-            doc = dict()
-            for d in data:
-                if d['guid'] == guid:
-                    doc = d
-                    break
-            obj = HarvestObject(guid=guid, job=harvest_job, content=doc,
-                                package_id=guid_to_package_id[guid],
-                                extras=[HOExtra(key='status', value='change')])
-            obj.save()
-            ids.append(obj.id)
+        # an incremental listing says nothing about datasets missing upstream
+        if mode == 'full':
+            delete = guids_in_db - guids_in_harvest
+        else:
+            delete = set()
 
+        delete_ids = []
+        pending = []
         for guid in delete:
-            obj = HarvestObject(guid=guid, job=harvest_job,
-                                package_id=guid_to_package_id[guid],
-                                extras=[HOExtra(key='status', value='delete')])
-            ids.append(obj.id)
-            model.Session.query(HarvestObject). \
-                filter_by(guid=guid). \
-                update({'current': False}, False)
-            obj.save()
+            pending.append({'guid': guid, 'status': 'delete',
+                            'package_id': guid_to_package_id[guid]})
+            if len(pending) >= batch_size:
+                with timed('gather.persist'):
+                    delete_ids.extend(self._persist_objects(harvest_job, pending))
+                pending = []
+        with timed('gather.persist'):
+            delete_ids.extend(self._persist_objects(harvest_job, pending))
+
+        if delete:
+            with timed('gather.persist'):
+                self._flag_deleted_as_not_current(harvest_job)
+
+        # deletions processed in bulk are not queued for import
+        if delete_ids and self.source_config.get('bulk_delete'):
+            delete_ids = self._delete_in_bulk(harvest_job, delete_ids)
+        ids.extend(delete_ids)
+
+        stats['delete'] = len(delete)
+        job_info = DataverseHarvestJob.get_or_create(harvest_job)
+        data = job_info.get_data()
+        data.pop('checkpoint', None)
+        job_info.set_data(dict(data, gather_stats=stats))
+        model.Session.commit()
+        log.info(f'Gather stats for job {harvest_job.id}: {stats}')
 
         if len(ids) == 0:
-            self._save_gather_error(f'No records received from the {self.harvester_name()} service {harvest_job}')
+            if mode == 'incremental':
+                log.info(f'No datasets modified since {since} for job {harvest_job.id}')
+                return []
+            if guids_in_harvest or delete:
+                log.info(f'No new, changed or deleted records left to import for job {harvest_job.id}')
+                return []
+            self._save_gather_error(f'No records received from the {self.harvester_name()} service', harvest_job)
             return None
 
         return ids
 
+    def diff(self, harvest_source, source_config=None, list_guids=False):
+        '''
+        Compare the remote listing of a source with its current harvest
+        objects without writing anything to the database or the search
+        index, and return the counts of new, changed, unchanged and deleted
+        records, as a gather would compute them.
+
+        `source_config` is a configuration JSON string replacing the one of
+        the source, e.g. to try a new filter. The whole listing is walked,
+        incremental or not. Datasets are not prefetched, so records whose
+        modification date changed but whose dataset did not count as changed.
+
+        Pages are compared one at a time with the objects of their GUIDs, so
+        only the GUIDs of the listing are held in memory. With `list_guids`,
+        the result also holds the sorted GUID list of every status.
+        '''
+        self._set_source_config(source_config or harvest_source.config)
+        stats = {'new': 0, 'change': 0, 'unchanged': 0, 'delete': 0}
+        guids = {status: [] for status in stats} if list_guids else None
+
+        current_count = model.Session.query(func.count(HarvestObject.id)). \
+            filter(HarvestObject.current == True). \
+            filter(HarvestObject.harvest_source_id == harvest_source.id). \
+            scalar()
+
+        skip_unchanged = self.source_config.get('skip_unchanged', True)
+        seen_guids = set()
+        matched = 0
+        for cursor, page in self._iter_pages(harvest_source.url):
+            page_index = self._index_page(page, seen_guids)
+            seen_guids.update(page_index)
+            fingerprints = self._get_fingerprints(harvest_source.id, list(page_index))
+            new, change = self._classify_page(page_index, fingerprints.keys())
+            # without skip_unchanged, the gather queues every known record
+            unchanged = self._find_unchanged(change, page_index, fingerprints) if skip_unchanged else set()
+            change -= unchanged
+            matched += len(fingerprints)
+            for status, page_guids in (('new', new), ('change', change), ('unchanged', unchanged)):
+                stats[status] += len(page_guids)
+                if list_guids:
+                    guids[status].extend(page_guids)
+        model.Session.rollback()
+
+        stats['delete'] = current_count - matched
+        result = dict(stats)
+        if list_guids:
+            query = model.Session.query(HarvestObject.guid). \
+                filter(HarvestObject.current == True). \
+                filter(HarvestObject.harvest_source_id == harvest_source.id). \
+                yield_per(1000)
+            guids['delete'] = [guid for (guid,) in query if guid not in seen_guids]
+            model.Session.rollback()
+            result['guids'] = {status: sorted(status_guids) for status, status_guids in guids.items()}
+        log.info(f'Diff of source {harvest_source.id}: {stats}')
+        return result
+
+    def _get_fingerprints(self, harvest_source_id, guids):
+        '''
+        Return the (remote modification date, content hash) fingerprints of
+        the current objects of the source with the given GUIDs, by GUID
+        '''
+        if not guids:
+            return {}
+        modified_extra = aliased(HOExtra)
+        hash_extra = aliased(HOExtra)
+        query = model.Session.query(HarvestObject.guid, modified_extra.value, hash_extra.value). \
+            outerjoin(modified_extra, and_(modified_extra.harvest_object_id == HarvestObject.id,
+                                           modified_extra.key == 'remote_modified')). \
+            outerjoin(hash_extra, and_(hash_extra.harvest_object_id == HarvestObject.id,
+                                       hash_extra.key == 'content_hash')). \
+            filter(HarvestObject.current == True). \
+            filter(HarvestObject.harvest_source_id == harvest_source_id). \
+            filter(HarvestObject.guid.in_(guids))
+        return {guid: (modified, hash_) for guid, modified, hash_ in query}
+
     def fetch_stage(self, harvest_object):
+        dataverse_model.setup()
+        harvest_job_id = harvest_object.harvest_job_id
+        with self._get_job_activity().working(harvest_job_id):
+            metrics = get_metrics(harvest_job_id)
+            started = time.perf_counter()
+            with activate_metrics(metrics), metrics.timed('fetch'):
+                result = self._fetch_stage(harvest_object)
+            if self._record_object(metrics, 'fetch', harvest_object, result, started) % METRICS_FLUSH_INTERVAL == 0:
+                self._save_metrics(harvest_job_id, metrics, 'fetch')
+        return result
+
+    def _fetch_stage(self, harvest_object):
+        '''
+        Add the full dataset metadata, as returned by the native API, to the
+        content of the harvest object under the `dataset` key, unless it was
+        already prefetched during the gather stage
+        '''
+        log = logging.getLogger(__name__ + '.fetch')
+        log.debug(f'{self.harvester_name()}: Fetch stage for harvest object: {harvest_object.id}')
+
+        if not harvest_object.content:
+            # deleted datasets have nothing to fetch
+            return True
+
+        self._set_source_config(harvest_object.source.config)
+        content = load_content(harvest_object.content)
+        if 'dataset' in content:
+            return True
+
+        client = self._get_client(harvest_object.source.url)
+
+        try:
+            content['dataset'] = client.get_dataset(harvest_object.guid)[0]
+        except Exception as e:
+            self._save_object_error(
+                f'Could not fetch dataset {harvest_object.guid}: {e}',
+                harvest_object,
+                'Fetch'
+            )
+            return False
+
+        harvest_object.content, hash_ = self._encode_content(content)
+        self._set_object_extra(harvest_object, 'content_hash', hash_)
+        harvest_object.save()
+
         return True
 
     def import_stage(self, harvest_object):
+        if not harvest_object:
+            return self._import_stage(harvest_object)
+
+        dataverse_model.setup()
+        harvest_job_id = harvest_object.harvest_job_id
+        activity = self._get_job_activity()
+        with activity.working(harvest_job_id):
+            metrics = get_metrics(harvest_job_id)
+            started = time.perf_counter()
+            source_config = get_harvest_context(harvest_object.source).config
+            with activate_metrics(metrics), metrics.timed('import'), self._profiled(harvest_job_id, source_config):
+                result = self._import_stage(harvest_object)
+            if self._record_object(metrics, 'import', harvest_object, result, started) % METRICS_FLUSH_INTERVAL == 0:
+                self._save_metrics(harvest_job_id, metrics, 'import')
+            profile = get_profile(harvest_job_id, create=False)
+            if profile is not None and profile.objects % PROFILE_WRITE_INTERVAL == 0:
+                self._save_profile(harvest_job_id, profile)
+            done = not self._has_waiting_objects(harvest_job_id)
+
+        # once no object of the job is left to hand out, the process flushes
+        # its own share of the job (queued index updates included); workers
+        # that do not get any of the last objects flush theirs after being
+        # idle for a while (see JobActivity)
+        if done:
+            activity.finish(harvest_job_id)
+        return result
+
+    def _import_stage(self, harvest_object, bulk=False, errors=None):
+        '''
+        Import a single harvest object.
+
+        With `bulk`, nothing is committed, errors are appended to `errors`
+        instead of being saved, and indexing, including the removal of
+        deleted packages, is left to the caller: see bulk_import.
+        '''
 
         log = logging.getLogger(__name__ + '.import')
-        log.debug(f'{self.harvester_name()}: Import stage for harvest object: {harvest_object.id}')
 
         if not harvest_object:
             log.error('No harvest object received')
             return False
 
-        if not harvest_object.content:
+        log.debug(f'{self.harvester_name()}: Import stage for harvest object: {harvest_object.id}')
+
+        status = self._get_object_extra(harvest_object, 'status')
+
+        # deleted datasets are gathered without content
+        if not harvest_object.content and status != 'delete':
             log.error('Harvest object contentless')
-            self._save_object_error(
-                f'Empty content for object {harvest_object.id}',
-                harvest_object,
-                'Import'
-            )
+            self._import_error(f'Empty content for object {harvest_object.id}', harvest_object, errors)
             return False
 
-        self._set_source_config(harvest_object.source.config)
+        harvest_context = get_harvest_context(harvest_object.source)
+        self.source_config = harvest_context.config
 
-        status = self._get_object_extra(harvest_object, 'status')
+        # the unchanged path moves the object to the previous job
+        harvest_job_id = harvest_object.harvest_job_id
 
-        # Get the last harvested object (if any)
-        previous_object = Session.query(HarvestObject) \
-            .filter(HarvestObject.guid == harvest_object.guid) \
-            .filter(HarvestObject.current == True) \
-            .first()
+        # Get the last harvested object (if any); its content is only needed
+        # for objects harvested before content hashes were stored
+        with timed('import.previous_object'):
+            if harvest_object.guid:
+                self._lock_guid(harvest_object)
+            previous_object = Session.query(HarvestObject) \
+                .options(defer(HarvestObject.content)) \
+                .filter(HarvestObject.harvest_source_id == harvest_object.harvest_source_id) \
+                .filter(HarvestObject.guid == harvest_object.guid) \
+                .filter(HarvestObject.current == True) \
+                .first()
 
-        context = {'model': model, 'session': model.Session, 'user': self._get_user_name()}
+        context = harvest_context.action_context()
+        if bulk:
+            context['defer_commit'] = True
 
         if status == 'delete':
+            package_id = harvest_object.package_id
+            if self.source_config.get('purge_deleted'):
+                with timed('import.package_action'):
+                    self._purge_packages(harvest_job_id, [package_id])
+                harvest_object.package_id = None
+                if not bulk:
+                    model.Session.commit()
+                    delete_from_index([package_id])
+                log.info(f'Purged package {package_id} with guid {harvest_object.guid}')
+                return True
+
+            # package_delete always commits, which would end the savepoint
+            # of the object in a bulk import
+            if bulk:
+                with timed('import.package_action'):
+                    self._soft_delete_packages([package_id])
+                log.info(f'Deleted package {package_id} with guid {harvest_object.guid}')
+                return True
+
             # Delete package
-            p.toolkit.get_action('package_delete')(context, {'id': harvest_object.package_id})
-            log.info('Deleted package {0} with guid {1}'.format(harvest_object.package_id, harvest_object.guid))
+            try:
+                p.toolkit.get_action('package_delete')(context, {'id': package_id})
+            except p.toolkit.ObjectNotFound:
+                log.info(f'Package {package_id} with guid {harvest_object.guid} is already gone')
+                return True
+            log.info('Deleted package {0} with guid {1}'.format(package_id, harvest_object.guid))
 
             return True
 
+        # Another object of the same GUID was imported since this one was
+        # gathered (e.g. by a concurrent worker): update its package
+        if status == 'new' and previous_object and previous_object.package_id:
+            status = 'change'
+            harvest_object.package_id = previous_object.package_id
+            self._set_object_extra(harvest_object, 'status', status)
+
         # Flag previous object as not current anymore
         if previous_object:
             previous_object.current = False
@@ -225,23 +1212,19 @@ class DataVerseHarvester(HarvesterBase, SingletonPlugin):
 
         # Generate GUID if not present (i.e. it's a manual import)
         if not harvest_object.guid:
-            self._save_object_error('Missing GUID for object {0}'
-                                    .format(harvest_object.id), harvest_object, 'Import')
+            self._import_error('Missing GUID for object {0}'.format(harvest_object.id), harvest_object, errors)
             return False
 
         # pre-check to skip resource logic in case no changes occurred remotely
-        if status == 'change':
-
-            # Check if the document has changed
-            m = hashlib.md5()
-            m.update(previous_object.content)
-            old_md5 = m.hexdigest()
+        if status == 'change' and previous_object:
 
-            m = hashlib.md5()
-            m.update(harvest_object.content)
-            new_md5 = m.hexdigest()
+            # Check if the document has changed; a 304 from the response
+            # cache only tells that the cached body is unchanged, not that it
+            # was imported, so the hashes are always compared
+            old_hash = self._get_content_hash(previous_object)
+            new_hash = self._get_content_hash(harvest_object)
 
-            if old_md5 == new_md5:
+            if old_hash == new_hash:
 
                 # Assign the previous job id to the new object to # avoid losing history
                 harvest_object.harvest_job_id = previous_object.job.id
@@ -254,6 +1237,16 @@ class DataVerseHarvester(HarvesterBase, SingletonPlugin):
                 previous_object.delete()
 
                 # Reindex the corresponding package to update the reference to the harvest object
+                if bulk:
+                    log.info(f'{self.harvester_name()} document with GUID {harvest_object.id} unchanged, skipping...')
+                    return True
+
+                if self._deferred_indexing():
+                    model.Session.commit()
+                    self._index_later(harvest_job_id, harvest_object, harvest_object.package_id)
+                    log.info(f'{self.harvester_name()} document with GUID {harvest_object.id} unchanged, skipping...')
+                    return True
+
                 context.update({'validate': False, 'ignore_auth': True})
                 try:
                     package_dict = logic.get_action('package_show')(context,
@@ -265,8 +1258,9 @@ class DataVerseHarvester(HarvesterBase, SingletonPlugin):
                         if extra['key'] == 'harvest_object_id':
                             extra['value'] = harvest_object.id
                     if package_dict:
-                        package_index = PackageSearchIndex()
-                        package_index.index_package(package_dict)
+                        with timed('import.index'):
+                            package_index = PackageSearchIndex()
+                            package_index.index_package(package_dict)
 
                 log.info(f'{self.harvester_name()} document with GUID {harvest_object.id} unchanged, skipping...')
                 model.Session.commit()
@@ -274,45 +1268,39 @@ class DataVerseHarvester(HarvesterBase, SingletonPlugin):
                 return True
 
         # Build the package dict
-        package_dict, metadata = self.create_package_dict(harvest_object.guid, harvest_object.content)
+        with timed('import.create_package_dict'):
+            package_dict, metadata = self.create_package_dict(harvest_object.guid,
+                                                              decode_content(harvest_object.content))
 
         if not package_dict:
             log.error('No package dict returned, aborting import for object {0}'.format(harvest_object.id))
             return False
 
-        package_dict['name'] = self._gen_new_name(package_dict['title'])
+        # Updated datasets keep their name; new names are checked against an
+        # index of the existing names loaded once per job
+        names = get_name_index(harvest_job_id, harvest_object.harvest_source_id)
+        name = names.get_name(harvest_object.package_id) if status == 'change' else None
+        package_dict['name'] = name or names.new_name(package_dict['title'])
 
-        # We need to get the owner organization (if any) from the harvest source dataset
-        source_dataset = model.Package.get(harvest_object.source.id)
-        if source_dataset.owner_org:
-            package_dict['owner_org'] = source_dataset.owner_org
+        # The owner organization (if any) is the one of the harvest source dataset
+        if harvest_context.owner_org:
+            package_dict['owner_org'] = harvest_context.owner_org
 
-        self.attach_resources(metadata, package_dict)
+        with timed('import.attach_resources'):
+            self.attach_resources(metadata, package_dict)
 
         # Create / update the package
 
-        context = {'model': model,
-                   'session': model.Session,
-                   'user': self._get_user_name(),
-                   'extras_as_string': True,
-                   'api_version': '2',
-                   'return_id_only': True}
-        if context['user'] == self._site_user['name']:
-            context['ignore_auth'] = True
-
-        # The default package schema does not like Upper case tags
-        tag_schema = logic.schema.default_tags_schema()
-        tag_schema['name'] = [not_empty, unicode]
+        context = harvest_context.action_context(extras_as_string=True, api_version='2', return_id_only=True)
+        if bulk:
+            context['defer_commit'] = True
 
         if status == 'new':
-            package_schema = logic.schema.default_create_package_schema()
-            package_schema['tags'] = tag_schema
-            context['schema'] = package_schema
+            context['schema'] = harvest_context.create_schema
 
             # We need to explicitly provide a package ID, otherwise ckanext-spatial
             # won't be be able to link the extent to the package.
-            package_dict['id'] = unicode(uuid.uuid4())
-            package_schema['id'] = [unicode]
+            package_dict['id'] = str(uuid.uuid4())
 
             # Save reference to the package on the object
             harvest_object.package_id = package_dict['id']
@@ -324,31 +1312,368 @@ class DataVerseHarvester(HarvesterBase, SingletonPlugin):
             model.Session.flush()
 
             try:
-                package_id = p.toolkit.get_action('package_create')(context, package_dict)
+                try:
+                    self._validate_package_dict(context, package_dict, 'package_create')
+                except p.toolkit.ValidationError as e:
+                    if 'name' not in e.error_dict:
+                        raise
+                    # the name was taken by another process since the index
+                    # was loaded: probe the database for a free one
+                    package_dict['name'] = self._gen_new_name(package_dict['title'])
+                    names.add(package_dict['name'])
+                    self._validate_package_dict(context, package_dict, 'package_create')
+                with self._indexing_context(), timed('import.package_action'):
+                    package_id = p.toolkit.get_action('package_create')(context, package_dict)
+                names.add(package_dict['name'], package_id)
                 log.info(f'{self.harvester_name()}: Created new package {package_id} with guid {harvest_object.guid}')
             except p.toolkit.ValidationError as e:
-                self._save_object_error(f'Validation Error: {e.error_summary} {harvest_object} Import')
+                self._validation_error(e, harvest_object, bulk, errors)
                 return False
 
         elif status == 'change':
-            # we know the internal document did change, bc of a md5 hash comparison done above
+            # we know the internal document did change, bc of a hash comparison done above
 
-            package_schema = logic.schema.default_update_package_schema()
-            package_schema['tags'] = tag_schema
-            context['schema'] = package_schema
+            context['schema'] = harvest_context.update_schema
 
             package_dict['id'] = harvest_object.package_id
             try:
-                package_id = p.toolkit.get_action('package_update')(context, package_dict)
+                self._validate_package_dict(context, package_dict, 'package_update')
+                with self._indexing_context(), timed('import.package_action'):
+                    package_id = p.toolkit.get_action('package_update')(context, package_dict)
                 log.info(f'{self.harvester_name()} updated package {package_id} with guid {harvest_object.guid}')
             except p.toolkit.ValidationError as e:
-                self._save_object_error(f'Validation Error: {e.error_summary} {harvest_object} Import')
+                self._validation_error(e, harvest_object, bulk, errors)
                 return False
 
+        if bulk:
+            return True
+
         model.Session.commit()
 
+        if self._deferred_indexing():
+            self._index_later(harvest_job_id, harvest_object, package_id)
+
         return True
 
+    def _validate_package_dict(self, context, package_dict, action):
+        '''
+        Validate a package dict as `action` will and raise ValidationError
+        on errors, so that the action is only called with valid data.
+
+        On validation errors, package_create and package_update roll the
+        whole session back: that would close the savepoint of the object in
+        a bulk import, and drop the object state set up for the import (its
+        package id, the current flags and the GUID lock) before a retry.
+        '''
+        validation_context = dict(context)
+        if action == 'package_update':
+            validation_context['package'] = model.Package.get(package_dict['id'])
+        package_plugin = lib_plugins.lookup_package_plugin(package_dict.get('type'))
+        with timed('import.validate'):
+            _data, validation_errors = lib_plugins.plugin_validate(
+                package_plugin, validation_context, package_dict, context['schema'], action)
+        if validation_errors:
+            raise p.toolkit.ValidationError(validation_errors)
+
+    def _validation_error(self, error, harvest_object, bulk, errors=None):
+        '''
+        Save or collect the validation error of an object; outside bulk
+        imports, the object changes are rolled back first, as the action
+        would have done
+        '''
+        if not bulk:
+            model.Session.rollback()
+        self._import_error(f'Validation Error: {error.error_summary}', harvest_object, errors)
+
+    def _import_error(self, message, harvest_object, errors=None):
+        ''' Save an import error, or collect it when importing in bulk '''
+        if errors is None:
+            self._save_object_error(message, harvest_object, 'Import')
+        else:
+            errors.append((harvest_object, message))
+
+    def bulk_import(self, harvest_job, batch_size=DEFAULT_IMPORT_BATCH_SIZE):
+        '''
+        Fetch and import all the pending objects of a job, `batch_size`
+        objects per transaction.
+
+        Each object is imported inside a savepoint, so that a failing record
+        is rolled back alone; the packages of a batch are indexed in Solr
+        once the batch is committed. Return the number of imported and
+        errored objects.
+        '''
+        dataverse_model.setup()
+        self._set_source_config(harvest_job.source.config)
+        metrics = get_metrics(harvest_job.id)
+
+        object_ids = [object_id for (object_id,) in model.Session.query(HarvestObject.id).
+                      filter(HarvestObject.harvest_job_id == harvest_job.id).
+                      filter(HarvestObject.state.in_(['WAITING', 'FETCH', 'IMPORT'])).
+                      order_by(HarvestObject.gathered)]
+        log.info(f'Bulk importing {len(object_ids)} objects of job {harvest_job.id}')
+
+        imported = errored = 0
+        try:
+            for start in range(0, len(object_ids), batch_size):
+                batch_imported, batch_errored = self._import_batch(harvest_job,
+                                                                   object_ids[start:start + batch_size], metrics)
+                imported += batch_imported
+                errored += batch_errored
+                log.info(f'Job {harvest_job.id}: {imported} objects imported, {errored} errors')
+        finally:
+            model.Session.rollback()
+            self._finish_job(harvest_job.id, metrics)
+        return imported, errored
+
+    def _fetch_batch(self, harvest_job, objects, errors):
+        ''' Fetch concurrently the datasets of the objects that were not prefetched, without committing '''
+        to_fetch = {}
+        for harvest_object in objects:
+            if harvest_object.content and 'dataset' not in load_content(harvest_object.content):
+                to_fetch[harvest_object.guid] = harvest_object
+        if not to_fetch:
+            return
+
+        workers = max(self.source_config.get('fetch_workers', 0), 1)
+        with timed('fetch'):
+            datasets = self._get_client(harvest_job.source.url).get_datasets(list(to_fetch), workers)
+        for guid, result in datasets.items():
+            harvest_object = to_fetch[guid]
+            if isinstance(result, Exception):
+                errors.append((harvest_object, f'Could not fetch dataset {guid}: {result}'))
+                continue
+            content = load_content(harvest_object.content)
+            content['dataset'] = result[0]
+            harvest_object.content, hash_ = self._encode_content(content)
+            self._set_object_extra(harvest_object, 'content_hash', hash_)
+
+    def _import_batch(self, harvest_job, object_ids, metrics):
+        errors = []
+        succeeded = []
+        package_ids = []
+        deleted_ids = []
+
+        # resolve the harvesting user before opening the batch transaction
+        get_harvest_context(harvest_job.source)
+
+        with activate_metrics(metrics), automatic_indexing_disabled():
+            objects = model.Session.query(HarvestObject).filter(HarvestObject.id.in_(object_ids)).all()
+            self._fetch_batch(harvest_job, objects, errors)
+            failed_fetches = {harvest_object.id for harvest_object, message in errors}
+
+            for harvest_object in objects:
+                if harvest_object.id in failed_fetches:
+                    continue
+                started = time.perf_counter()
+                object_errors = []
+                # purging detaches the object from its package
+                package_id = harvest_object.package_id
+                deleted = self._get_object_extra(harvest_object, 'status') == 'delete'
+                savepoint = model.Session.begin_nested()
+                try:
+                    with metrics.timed('import'), self._profiled(harvest_job.id, self.source_config):
+                        success = self._import_stage(harvest_object, bulk=True, errors=object_errors)
+                except Exception as e:
+                    log.exception(f'Error importing object {harvest_object.id}')
+                    object_errors.append((harvest_object, f'Error importing object: {e}'))
+                    success = False
+
+                # a session rollback made by CKAN itself closes the savepoint
+                # and undoes what the import did
+                if success and not savepoint.is_active:
+                    object_errors.append((harvest_object, 'Import rolled back by CKAN'))
+                    success = False
+
+                if success:
+                    savepoint.commit()
+                    succeeded.append(harvest_object.id)
+                    if deleted:
+                        if package_id:
+                            deleted_ids.append(package_id)
+                    elif harvest_object.package_id:
+                        package_ids.append(harvest_object.package_id)
+                else:
+                    if savepoint.is_active:
+                        savepoint.rollback()
+                    errors.extend(object_errors)
+                self._record_object(metrics, 'import', harvest_object, success, started)
+
+            now = datetime.datetime.utcnow()
+            succeeded_ids = set(succeeded)
+            failed = [object_id for object_id in object_ids if object_id not in succeeded_ids]
+            if succeeded:
+                model.Session.query(HarvestObject).filter(HarvestObject.id.in_(succeeded)). \
+                    update({'state': 'COMPLETE', 'import_finished': now}, synchronize_session=False)
+            if failed:
+                model.Session.query(HarvestObject).filter(HarvestObject.id.in_(failed)). \
+                    update({'state': 'ERROR', 'import_finished': now}, synchronize_session=False)
+            model.Session.commit()
+
+        for harvest_object, message in errors:
+            model.Session.add(HarvestObjectError(message=message, object=harvest_object, stage='Import'))
+        model.Session.commit()
+
+        indexer = get_indexer(self.source_config.get('index_batch_size', DEFAULT_INDEX_BATCH_SIZE))
+        with activate_metrics(metrics), timed('import.index'):
+            for package_id in package_ids:
+                indexer.add(harvest_job.id, package_id)
+            indexer.flush()
+            delete_from_index(deleted_ids)
+
+        return len(succeeded), len(failed)
+
+    def run_bulk_job(self, harvest_job, batch_size=DEFAULT_IMPORT_BATCH_SIZE):
+        '''
+        Run a whole job in the current process, without the harvest queues:
+        gather, then fetch and import in bulk. Return the number of imported
+        and errored objects.
+
+        Whatever happens, the job ends up 'Finished'; an error stopping the
+        run is saved as a gather error of the job and raised again.
+        '''
+        harvest_job_id = harvest_job.id
+        harvest_job.status = 'Running'
+        harvest_job.gather_started = datetime.datetime.utcnow()
+        harvest_job.save()
+
+        imported = errored = 0
+        try:
+            ids = self.gather_stage(harvest_job)
+
+            harvest_job.gather_finished = datetime.datetime.utcnow()
+            harvest_job.save()
+
+            if ids:
+                imported, errored = self.bulk_import(harvest_job, batch_size)
+        except Exception as e:
+            log.exception(f'Error running job {harvest_job_id}')
+            model.Session.rollback()
+            self._save_gather_error(f'Error running job {harvest_job_id}: {e}', HarvestJob.get(harvest_job_id))
+            raise
+        finally:
+            model.Session.rollback()
+            harvest_job = HarvestJob.get(harvest_job_id)
+            harvest_job.status = 'Finished'
+            harvest_job.finished = datetime.datetime.utcnow()
+            harvest_job.save()
+        return imported, errored
+
+    def _deferred_indexing(self):
+        return self.source_config.get('deferred_indexing', False)
+
+    def _indexing_context(self):
+        '''
+        Return the context manager wrapping package_create/package_update:
+        with deferred indexing, CKAN synchronous indexing is turned off as
+        the harvester indexes the packages in batches
+        '''
+        if self._deferred_indexing():
+            return automatic_indexing_disabled()
+        return contextlib.nullcontext()
+
+    def _index_later(self, harvest_job_id, harvest_object, package_id):
+        '''
+        Queue the package for batched indexing; the queue of the process is
+        flushed when it is full and when the process is done with the job
+        '''
+        indexer = get_indexer(self.source_config.get('index_batch_size', DEFAULT_INDEX_BATCH_SIZE))
+        with timed('import.index'):
+            indexer.add(harvest_job_id, package_id)
+
+    def _has_waiting_objects(self, harvest_job_id):
+        '''
+        Tell whether objects of the job are still waiting to be handed to a
+        worker; the objects being fetched or imported are flushed by the
+        worker handling them
+        '''
+        return model.Session.query(
+            model.Session.query(HarvestObject.id).
+            filter(HarvestObject.harvest_job_id == harvest_job_id).
+            filter(HarvestObject.state == 'WAITING').
+            exists()
+        ).scalar()
+
+    def _get_job_activity(self):
+        ''' Return the JobActivity of the process, flushing jobs with _finish_job '''
+        global _job_activity
+        with _job_activity_lock:
+            if _job_activity is None:
+                idle_timeout = int(config.get('ckanext.dataverse.worker_idle_timeout', DEFAULT_IDLE_TIMEOUT))
+                _job_activity = JobActivity(self._detach_job, self._finish_detached_job, idle_timeout)
+            return _job_activity
+
+    def _detach_job(self, harvest_job_id):
+        ''' Take the metrics and the import profile of a job out of the process registries '''
+        return discard_metrics(harvest_job_id), discard_profile(harvest_job_id)
+
+    def _finish_detached_job(self, harvest_job_id, state):
+        metrics, profile = state
+        self._finish_job(harvest_job_id, metrics, profile)
+
+    def _finish_job(self, harvest_job_id, metrics, profile=None):
+        ''' Flush what the process accumulated for a job once it is done with the job '''
+        indexer = get_indexer()
+        if indexer.job_id == harvest_job_id:
+            with activate_metrics(metrics), timed('import.index'):
+                indexer.flush()
+        if metrics is not None:
+            self._save_metrics(harvest_job_id, metrics, 'import')
+        discard_metrics(harvest_job_id)
+        discard_name_index(harvest_job_id)
+        self._save_profile(harvest_job_id, profile or discard_profile(harvest_job_id))
+
+    def _profiled(self, harvest_job_id, source_config):
+        '''
+        Return a context manager profiling the import of an object into the
+        profile of its job when profiling is enabled, site wide with
+        `ckanext.dataverse.profile_import` or with the `profile_import`
+        option of the source
+        '''
+        if not profiling_enabled(source_config):
+            return contextlib.nullcontext()
+        return get_profile(harvest_job_id).profiled()
+
+    def _save_profile(self, harvest_job_id, profile):
+        ''' Write the import profile of the job, if any, to the profile directory '''
+        if profile is None or not profile.objects:
+            return
+        try:
+            path = profile.write_report(get_profile_dir())
+            log.info(f'Import profile of job {harvest_job_id} written to {path}')
+        except Exception as e:
+            log.warning(f'Could not write the import profile of job {harvest_job_id}: {e}')
+
+    def _record_object(self, metrics, stage, harvest_object, result, started):
+        ''' Record an object processed by a stage; return how many objects the stage processed so far '''
+        metrics.incr(f'{stage}.objects')
+        if not result:
+            metrics.incr(f'{stage}.errors')
+        log.debug(json.dumps({'event': 'dataverse_harvest_object', 'stage': stage,
+                              'job_id': metrics.job_id, 'object_id': harvest_object.id,
+                              'success': bool(result), 'elapsed': round(time.perf_counter() - started, 4)}))
+        return metrics.tick(stage)
+
+    def _save_metrics(self, harvest_job_id, metrics, stage):
+        '''
+        Log the metrics accumulated by the process and merge them into the
+        summary stored with the job, then start accumulating afresh
+        '''
+        metrics.log_summary(stage)
+        summary = metrics.summary()
+        metrics.reset()
+        try:
+            job_info = DataverseHarvestJob.get_for_update(harvest_job_id)
+            if job_info is None:
+                model.Session.rollback()
+                return
+            data = job_info.get_data()
+            data['metrics'] = merge_summaries(data.get('metrics', {}), summary)
+            job_info.set_data(data)
+            model.Session.commit()
+        except Exception as e:
+            model.Session.rollback()
+            log.warning(f'Could not save the metrics of job {harvest_job_id}: {e}')
+
     def _set_source_config(self, config_str):
         '''
         Loads the source configuration JSON object into a dict for
@@ -370,25 +1695,44 @@ class DataVerseHarvester(HarvesterBase, SingletonPlugin):
                 return extra.value
         return None
 
-    def _get_user_name(self):
+    def _set_object_extra(self, harvest_object, key, value):
         '''
-        Returns the name of the user that will perform the harvesting actions
-        (deleting, updating and creating datasets)
-        By default this will be the internal site admin user. This is the
-        recommended setting, but if necessary it can be overridden with the
-        `ckanext.spatial.harvest.user_name` config option, eg to support the
-        old hardcoded 'harvest' user:
-           ckanext.spatial.harvest.user_name = harvest
+        Helper function for setting the value of a harvest object extra,
+        creating it if needed
         '''
-        if self._user_name:
-            return self._user_name
+        for extra in harvest_object.extras:
+            if extra.key == key:
+                extra.value = value
+                return
+        harvest_object.extras.append(HOExtra(key=key, value=value))
 
-        self._site_user = p.toolkit.get_action('get_site_user')({'model': model, 'ignore_auth': True}, {})
+    def _get_content_hash(self, harvest_object):
+        '''
+        Return the canonical hash of the object content, as stored when the
+        object was gathered or fetched, computing it for older objects
+        '''
+        stored_hash = self._get_object_extra(harvest_object, 'content_hash')
+        if stored_hash:
+            return stored_hash
+        return content_hash(load_content(harvest_object.content))
 
-        config_user_name = config.get('ckanext.spatial.harvest.user_name')
-        if config_user_name:
-            self._user_name = config_user_name
-        else:
-            self._user_name = self._site_user['name']
+    def _encode_content(self, content):
+        '''
+        Return the stored form of an object content, trimmed to
+        `content_fields` and compressed if the source has `compress_content`,
+        and the hash of the trimmed content
+        '''
+        content = trim_content(content, self.content_fields)
+        compress = self.source_config.get('compress_content', False)
+        return encode_content(content, compress), content_hash(content)
 
-        return self._user_name
+    def _lock_guid(self, harvest_object):
+        '''
+        Take a transaction level advisory lock on the GUID of the object
+        within its source, so that concurrent import workers handling
+        objects of the same GUID run one after the other
+        '''
+        Session.execute(
+            'SELECT pg_advisory_xact_lock(hashtext(:key))',
+            {'key': f'{harvest_object.harvest_source_id}:{harvest_object.guid}'}
+        )
@@ -0,0 +1,92 @@
+import logging
+
+from sqlalchemy import text
+
+from ckan import model
+
+log = logging.getLogger(__name__)
+
+# Non-current revisions of each GUID kept by default
+DEFAULT_KEEP_REVISIONS = 1
+
+# Harvest objects deleted per transaction
+DEFAULT_COMPACT_BATCH_SIZE = 5000
+
+# Processed objects beyond the `keep` most recent non-current revisions of
+# their GUID; objects still waiting to be processed are never compacted
+STALE_OBJECTS_SQL = '''
+    CREATE TEMPORARY TABLE dataverse_stale_object AS
+    SELECT id FROM (
+        SELECT id, row_number() OVER (PARTITION BY guid ORDER BY gathered DESC, id) AS revision
+        FROM harvest_object
+        WHERE harvest_source_id = :source_id
+          AND NOT current
+          AND state IN ('COMPLETE', 'ERROR')
+    ) AS revisions
+    WHERE revision > :keep
+'''
+
+ORPHANED_EXTRAS_SQL = '''
+    DELETE FROM harvest_object_extra AS extra
+    WHERE extra.harvest_object_id IS NULL
+       OR NOT EXISTS (SELECT 1 FROM harvest_object WHERE harvest_object.id = extra.harvest_object_id)
+'''
+
+ORPHANED_ERRORS_SQL = '''
+    DELETE FROM harvest_object_error AS error
+    WHERE error.harvest_object_id IS NULL
+       OR NOT EXISTS (SELECT 1 FROM harvest_object WHERE harvest_object.id = error.harvest_object_id)
+'''
+
+
+def compact_history(source_id, keep=DEFAULT_KEEP_REVISIONS, batch_size=DEFAULT_COMPACT_BATCH_SIZE):
+    '''
+    Delete the old revisions of the harvest objects of a source: for every
+    GUID, the current object and its `keep` most recent non-current objects
+    are kept, older processed objects are deleted along with their extras
+    and errors, `batch_size` objects per transaction.
+
+    Return the number of deleted objects.
+    '''
+    # the list of stale objects is a temporary table, so the whole
+    # compaction runs on a single connection
+    connection = model.meta.engine.connect()
+    deleted = 0
+    try:
+        with connection.begin():
+            connection.execute(text(STALE_OBJECTS_SQL), source_id=source_id, keep=keep)
+            connection.execute('CREATE INDEX ON dataverse_stale_object (id)')
+
+        last_id = ''
+        while True:
+            ids = [object_id for (object_id,) in connection.execute(
+                text('SELECT id FROM dataverse_stale_object WHERE id > :last_id ORDER BY id LIMIT :limit'),
+                last_id=last_id, limit=batch_size)]
+            if not ids:
+                break
+            with connection.begin():
+                for statement in ('DELETE FROM harvest_object_extra WHERE harvest_object_id IN :ids',
+                                  'DELETE FROM harvest_object_error WHERE harvest_object_id IN :ids',
+                                  'DELETE FROM harvest_object WHERE id IN :ids'):
+                    connection.execute(text(statement), ids=tuple(ids))
+            deleted += len(ids)
+            last_id = ids[-1]
+            log.debug(f'Deleted {deleted} old harvest objects of source {source_id}')
+    finally:
+        connection.execute('DROP TABLE IF EXISTS dataverse_stale_object')
+        connection.close()
+
+    log.info(f'Deleted {deleted} old harvest objects of source {source_id}, keeping {keep} revisions per GUID')
+    return deleted
+
+
+def delete_orphans():
+    '''
+    Delete the harvest object extras and errors whose object does not exist
+    any more; return how many extras and errors were deleted
+    '''
+    extras = model.Session.execute(ORPHANED_EXTRAS_SQL).rowcount
+    errors = model.Session.execute(ORPHANED_ERRORS_SQL).rowcount
+    model.Session.commit()
+    log.info(f'Deleted {extras} orphaned harvest object extras and {errors} orphaned errors')
+    return extras, errors
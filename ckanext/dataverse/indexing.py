@@ -0,0 +1,139 @@
+import contextlib
+import functools
+import logging
+import threading
+
+from ckan import logic
+from ckan import model
+from ckan.common import config
+from ckan.lib.search.common import make_connection
+from ckan.lib.search.index import PackageSearchIndex
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INDEX_BATCH_SIZE = 100
+
+_local = threading.local()
+_notify_guard_installed = False
+_notify_guard_lock = threading.Lock()
+
+
+def _install_notify_guard():
+    '''
+    Make the CKAN synchronous search plugin skip the packages committed by
+    threads inside automatic_indexing_disabled; other threads keep
+    indexing as configured
+    '''
+    global _notify_guard_installed
+    with _notify_guard_lock:
+        if _notify_guard_installed:
+            return
+        from ckan.lib.search import SynchronousSearchPlugin
+        notify = SynchronousSearchPlugin.notify
+
+        @functools.wraps(notify)
+        def guarded_notify(self, entity, operation):
+            if getattr(_local, 'indexing_disabled', 0):
+                return
+            return notify(self, entity, operation)
+
+        SynchronousSearchPlugin.notify = guarded_notify
+        _notify_guard_installed = True
+
+
+@contextlib.contextmanager
+def automatic_indexing_disabled():
+    '''
+    Disable the synchronous Solr indexing CKAN performs on every package
+    commit, for the commits of the current thread in the block. The CKAN
+    configuration is left untouched, so concurrent threads are not affected.
+    '''
+    _install_notify_guard()
+    _local.indexing_disabled = getattr(_local, 'indexing_disabled', 0) + 1
+    try:
+        yield
+    finally:
+        _local.indexing_disabled -= 1
+
+
+class DeferredIndexer(object):
+    '''
+    Collect the ids of the packages touched by a harvest job and index them
+    in Solr in batches, with a single Solr commit per batch, instead of
+    indexing and committing each package as soon as it is saved
+    '''
+
+    def __init__(self, batch_size=DEFAULT_INDEX_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.job_id = None
+        self._package_ids = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._package_ids)
+
+    def add(self, job_id, package_id):
+        '''
+        Queue a package for indexing, flushing the queue when it belongs to
+        another job or when it reaches the batch size
+        '''
+        if self.job_id and job_id != self.job_id:
+            self.flush()
+        with self._lock:
+            self.job_id = job_id
+            if package_id not in self._package_ids:
+                self._package_ids.append(package_id)
+            full = len(self._package_ids) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        ''' Index all the queued packages and commit once; return how many were indexed '''
+        with self._lock:
+            package_ids, self._package_ids = self._package_ids, []
+        if not package_ids:
+            return 0
+
+        context = {'model': model, 'session': model.Session, 'ignore_auth': True,
+                   'validate': False, 'use_cache': False}
+        package_index = PackageSearchIndex()
+        indexed = 0
+        for package_id in package_ids:
+            try:
+                package_dict = logic.get_action('package_show')(context.copy(), {'id': package_id})
+            except logic.NotFound:
+                continue
+            package_index.update_dict(package_dict, defer_commit=True)
+            indexed += 1
+        package_index.commit()
+
+        log.info(f'Indexed {indexed} packages of job {self.job_id} in Solr')
+        return indexed
+
+
+def delete_from_index(package_ids, batch_size=DEFAULT_INDEX_BATCH_SIZE):
+    '''
+    Remove packages from the Solr index with one delete query per
+    `batch_size` packages and a single Solr commit
+    '''
+    if not package_ids:
+        return
+    connection = make_connection()
+    site_id = config.get('ckan.site_id')
+    for start in range(0, len(package_ids), batch_size):
+        ids = ' OR '.join(f'"{package_id}"' for package_id in package_ids[start:start + batch_size])
+        connection.delete(q=f'+site_id:"{site_id}" +id:({ids})', commit=False)
+    connection.commit()
+    log.info(f'Removed {len(package_ids)} packages from the search index')
+
+
+_indexer = None
+
+
+def get_indexer(batch_size=DEFAULT_INDEX_BATCH_SIZE):
+    ''' Return the deferred indexer of the current process '''
+    global _indexer
+    if _indexer is None:
+        _indexer = DeferredIndexer(batch_size)
+    _indexer.batch_size = batch_size
+    return _indexer
@@ -0,0 +1,210 @@
+import contextlib
+import json
+import logging
+import socket
+import threading
+import time
+
+from sqlalchemy import event
+
+from ckan import model
+from ckan.common import config
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+_registry = {}
+_registry_lock = threading.Lock()
+_db_listener_installed = False
+
+
+class HarvestMetrics(object):
+    '''
+    Timings and counters of one harvest job within the current process.
+
+    Timers aggregate the count, total and maximum duration of a named step
+    (e.g. `gather`, `import.package_action`); counters hold free-form totals
+    such as HTTP requests, bytes received or DB queries. Both are cleared by
+    `reset` once saved, unlike the `processed` object counts of each stage,
+    which pace the periodic saves.
+    '''
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.started = time.time()
+        self.timers = {}
+        self.counters = {}
+        self.processed = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def add_time(self, name, elapsed):
+        with self._lock:
+            timer = self.timers.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+            timer['count'] += 1
+            timer['total'] += elapsed
+            timer['max'] = max(timer['max'], elapsed)
+        get_exporter().timing(name, elapsed)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        get_exporter().incr(name, value)
+
+    def tick(self, stage):
+        ''' Count an object processed by a stage; return how many the stage processed so far '''
+        with self._lock:
+            self.processed[stage] = self.processed.get(stage, 0) + 1
+            return self.processed[stage]
+
+    def record_http(self, status_code, nbytes, elapsed):
+        self.incr('http.requests')
+        self.incr(f'http.status.{status_code}')
+        self.incr('http.bytes', nbytes)
+        self.add_time('http.request', elapsed)
+
+    def summary(self):
+        ''' Return the metrics as a JSON serializable dict, with objects per second per stage '''
+        with self._lock:
+            timers = {name: dict(timer) for name, timer in self.timers.items()}
+            counters = dict(self.counters)
+        _add_rates(timers, counters)
+        return {'job_id': self.job_id, 'timers': timers, 'counters': counters}
+
+    def reset(self):
+        with self._lock:
+            self.timers = {}
+            self.counters = {}
+
+    def log_summary(self, stage):
+        ''' Emit the metrics as a single structured log line '''
+        log.info(json.dumps(dict(self.summary(), event='dataverse_harvest_metrics', stage=stage)))
+
+
+def _add_rates(timers, counters):
+    for stage in ('gather', 'fetch', 'import'):
+        objects = counters.get(f'{stage}.objects')
+        total = timers.get(stage, {}).get('total')
+        if objects and total:
+            counters[f'{stage}.objects_per_second'] = round(objects / total, 2)
+
+
+def merge_summaries(first, second):
+    ''' Return the sum of two metric summaries, e.g. from several import workers '''
+    timers = {name: dict(timer) for name, timer in first.get('timers', {}).items()}
+    for name, timer in second.get('timers', {}).items():
+        merged = timers.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+        merged['count'] += timer['count']
+        merged['total'] += timer['total']
+        merged['max'] = max(merged['max'], timer['max'])
+    counters = dict(first.get('counters', {}))
+    for name, value in second.get('counters', {}).items():
+        if not name.endswith('_per_second'):
+            counters[name] = counters.get(name, 0) + value
+    _add_rates(timers, counters)
+    return {'job_id': second.get('job_id', first.get('job_id')), 'timers': timers, 'counters': counters}
+
+
+def get_metrics(job_id):
+    ''' Return the metrics of a job for the current process '''
+    _install_db_listener()
+    with _registry_lock:
+        if job_id not in _registry:
+            _registry[job_id] = HarvestMetrics(job_id)
+        return _registry[job_id]
+
+
+def discard_metrics(job_id):
+    ''' Remove the metrics of a job from the process registry and return them, if any '''
+    with _registry_lock:
+        return _registry.pop(job_id, None)
+
+
+def current():
+    ''' Return the metrics activated in the current thread, if any '''
+    return getattr(_local, 'metrics', None)
+
+
+@contextlib.contextmanager
+def activate(metrics):
+    '''
+    Make `metrics` the current metrics of the thread, so that HTTP requests
+    and DB queries performed in the block are accounted to it
+    '''
+    previous = current()
+    _local.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _local.metrics = previous
+
+
+@contextlib.contextmanager
+def timed(name):
+    ''' Time the block against the current metrics, if any '''
+    metrics = current()
+    if metrics is None:
+        yield
+    else:
+        with metrics.timed(name):
+            yield
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    metrics = current()
+    if metrics is not None:
+        metrics.incr('db.queries')
+
+
+def _install_db_listener():
+    global _db_listener_installed
+    if _db_listener_installed or model.meta.engine is None:
+        return
+    event.listen(model.meta.engine, 'before_cursor_execute', _count_query)
+    _db_listener_installed = True
+
+
+class StatsdExporter(object):
+    '''
+    Fire and forget StatsD client, enabled by `ckanext.dataverse.statsd_host`
+    '''
+
+    def __init__(self, host=None, port=8125, prefix='ckanext.dataverse'):
+        self.address = (host, int(port)) if host else None
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if host else None
+
+    def _send(self, line):
+        if not self._socket:
+            return
+        try:
+            self._socket.sendto(f'{self.prefix}.{line}'.encode('utf-8'), self.address)
+        except OSError as e:
+            log.debug(f'Could not send metric to StatsD: {e}')
+
+    def timing(self, name, elapsed):
+        self._send(f'{name}:{elapsed * 1000:.3f}|ms')
+
+    def incr(self, name, value=1):
+        self._send(f'{name}:{value}|c')
+
+
+_exporter = None
+
+
+def get_exporter():
+    global _exporter
+    if _exporter is None:
+        _exporter = StatsdExporter(
+            config.get('ckanext.dataverse.statsd_host'),
+            config.get('ckanext.dataverse.statsd_port', 8125),
+            config.get('ckanext.dataverse.statsd_prefix', 'ckanext.dataverse'),
+        )
+    return _exporter
@@ -0,0 +1,94 @@
+import datetime
+import json
+import logging
+
+from sqlalchemy import Column, Table, types, ForeignKey, Index
+
+from ckan.model.meta import metadata, mapper, Session
+
+from ckanext.harvest.model import HarvestDomainObject
+
+log = logging.getLogger(__name__)
+
+__all__ = [
+    'DataverseHarvestJob', 'dataverse_harvest_job_table',
+    'setup',
+]
+
+dataverse_harvest_job_table = None
+
+_initialized = False
+
+
+def setup():
+    '''
+    Define and create the Dataverse tables if needed; cheap to call once
+    the tables have been checked in the current process
+    '''
+    global _initialized
+    if _initialized:
+        return
+
+    if dataverse_harvest_job_table is None:
+        define_dataverse_tables()
+        log.debug('Dataverse harvest tables defined in memory')
+
+    if not dataverse_harvest_job_table.exists():
+        dataverse_harvest_job_table.create()
+        log.debug('Dataverse harvest tables created')
+
+    # Lookup of the current object of a GUID within a source, used by the
+    # gather and import stages
+    Session.execute(
+        'CREATE INDEX IF NOT EXISTS idx_dataverse_harvest_object_current '
+        'ON harvest_object (harvest_source_id, guid) WHERE current'
+    )
+    Session.commit()
+    _initialized = True
+
+
+class DataverseHarvestJob(HarvestDomainObject):
+    '''
+    Dataverse specific bookkeeping attached to a HarvestJob: the gather mode
+    used by the job and a free-form JSON document (`data`) for the
+    harvester state that has no room in the ckanext-harvest tables
+    '''
+
+    @classmethod
+    def get_or_create(cls, harvest_job):
+        obj = Session.query(cls).get(harvest_job.id)
+        if obj is None:
+            obj = cls(harvest_job_id=harvest_job.id,
+                      harvest_source_id=harvest_job.source_id)
+            Session.add(obj)
+        return obj
+
+    @classmethod
+    def get_for_update(cls, harvest_job_id):
+        ''' Return the row of a job locked until the end of the transaction, or None '''
+        return Session.query(cls).with_for_update().get(harvest_job_id)
+
+    def get_data(self):
+        return json.loads(self.data) if self.data else {}
+
+    def set_data(self, data):
+        self.data = json.dumps(data)
+
+
+def define_dataverse_tables():
+    global dataverse_harvest_job_table
+
+    dataverse_harvest_job_table = Table(
+        'dataverse_harvest_job',
+        metadata,
+        Column('harvest_job_id', types.UnicodeText, ForeignKey('harvest_job.id', ondelete='CASCADE'),
+               primary_key=True),
+        Column('harvest_source_id', types.UnicodeText, ForeignKey('harvest_source.id', ondelete='CASCADE'),
+               nullable=False),
+        Column('mode', types.UnicodeText, nullable=False, default=u'full'),
+        Column('created', types.DateTime, default=datetime.datetime.utcnow),
+        Column('data', types.UnicodeText),
+        Index('idx_dataverse_harvest_job_source_mode', 'harvest_source_id', 'mode'),
+    )
+
+    mapper(DataverseHarvestJob, dataverse_harvest_job_table)
@@ -0,0 +1,129 @@
+import logging
+import re
+import threading
+import uuid
+
+from sqlalchemy import and_
+
+from ckan import model
+from ckan.common import config
+from ckan.lib.munge import munge_title_to_name
+from ckanext.harvest.model import HarvestObject
+
+log = logging.getLogger(__name__)
+
+# Same limits as HarvesterBase._ensure_name_is_unique: numbers up to 999
+# are appended, or 5 random hex characters
+PACKAGE_NAME_MAX_LENGTH = 100
+MAX_NUMBER_APPENDED = 999
+APPEND_MAX_CHARS = 5
+
+
+class NameIndex(object):
+    '''
+    In-memory index of the package names of the site, loaded with a single
+    query, used to give harvested datasets unique names without probing the
+    package table for every record.
+
+    It also maps the packages of the current objects of a source to their
+    names, so that updated datasets keep their name. Names generated through
+    the index are added to it; names created by other processes after the
+    index was loaded are only detected by package_create (see
+    DataVerseHarvester._import_stage).
+    '''
+
+    def __init__(self, harvest_job_id, harvest_source_id):
+        self.harvest_job_id = harvest_job_id
+        self.harvest_source_id = harvest_source_id
+        self.names = set()
+        self.source_names = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+        query = model.Session.query(model.Package.name, HarvestObject.package_id). \
+            outerjoin(HarvestObject, and_(HarvestObject.package_id == model.Package.id,
+                                          HarvestObject.current == True,
+                                          HarvestObject.harvest_source_id == harvest_source_id))
+        for name, package_id in query:
+            self.names.add(name)
+            if package_id:
+                self.source_names[package_id] = name
+        log.debug(f'Loaded {len(self.names)} package names, {len(self.source_names)} of source {harvest_source_id}')
+
+    def get_name(self, package_id):
+        '''
+        Return the name of a package of the source, looking up packages
+        created since the index was loaded, or None
+        '''
+        if not package_id:
+            return None
+        name = self.source_names.get(package_id)
+        if name is None:
+            name = model.Session.query(model.Package.name).filter(model.Package.id == package_id).scalar()
+            if name:
+                self.add(name, package_id)
+        return name
+
+    def add(self, name, package_id=None):
+        with self._lock:
+            self.names.add(name)
+            if package_id:
+                self.source_names[package_id] = name
+
+    def new_name(self, title):
+        '''
+        Return a unique name for a dataset title and reserve it, appending a
+        number sequence or random hex characters to the ideal name the way
+        HarvesterBase._gen_new_name does, so that names are the same as
+        with other harvesters
+        '''
+        ideal_name = re.sub('-+', '-', munge_title_to_name(title))[:PACKAGE_NAME_MAX_LENGTH]
+        append_type = config.get('ckanext.harvest.default_dataset_name_append', 'number-sequence')
+        with self._lock:
+            if ideal_name not in self.names:
+                name = ideal_name
+            elif append_type == 'random-hex':
+                stem = ideal_name[:PACKAGE_NAME_MAX_LENGTH - APPEND_MAX_CHARS]
+                name = stem + uuid.uuid4().hex[:APPEND_MAX_CHARS]
+                while name in self.names:
+                    name = stem + uuid.uuid4().hex[:APPEND_MAX_CHARS]
+            else:
+                counter = self._counters.get(ideal_name, 1)
+                while counter <= MAX_NUMBER_APPENDED and self._numbered(ideal_name, counter) in self.names:
+                    counter += 1
+                if counter > MAX_NUMBER_APPENDED:
+                    raise ValueError(f'Could not find a unique name for {title}')
+                self._counters[ideal_name] = counter + 1
+                name = self._numbered(ideal_name, counter)
+            self.names.add(name)
+        return name
+
+    @staticmethod
+    def _numbered(ideal_name, counter):
+        return ideal_name[:PACKAGE_NAME_MAX_LENGTH - len(str(counter))] + str(counter)
+
+
+# Name indexes kept per process, one per job being imported
+MAX_INDEXES = 4
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_name_index(harvest_job_id, harvest_source_id):
+    '''
+    Return the name index of a job, loading it on the first call for the
+    job in the current process
+    '''
+    with _indexes_lock:
+        index = _indexes.get(harvest_job_id)
+        if index is None:
+            index = _indexes[harvest_job_id] = NameIndex(harvest_job_id, harvest_source_id)
+            while len(_indexes) > MAX_INDEXES:
+                _indexes.pop(next(iter(_indexes)))
+        return index
+
+
+def discard_name_index(harvest_job_id):
+    with _indexes_lock:
+        _indexes.pop(harvest_job_id, None)
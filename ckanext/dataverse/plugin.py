@@ -0,0 +1,17 @@
+import ckan.plugins as p
+
+from ckanext.dataverse import cli
+
+
+class DataversePlugin(p.SingletonPlugin):
+    '''
+    Registers the `ckan dataverse` commands; the harvesters themselves are
+    registered by the plugins subclassing DataVerseHarvester
+    '''
+
+    p.implements(p.IClick)
+
+    # IClick
+
+    def get_commands(self):
+        return cli.get_commands()
@@ -0,0 +1,166 @@
+import contextlib
+import cProfile
+import io
+import logging
+import os
+import pstats
+import tempfile
+import threading
+import time
+
+from ckan.common import config
+from ckan.plugins import toolkit
+
+log = logging.getLogger(__name__)
+
+# Functions listed in the report, by cumulative and by own time
+DEFAULT_TOP_FUNCTIONS = 30
+
+# Profiled objects between two writes of the report of a job
+PROFILE_WRITE_INTERVAL = 100
+
+# Import sub-steps reported from the profile, as (label, end of the file
+# name or None for any file, function name); the cumulative time of every
+# matching function is summed
+SUBSTEPS = (
+    ('import_stage', None, '_import_stage'),
+    ('create_package_dict', None, 'create_package_dict'),
+    ('attach_resources', None, 'attach_resources'),
+    ('package_create', 'ckan/logic/action/create.py', 'package_create'),
+    ('package_update', 'ckan/logic/action/update.py', 'package_update'),
+    ('validation', 'ckan/lib/navl/dictization_functions.py', 'validate'),
+    ('solr', 'pysolr.py', '_send_request'),
+    ('db', 'sqlalchemy/engine/base.py', '_execute_context'),
+)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class ImportProfile(object):
+    '''
+    cProfile data of the objects of one harvest job imported by the current
+    process, aggregated over all of them.
+
+    cProfile only sees the thread that enables it, so every import thread
+    gets its own profiler; they are merged when the report is written.
+    '''
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.objects = 0
+        self.elapsed = 0.0
+        self._profilers = {}
+        self._lock = threading.Lock()
+
+    def _get_profiler(self):
+        ''' Return the profiler of the current thread and the lock held while it runs '''
+        thread_id = threading.get_ident()
+        with self._lock:
+            if thread_id not in self._profilers:
+                self._profilers[thread_id] = (cProfile.Profile(), threading.RLock())
+            return self._profilers[thread_id]
+
+    @contextlib.contextmanager
+    def profiled(self):
+        ''' Profile the block as the import of one object '''
+        profiler, lock = self._get_profiler()
+        with lock:
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # another profiler is active in the thread
+                log.debug(f'Could not profile an import of job {self.job_id}: {e}')
+                yield
+                return
+            started = time.perf_counter()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                with self._lock:
+                    self.objects += 1
+                    self.elapsed += time.perf_counter() - started
+
+    def stats(self):
+        ''' Return the pstats.Stats of all the threads, waiting for their current import to end '''
+        with self._lock:
+            profilers = list(self._profilers.values())
+        stats = pstats.Stats()
+        for profiler, lock in profilers:
+            with lock:
+                stats.add(profiler)
+        return stats
+
+    def write_report(self, directory, top=DEFAULT_TOP_FUNCTIONS):
+        '''
+        Write the report of the job in `directory`: a text summary with the
+        cumulative time of each import sub-step and the `top` functions by
+        cumulative and by own time, and the raw profile in pstats format
+        (for snakeviz, pstats, ...). Files are named after the job and the
+        process id. Return the path of the summary.
+        '''
+        stats = self.stats()
+        os.makedirs(directory, exist_ok=True)
+        base_path = os.path.join(directory, f'dataverse-import-{self.job_id}-{os.getpid()}')
+        stats.dump_stats(base_path + '.prof')
+
+        report = io.StringIO()
+        report.write(f'Import profile of job {self.job_id} (process {os.getpid()})\n')
+        report.write(f'{self.objects} objects profiled in {self.elapsed:.3f}s\n\n')
+        report.write('Cumulative time per sub-step\n\n')
+        for label, calls, cumulative in substep_times(stats):
+            per_object = cumulative / self.objects if self.objects else 0
+            report.write(f'{label:<20} {calls:>10} calls {cumulative:>12.3f}s {per_object:>10.4f}s/object\n')
+        report.write('\n')
+        stats.stream = report
+        stats.sort_stats('cumulative').print_stats(top)
+        stats.sort_stats('tottime').print_stats(top)
+
+        path = base_path + '.txt'
+        with open(path + '.tmp', 'w') as f:
+            f.write(report.getvalue())
+        os.replace(path + '.tmp', path)
+        return path
+
+
+def substep_times(stats):
+    ''' Return (label, number of calls, cumulative time) tuples for the SUBSTEPS '''
+    times = []
+    for label, file_suffix, function_name in SUBSTEPS:
+        calls = cumulative = 0
+        for (filename, _line, name), (_primitive, total_calls, _own, function_cumulative, _callers) \
+                in stats.stats.items():
+            if name != function_name:
+                continue
+            if file_suffix and not filename.replace(os.sep, '/').endswith(file_suffix):
+                continue
+            calls += total_calls
+            cumulative += function_cumulative
+        times.append((label, calls, cumulative))
+    return times
+
+
+def profiling_enabled(source_config):
+    ''' Tell whether imports are profiled, site wide or for the source '''
+    return toolkit.asbool(config.get('ckanext.dataverse.profile_import', False)) \
+        or bool(source_config.get('profile_import', False))
+
+
+def get_profile_dir():
+    return config.get('ckanext.dataverse.profile_dir') \
+        or os.path.join(tempfile.gettempdir(), 'ckanext-dataverse-profiles')
+
+
+def get_profile(job_id, create=True):
+    ''' Return the import profile of a job for the current process, or None if there is none and not `create` '''
+    with _registry_lock:
+        if job_id not in _registry and create:
+            _registry[job_id] = ImportProfile(job_id)
+        return _registry.get(job_id)
+
+
+def discard_profile(job_id):
+    ''' Remove the profile of a job from the process registry and return it, if any '''
+    with _registry_lock:
+        return _registry.pop(job_id, None)
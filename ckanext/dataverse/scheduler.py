@@ -0,0 +1,126 @@
+import collections
+import datetime
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from ckan import model
+from ckanext.harvest.model import HarvestJob
+from ckanext.harvest.queue import get_fetch_publisher
+
+log = logging.getLogger(__name__)
+
+# Gathers run at once against the same Dataverse installation
+DEFAULT_GATHERS_PER_HOST = 1
+
+
+class MultiSourceGather(object):
+    '''
+    Gather the jobs of several Dataverse sources in the current process and
+    send their objects to the fetch queue, as the gather consumer does.
+
+    Jobs are grouped by the host of their source. Each host gets its own
+    worker threads, at most `per_host` gathers at once, and its sources are
+    gathered in turn, so that the total time is bounded by the slowest host
+    rather than by the sum of all the sources. When `workers` is lower than
+    the number of hosts, free workers take the next job of each host in
+    round robin, so that no host waits for all the sources of another.
+
+    The HTTP clients of sources on the same host share its connection pool,
+    connection slots and rate limiter (see client.HostPool); database work
+    goes through the session of each worker thread.
+    '''
+
+    def __init__(self, jobs, per_host=DEFAULT_GATHERS_PER_HOST, workers=None):
+        '''
+        `jobs` is a list of (harvester, harvest job) tuples
+        '''
+        self.per_host = per_host
+        self._pending = collections.OrderedDict()
+        for harvester, harvest_job in jobs:
+            host = urlsplit(harvest_job.source.url).netloc.lower()
+            self._pending.setdefault(host, collections.deque()).append((harvester, harvest_job.id))
+        self._hosts = list(self._pending)
+        self.workers = workers or len(self._hosts) * per_host
+        self._running = collections.Counter()
+        self._turn = 0
+        self._condition = threading.Condition()
+        self.results = {}
+
+    def run(self):
+        '''
+        Gather all the jobs; return a dict mapping the id of each job to the
+        number of objects sent to the fetch queue, or None if its gather
+        failed
+        '''
+        if not self._hosts:
+            return {}
+        log.info(f'Gathering {sum(len(jobs) for jobs in self._pending.values())} jobs on '
+                 f'{len(self._hosts)} hosts with {self.workers} workers')
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='dataverse-gather') as executor:
+            for future in [executor.submit(self._work) for _ in range(self.workers)]:
+                future.result()
+        return self.results
+
+    def _next_job(self):
+        '''
+        Return the next (host, harvester, job id) to gather, taking hosts in
+        turn and skipping those already running `per_host` gathers; wait
+        while every host with pending jobs is busy. Return None when there
+        is nothing left to gather.
+        '''
+        with self._condition:
+            while True:
+                if not any(self._pending.values()):
+                    return None
+                for _ in range(len(self._hosts)):
+                    host = self._hosts[self._turn]
+                    self._turn = (self._turn + 1) % len(self._hosts)
+                    if self._pending[host] and self._running[host] < self.per_host:
+                        self._running[host] += 1
+                        return (host,) + self._pending[host].popleft()
+                self._condition.wait()
+
+    def _work(self):
+        try:
+            while True:
+                job = self._next_job()
+                if job is None:
+                    return
+                host, harvester, harvest_job_id = job
+                try:
+                    self.results[harvest_job_id] = self._gather(harvester, harvest_job_id)
+                finally:
+                    with self._condition:
+                        self._running[host] -= 1
+                        self._condition.notify_all()
+        finally:
+            model.Session.remove()
+
+    def _gather(self, harvester, harvest_job_id):
+        job = HarvestJob.get(harvest_job_id)
+        job.status = 'Running'
+        job.gather_started = datetime.datetime.utcnow()
+        job.save()
+
+        try:
+            ids = harvester.gather_stage(job)
+        except Exception as e:
+            log.exception(e)
+            model.Session.rollback()
+            harvester._save_gather_error(f'Error gathering job {harvest_job_id}: {e}', job)
+            ids = None
+
+        if ids:
+            publisher = get_fetch_publisher()
+            try:
+                for object_id in ids:
+                    publisher.send({'harvest_object_id': object_id})
+            finally:
+                publisher.close()
+
+        job.gather_finished = datetime.datetime.utcnow()
+        job.save()
+        log.info(f'Job {harvest_job_id}: {len(ids) if ids is not None else "gather failed, no"} objects queued')
+        return len(ids) if ids is not None else None
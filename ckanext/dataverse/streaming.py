@@ -0,0 +1,143 @@
+import codecs
+import json
+
+# Bytes read from the response body at a time
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = ' \t\n\r'
+
+
+class SearchResultStream(object):
+    '''
+    Incremental parser of a Search API answer read from an iterable of
+    byte chunks.
+
+    Iterating the stream decodes and yields the entries of `data.items` one
+    at a time while the body is being read, so that neither the raw body nor
+    the whole parsed tree are ever held in memory. Once the items are
+    exhausted, `data` holds the other members of the `data` object
+    (total_count, start, ...) with an empty `items` list.
+
+    Documents without `data.items` (e.g. error answers) are parsed whole and
+    their items, if any, are yielded from the parsed document.
+    '''
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json_decoder = json.JSONDecoder()
+        self._eof = False
+        self.data = None
+
+    def _read(self):
+        ''' Return the next decoded piece of the body, or None at its end '''
+        while not self._eof:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._eof = True
+                return self._text_decoder.decode(b'', final=True) or None
+            text = self._text_decoder.decode(chunk)
+            if text:
+                return text
+        return None
+
+    def _read_prefix(self):
+        '''
+        Read the body up to the opening bracket of `data.items`; return the
+        text read so far and the remaining text after the bracket, or None
+        if the body has no such member
+        '''
+        prefix = []
+        path = []
+        in_string = escaped = False
+        string = []
+        last_string = key = None
+        while True:
+            text = self._read()
+            if text is None:
+                return ''.join(prefix), None
+            for position, char in enumerate(text):
+                if in_string:
+                    if escaped:
+                        escaped = False
+                    elif char == '\\':
+                        escaped = True
+                    elif char == '"':
+                        in_string = False
+                        last_string = ''.join(string)
+                        string = []
+                        continue
+                    string.append(char)
+                elif char == '"':
+                    in_string = True
+                elif char == ':':
+                    key = last_string
+                elif char in '{[':
+                    if char == '[' and key == 'items' and path == [None, 'data']:
+                        prefix.append(text[:position + 1])
+                        return ''.join(prefix), text[position + 1:]
+                    path.append(key)
+                    key = None
+                elif char in '}]':
+                    path.pop()
+                elif char == ',':
+                    key = None
+            prefix.append(text)
+
+    def __iter__(self):
+        prefix, buffer = self._read_prefix()
+        if buffer is None:
+            document = json.loads(prefix)
+            data = document.get('data', document)
+            items = data.pop('items', [])
+            self.data = dict(data, items=[])
+            yield from items
+            return
+
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in WHITESPACE + ',':
+                position += 1
+            if position == len(buffer):
+                text = self._read()
+                if text is None:
+                    raise ValueError('Search API answer ended inside data.items')
+                buffer = buffer[position:] + text
+                position = 0
+                continue
+            if buffer[position] == ']':
+                break
+            try:
+                item, position = self._json_decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the item spans the next chunks: at least double the buffer
+                # before trying again, so that large items are not decoded
+                # over and over
+                buffer = buffer[position:]
+                position = 0
+                pieces = [buffer]
+                size = len(buffer)
+                while size < 2 * len(buffer):
+                    text = self._read()
+                    if text is None:
+                        break
+                    pieces.append(text)
+                    size += len(text)
+                if len(pieces) == 1:
+                    raise ValueError('Search API answer ended inside data.items')
+                buffer = ''.join(pieces)
+                continue
+            yield item
+            if position > DEFAULT_CHUNK_SIZE:
+                buffer = buffer[position:]
+                position = 0
+
+        suffix = [buffer[position:]]
+        while True:
+            text = self._read()
+            if text is None:
+                break
+            suffix.append(text)
+        document = json.loads(prefix + ''.join(suffix))
+        self.data = document['data']
+
@@ -0,0 +1,251 @@
+'''
+Local stand-in for a Dataverse installation, serving a synthetic catalogue
+through the Search API and the native datasets API, so that the harvester
+can be exercised and benchmarked without network access.
+'''
+import contextlib
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PID_PREFIX = 'doi:10.5072/FK2/'
+ROOT_ALIAS = 'root'
+ROOT_ID = 1
+
+
+class FakeCatalogue(object):
+    '''
+    Synthetic catalogue of `size` datasets, generated on the fly from their
+    position so that large catalogues cost no memory.
+
+    With `subdataverses`, dataset n belongs to the sub-dataverse
+    `sub{n % subdataverses}` of the root dataverse; otherwise all the
+    datasets belong to the root dataverse.
+
+    Every dataset was last modified at `modified`, except those whose
+    position is in `updates`, which maps positions to their own dates.
+    '''
+
+    def __init__(self, size, files_per_dataset=3, modified='2024-01-01T00:00:00Z', subdataverses=0):
+        self.size = size
+        self.files_per_dataset = files_per_dataset
+        self.modified = modified
+        self.subdataverses = subdataverses
+        self.updates = {}
+
+    def modified_at(self, n):
+        return self.updates.get(n, self.modified)
+
+    def pid(self, n):
+        return f'{PID_PREFIX}{n:08d}'
+
+    def position(self, pid):
+        if not pid.startswith(PID_PREFIX):
+            return None
+        try:
+            n = int(pid[len(PID_PREFIX):])
+        except ValueError:
+            return None
+        return n if 0 <= n < self.size else None
+
+    def search_item(self, n):
+        return {
+            'name': f'Dataset {n}',
+            'type': 'dataset',
+            'url': f'https://doi.org/10.5072/FK2/{n:08d}',
+            'global_id': self.pid(n),
+            'description': f'Synthetic dataset number {n} served by the fake Dataverse',
+            'published_at': self.modified,
+            'updatedAt': self.modified_at(n),
+            'subjects': ['Earth and Environmental Sciences'],
+            'authors': [f'Author {n % 97}'],
+        }
+
+    def dataset(self, n):
+        return {
+            'id': n,
+            'identifier': f'FK2/{n:08d}',
+            'persistentUrl': f'https://doi.org/10.5072/FK2/{n:08d}',
+            'protocol': 'doi',
+            'authority': '10.5072',
+            'publisher': 'Fake Dataverse',
+            'latestVersion': {
+                'versionState': 'RELEASED',
+                'lastUpdateTime': self.modified_at(n),
+                'license': {'name': 'CC0 1.0', 'uri': 'http://creativecommons.org/publicdomain/zero/1.0'},
+                'metadataBlocks': {
+                    'citation': {
+                        'fields': [
+                            {'typeName': 'title', 'value': f'Dataset {n}'},
+                            {'typeName': 'dsDescription',
+                             'value': [{'dsDescriptionValue': {'value': f'Synthetic dataset number {n}'}}]},
+                        ],
+                    },
+                },
+                'files': [
+                    {'label': f'file-{n}-{f}.csv',
+                     'dataFile': {'id': n * 100 + f, 'contentType': 'text/csv', 'filesize': 1024 * (f + 1)}}
+                    for f in range(self.files_per_dataset)
+                ],
+            },
+        }
+
+    def dataverse(self, identifier):
+        ''' Return the dataverse with the given id or alias, or None '''
+        if identifier in (':root', ROOT_ALIAS, str(ROOT_ID)):
+            return {'id': ROOT_ID, 'alias': ROOT_ALIAS, 'name': 'Root'}
+        for n in range(self.subdataverses):
+            if identifier in (f'sub{n}', str(100 + n)):
+                return {'id': 100 + n, 'alias': f'sub{n}', 'name': f'Sub-dataverse {n}'}
+        return None
+
+    def contents(self, dataverse):
+        if dataverse['id'] != ROOT_ID:
+            return []
+        return [{'type': 'dataverse', 'id': 100 + n, 'title': f'Sub-dataverse {n}'}
+                for n in range(self.subdataverses)]
+
+    def positions(self, subtree=None, owner=None):
+        '''
+        Return the positions of the datasets within a subtree and/or owned
+        directly by a dataverse (sub-dataverses have no children)
+        '''
+        if owner is not None:
+            if owner == ROOT_ALIAS:
+                owned = range(0) if self.subdataverses else range(self.size)
+            else:
+                owned = self.positions(subtree=owner)
+            return owned if subtree in (None, ROOT_ALIAS, owner) else range(0)
+        if subtree and subtree != ROOT_ALIAS:
+            return range(int(subtree[len('sub'):]), self.size, self.subdataverses)
+        return range(self.size)
+
+
+class FakeDataverseHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.count_request()
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and server.random.random() < server.error_rate:
+            return self._send_json(503, {'status': 'ERROR', 'message': 'Service temporarily unavailable'})
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        params = {key: values[0] for key, values in query.items()}
+        path = url.path.rstrip('/')
+        if path == '/api/search':
+            if server.search_limit is not None and int(params.get('start', 0)) >= server.search_limit:
+                return self._send_json(503, {'status': 'ERROR', 'message': 'Service temporarily unavailable'})
+            return self._search(params, query.get('fq', []))
+        if path == '/api/datasets/:persistentId':
+            return self._dataset(params)
+        if path.startswith('/api/dataverses/'):
+            return self._dataverse(path[len('/api/dataverses/'):])
+        self._send_json(404, {'status': 'ERROR', 'message': f'{url.path} not found'})
+
+    def _search(self, params, filter_queries):
+        catalogue = self.server.catalogue
+        start = int(params.get('start', 0))
+        per_page = min(int(params.get('per_page', 10)), 1000)
+        owner = since = None
+        for filter_query in filter_queries:
+            if filter_query.startswith('identifierOfDataverse:'):
+                owner = filter_query[len('identifierOfDataverse:'):]
+            elif filter_query.startswith('dateSort:['):
+                # dateSort:[<date> TO *]; ISO dates in UTC compare as strings
+                since = filter_query[len('dateSort:['):].split(' ')[0]
+        positions = catalogue.positions(params.get('subtree'), owner)
+        if since:
+            positions = [n for n in positions if catalogue.modified_at(n) >= since]
+        items = [catalogue.search_item(n) for n in positions[start:start + per_page]]
+        self._send_json(200, {'status': 'OK', 'data': {
+            'q': params.get('q', '*'),
+            'total_count': len(positions),
+            'start': start,
+            'spelling_alternatives': {},
+            'items': items,
+            'count_in_response': len(items),
+        }})
+
+    def _dataset(self, params):
+        n = self.server.catalogue.position(params.get('persistentId', ''))
+        if n is None:
+            return self._send_json(404, {'status': 'ERROR', 'message': 'Dataset not found'})
+        body = json.dumps({'status': 'OK', 'data': self.server.catalogue.dataset(n)}).encode('utf-8')
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self._send_body(200, body, {'ETag': etag})
+
+    def _dataverse(self, path):
+        identifier, _, action = path.partition('/')
+        dataverse = self.server.catalogue.dataverse(identifier)
+        if dataverse is None:
+            return self._send_json(404, {'status': 'ERROR', 'message': f'Dataverse {identifier} not found'})
+        if action == 'contents':
+            return self._send_json(200, {'status': 'OK', 'data': self.server.catalogue.contents(dataverse)})
+        self._send_json(200, {'status': 'OK', 'data': dataverse})
+
+    def _send_json(self, status, content):
+        self._send_body(status, json.dumps(content).encode('utf-8'))
+
+    def _send_body(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeDataverseServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, catalogue, latency=0, error_rate=0, seed=0):
+        super().__init__(('127.0.0.1', 0), FakeDataverseHandler)
+        self.catalogue = catalogue
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        # search offset from which listings fail, to interrupt a gather
+        self.search_limit = None
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+
+@contextlib.contextmanager
+def fake_dataverse(size=1000, latency=0, error_rate=0, **kwargs):
+    '''
+    Run a fake Dataverse serving `size` datasets in a background thread and
+    yield the server; `latency` is added to every answer (in seconds) and
+    `error_rate` is the share of requests answered with a 503
+    '''
+    server = FakeDataverseServer(FakeCatalogue(size, **kwargs), latency, error_rate)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
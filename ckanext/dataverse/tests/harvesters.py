@@ -0,0 +1,85 @@
+import datetime
+import json
+
+from ckanext.harvest.model import HarvestObject
+
+from ckanext.dataverse.harvesters.dataverse_harvester import DataVerseHarvester
+
+
+class DataverseTestHarvester(DataVerseHarvester):
+    '''
+    Minimal concrete harvester used to exercise the DataVerseHarvester stages
+    '''
+
+    def harvester_name(self):
+        return 'dataverse-test'
+
+    def info(self):
+        return {
+            'name': 'dataverse-test',
+            'title': 'Dataverse test harvester',
+            'description': 'Harvester used by the ckanext-dataverse tests',
+        }
+
+    def create_package_dict(self, guid, content):
+        doc = json.loads(content)
+        package_dict = {
+            'title': doc.get('name') or guid,
+            'notes': doc.get('description'),
+            'tags': [{'name': subject} for subject in doc.get('subjects') or []],
+        }
+        return package_dict, doc
+
+    def attach_resources(self, metadata, package_dict):
+        package_dict['resources'] = []
+
+
+def synthetic_items(count, prefix='doi:10.5072/FK2/', offset=0):
+    ''' Return `count` Search API-like documents with predictable GUIDs '''
+    return [
+        {
+            'name': f'Dataset {n}',
+            'description': f'Synthetic dataset number {n}',
+            'subjects': ['Earth and Environmental Sciences'],
+            'guid': f'{prefix}{n:08d}',
+        }
+        for n in range(offset, offset + count)
+    ]
+
+
+def run_job(harvester, harvest_job):
+    '''
+    Run the gather, fetch and import stages of a job in the current process,
+    updating the harvest objects the way the ckanext-harvest queue consumers
+    do. Return the ids of the gathered objects.
+    '''
+    harvest_job.gather_started = datetime.datetime.utcnow()
+    harvest_job.status = 'Running'
+    harvest_job.save()
+    ids = harvester.gather_stage(harvest_job) or []
+    harvest_job.gather_finished = datetime.datetime.utcnow()
+    harvest_job.save()
+
+    for object_id in ids:
+        obj = HarvestObject.get(object_id)
+        obj.state = 'FETCH'
+        obj.fetch_started = datetime.datetime.utcnow()
+        obj.save()
+        if not harvester.fetch_stage(obj):
+            obj.state = 'ERROR'
+            obj.save()
+            continue
+        obj.fetch_finished = datetime.datetime.utcnow()
+        obj.state = 'IMPORT'
+        obj.import_started = datetime.datetime.utcnow()
+        obj.save()
+        success = harvester.import_stage(obj)
+        obj = HarvestObject.get(object_id)
+        obj.state = 'COMPLETE' if success else 'ERROR'
+        obj.import_finished = datetime.datetime.utcnow()
+        obj.save()
+
+    harvest_job.status = 'Finished'
+    harvest_job.finished = datetime.datetime.utcnow()
+    harvest_job.save()
+    return ids
@@ -0,0 +1,292 @@
+'''
+Performance benchmarks for the Dataverse harvester.
+
+They need a CKAN test database and take a while, so they only run when
+the DATAVERSE_BENCHMARK environment variable is set, e.g.:
+
+    DATAVERSE_BENCHMARK=1 pytest --ckan-ini=test.ini ckanext/dataverse/tests/test_benchmarks.py -s
+'''
+import json
+import logging
+import os
+import resource
+import time
+import tracemalloc
+
+import pytest
+
+from ckan import model
+from ckan.model.types import make_uuid
+from ckanext.harvest.model import HarvestObject
+
+from ckanext.dataverse.content import encode_content
+from ckanext.dataverse.harvesters.dataverse_harvester import UNSHARDED_CURSOR, DataVerseHarvester
+from ckanext.dataverse.history import compact_history
+from ckanext.dataverse.model import DataverseHarvestJob
+from ckanext.dataverse.streaming import DEFAULT_CHUNK_SIZE, SearchResultStream
+from ckanext.dataverse.tests import factories
+from ckanext.dataverse.tests.fake_dataverse import FakeCatalogue, fake_dataverse
+from ckanext.dataverse.tests.harvesters import DataverseTestHarvester, run_job, synthetic_items
+from ckanext.dataverse.tests.test_history import add_history
+
+log = logging.getLogger(__name__)
+
+BENCHMARK_SIZE = int(os.environ.get('DATAVERSE_BENCHMARK_SIZE', 100000))
+
+# Full gather -> fetch -> import runs against the fake Dataverse server
+RUN_SIZE = int(os.environ.get('DATAVERSE_BENCHMARK_RUN_SIZE', 1000))
+RUN_LATENCY = float(os.environ.get('DATAVERSE_BENCHMARK_LATENCY', 0.01))
+RUN_ERROR_RATE = float(os.environ.get('DATAVERSE_BENCHMARK_ERROR_RATE', 0.01))
+
+# Revisions per GUID of the history compaction benchmark
+HISTORY_REVISIONS = int(os.environ.get('DATAVERSE_BENCHMARK_HISTORY_REVISIONS', 10))
+
+# Search API answer parsed by the streaming benchmark
+SEARCH_PAGE_SIZE = int(os.environ.get('DATAVERSE_BENCHMARK_SEARCH_PAGE_SIZE', 1000))
+
+pytestmark = pytest.mark.skipif(not os.environ.get('DATAVERSE_BENCHMARK'),
+                                reason='set DATAVERSE_BENCHMARK=1 to run the benchmarks')
+
+SOURCE_DICT = {
+    "url": "http://dataverse.benchmark.test",
+    "name": "benchmark-dataverse-harvester",
+    "title": "Benchmark Dataverse",
+    "notes": "Benchmark Dataverse",
+    "source_type": "test-for-action",
+    "frequency": "MANUAL",
+    "config": json.dumps({"id_field_name": "global_id", "page_size": 1000})
+}
+
+
+def _prepopulate(source, job, items):
+    ''' Insert a current HarvestObject for every item, in a single round-trip '''
+    model.Session.bulk_insert_mappings(HarvestObject, [
+        {'id': make_uuid(), 'guid': item['guid'], 'current': True, 'content': json.dumps(item),
+         'harvest_source_id': source.id, 'harvest_job_id': job.id}
+        for item in items
+    ])
+    model.Session.commit()
+
+
+def _paginate(items, page_size):
+    ''' Return a stand-in for DataVerseHarvester._iter_pages listing `items` '''
+    def _iter_pages(url, since=None, offsets=None):
+        for start in range((offsets or {}).get(UNSHARDED_CURSOR, 0), len(items), page_size):
+            yield UNSHARDED_CURSOR, items[start:start + page_size]
+    return _iter_pages
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'harvest_setup', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+class TestGatherBenchmark:
+
+    def test_gather_large_catalogue(self):
+        source = factories.HarvestSourceObj(**SOURCE_DICT.copy())
+        previous_job = factories.HarvestJobObj(source=source)
+
+        # half of the remote catalogue is already harvested, and a tenth of
+        # the local objects disappeared upstream
+        remote = synthetic_items(BENCHMARK_SIZE)
+        vanished = synthetic_items(BENCHMARK_SIZE // 10, prefix='doi:10.5072/GONE/')
+        _prepopulate(source, previous_job, remote[:BENCHMARK_SIZE // 2] + vanished)
+
+        job = factories.HarvestJobObj(source=source)
+        harvester = DataverseTestHarvester()
+        harvester._iter_pages = _paginate(remote, 1000)
+
+        started = time.perf_counter()
+        ids = harvester.gather_stage(job)
+        elapsed = time.perf_counter() - started
+
+        log.info(f'Gathered {len(ids)} objects in {elapsed:.1f}s ({len(ids) / elapsed:.0f} objects/s)')
+        print(f'\ngather_stage: {len(ids)} objects in {elapsed:.1f}s ({len(ids) / elapsed:.0f} objects/s)')
+
+        assert len(ids) == len(remote) + len(vanished)
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _report(name, records, elapsed, metrics=None):
+    counters = (metrics or {}).get('counters', {})
+    line = (f'{name}: {records} records in {elapsed:.1f}s ({records / elapsed:.1f} records/s), '
+            f'peak RSS {_peak_rss_mb():.0f} MB, {counters.get("db.queries", "n/a")} DB queries, '
+            f'{counters.get("http.requests", "n/a")} HTTP requests')
+    log.info(line)
+    print(f'\n{line}')
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index', 'harvest_setup', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+class TestFullRunBenchmark:
+
+    @pytest.mark.parametrize('fetch_workers', [0, 8])
+    def test_full_run(self, fetch_workers):
+        with fake_dataverse(size=RUN_SIZE, latency=RUN_LATENCY, error_rate=RUN_ERROR_RATE) as server:
+            source = factories.HarvestSourceObj(**dict(
+                SOURCE_DICT,
+                url=server.url,
+                config=json.dumps({'id_field_name': 'global_id', 'page_size': 500,
+                                   'fetch_workers': fetch_workers, 'backoff_factor': 0.01}),
+            ))
+            job = factories.HarvestJobObj(source=source)
+            harvester = DataverseTestHarvester()
+
+            started = time.perf_counter()
+            ids = run_job(harvester, job)
+            elapsed = time.perf_counter() - started
+
+        job_info = model.Session.query(DataverseHarvestJob).get(job.id)
+        _report(f'full run (fetch_workers={fetch_workers})', len(ids), elapsed,
+                job_info.get_data().get('metrics'))
+
+        assert len(ids) == RUN_SIZE
+        assert model.Session.query(HarvestObject).filter_by(current=True).count() == RUN_SIZE
+
+
+def _search_answer(count, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Yield a Search API answer with `count` rich items as chunks of bytes,
+    generated lazily like a response body read from the network
+    '''
+    catalogue = FakeCatalogue(count)
+
+    def _pieces():
+        yield f'{{"status":"OK","data":{{"q":"*","total_count":{count},"start":0,"items":['
+        for n in range(count):
+            item = dict(catalogue.search_item(n),
+                        description=catalogue.search_item(n)['description'] * 20,
+                        keywords=[f'keyword {k}' for k in range(50)],
+                        contacts=[{'name': f'Contact {k}', 'affiliation': 'Fake University'} for k in range(10)])
+            yield (',' if n else '') + json.dumps(item)
+        yield f'],"count_in_response":{count}}}}}'
+
+    buffer = b''
+    for piece in _pieces():
+        buffer += piece.encode('utf-8')
+        while len(buffer) >= chunk_size:
+            yield buffer[:chunk_size]
+            buffer = buffer[chunk_size:]
+    yield buffer
+
+
+def _measure(parse):
+    ''' Return the result of `parse` and the peak of memory allocated while running it, in MB '''
+    tracemalloc.start()
+    try:
+        result = parse()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, peak / 1024 / 1024
+
+
+class TestSearchParsingBenchmark:
+
+    def test_streaming_parse_peak_memory(self):
+        def _parse_whole():
+            # what requests' response.json() does: body bytes, text and tree
+            data = json.loads(b''.join(_search_answer(SEARCH_PAGE_SIZE)).decode('utf-8'))['data']
+            return [DataVerseHarvester._get_search_doc(item, 'global_id') for item in data['items']]
+
+        def _parse_streamed():
+            stream = SearchResultStream(_search_answer(SEARCH_PAGE_SIZE))
+            return [DataVerseHarvester._get_search_doc(item, 'global_id') for item in stream]
+
+        whole, whole_peak = _measure(_parse_whole)
+        streamed, streamed_peak = _measure(_parse_streamed)
+
+        line = (f'search answer of {SEARCH_PAGE_SIZE} items: peak {whole_peak:.1f} MB parsed whole, '
+                f'{streamed_peak:.1f} MB streamed ({whole_peak / streamed_peak:.1f}x less)')
+        log.info(line)
+        print(f'\n{line}')
+
+        assert streamed == whole
+        assert streamed_peak < whole_peak
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'harvest_setup', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+class TestContentStorageBenchmark:
+
+    def test_content_storage(self):
+        source = factories.HarvestSourceObj(**SOURCE_DICT.copy())
+        job = factories.HarvestJobObj(source=source)
+        catalogue = FakeCatalogue(BENCHMARK_SIZE)
+        encodings = {
+            'legacy': json.dumps,
+            'compact': encode_content,
+            'compressed': lambda content: encode_content(content, compress=True),
+        }
+
+        for name, encode in encodings.items():
+            for start in range(0, BENCHMARK_SIZE, 5000):
+                model.Session.bulk_insert_mappings(HarvestObject, [
+                    {'id': make_uuid(), 'guid': f'{name}:{n}', 'current': False,
+                     'content': encode(dict(catalogue.search_item(n), dataset=catalogue.dataset(n))),
+                     'harvest_source_id': source.id, 'harvest_job_id': job.id}
+                    for n in range(start, min(start + 5000, BENCHMARK_SIZE))
+                ])
+            model.Session.commit()
+
+        # pg_column_size is the stored size, after any TOAST compression
+        sizes = {
+            name: model.Session.execute(
+                'SELECT sum(pg_column_size(content)) FROM harvest_object WHERE guid LIKE :prefix',
+                {'prefix': f'{name}:%'}).scalar() / 1024 / 1024
+            for name in encodings
+        }
+        line = (f'content of {BENCHMARK_SIZE} objects: ' + ', '.join(
+            f'{name} {size:.1f} MB ({100 * (1 - size / sizes["legacy"]):.0f}% saved)' for name, size in sizes.items()))
+        log.info(line)
+        print(f'\n{line}')
+
+        assert sizes['compressed'] < sizes['compact'] <= sizes['legacy']
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'harvest_setup', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+class TestHistoryBenchmark:
+
+    def _time_lookups(self, harvester, job, guids):
+        ''' Time the current objects query of the gather and the previous object query of the import '''
+        started = time.perf_counter()
+        harvester._get_current_objects(job)
+        gather_elapsed = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for guid in guids:
+            model.Session.query(HarvestObject). \
+                filter(HarvestObject.harvest_source_id == job.source.id). \
+                filter(HarvestObject.guid == guid). \
+                filter(HarvestObject.current == True). \
+                first()
+        import_elapsed = time.perf_counter() - started
+        return gather_elapsed, import_elapsed
+
+    def test_lookups_with_growing_history(self):
+        source = factories.HarvestSourceObj(**SOURCE_DICT.copy())
+        job = factories.HarvestJobObj(source=source)
+        guids = [item['guid'] for item in synthetic_items(BENCHMARK_SIZE // HISTORY_REVISIONS)]
+        for start in range(0, len(guids), 1000):
+            add_history(source, job, guids[start:start + 1000], HISTORY_REVISIONS)
+        model.Session.execute('ANALYZE harvest_object')
+        harvester = DataverseTestHarvester()
+        sample = guids[::max(len(guids) // 1000, 1)]
+
+        before = self._time_lookups(harvester, job, sample)
+        started = time.perf_counter()
+        deleted = compact_history(source.id, keep=1)
+        compact_elapsed = time.perf_counter() - started
+        model.Session.execute('ANALYZE harvest_object')
+        after = self._time_lookups(harvester, job, sample)
+
+        line = (f'history of {len(guids)} GUIDs x {HISTORY_REVISIONS} revisions: current objects query '
+                f'{before[0]:.2f}s -> {after[0]:.2f}s, {len(sample)} previous object lookups '
+                f'{before[1]:.2f}s -> {after[1]:.2f}s; compaction deleted {deleted} objects in {compact_elapsed:.1f}s')
+        log.info(line)
+        print(f'\n{line}')
+
+        assert deleted == len(guids) * (HISTORY_REVISIONS - 2)
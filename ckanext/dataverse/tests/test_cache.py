@@ -0,0 +1,55 @@
+import os
+import time
+
+from ckanext.dataverse.cache import ResponseCache
+
+URL = 'https://dataverse.test/api/datasets/:persistentId/?persistentId=doi%3A10.5072%2FFK2%2FABC'
+
+
+class TestResponseCache:
+
+    def test_set_and_get(self, tmp_path):
+        cache = ResponseCache(str(tmp_path))
+        cache.set(URL, '{"id": 1}', etag='"abc"', last_modified='Mon, 01 Jan 2024 00:00:00 GMT')
+
+        entry = cache.get(URL)
+
+        assert entry['body'] == '{"id": 1}'
+        assert cache.conditional_headers(entry) == {
+            'If-None-Match': '"abc"',
+            'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT',
+        }
+        assert cache.get(URL + '&other') is None
+
+    def test_responses_without_validators_are_not_stored(self, tmp_path):
+        cache = ResponseCache(str(tmp_path))
+        cache.set(URL, '{"id": 1}')
+
+        assert cache.get(URL) is None
+
+    def test_expired_entries_are_ignored_and_evicted(self, tmp_path):
+        cache = ResponseCache(str(tmp_path), max_age=60)
+        cache.set(URL, '{"id": 1}', etag='"abc"')
+        path = cache._path(URL)
+        old = time.time() - 120
+        os.utime(path, (old, old))
+
+        assert cache.evict() == 1
+        assert not os.path.exists(path)
+
+    def test_eviction_by_size_drops_least_recently_used(self, tmp_path):
+        cache = ResponseCache(str(tmp_path))
+        for n in range(3):
+            cache.set(f'{URL}{n}', 'x' * 1000, etag=f'"{n}"')
+            path = cache._path(f'{URL}{n}')
+            os.utime(path, (time.time() - 30 + n, time.time() - 30 + n))
+        cache.hit(f'{URL}0')
+        # entries do not all have the same size on disk, so room is made for
+        # exactly the two that must be kept
+        cache.max_size = os.path.getsize(cache._path(f'{URL}0')) + os.path.getsize(cache._path(f'{URL}2'))
+
+        assert cache.evict() == 1
+        assert cache.get(f'{URL}0') is not None
+        assert cache.get(f'{URL}1') is None
+        assert cache.get(f'{URL}2') is not None
+        assert cache.stats() == {'hits': 1, 'misses': 0, 'evictions': 1}
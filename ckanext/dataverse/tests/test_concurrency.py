@@ -0,0 +1,126 @@
+import datetime
+import json
+import threading
+
+import pytest
+
+from ckan import model
+from ckan.logic import get_action
+from ckan.tests import factories as ckan_factories
+from ckanext.harvest.model import HarvestObject
+
+from ckanext.dataverse.indexing import automatic_indexing_disabled
+from ckanext.dataverse.tests import factories
+from ckanext.dataverse.tests.fake_dataverse import fake_dataverse
+from ckanext.dataverse.tests.harvesters import DataverseTestHarvester
+
+CATALOGUE_SIZE = 20
+WORKERS = 4
+
+SOURCE_DICT = {
+    "name": "concurrent-dataverse-harvester",
+    "title": "Concurrent Dataverse",
+    "notes": "Concurrent Dataverse",
+    "source_type": "test-for-action",
+    "frequency": "MANUAL",
+    "config": json.dumps({"id_field_name": "global_id", "skip_unchanged": False, "fetch_workers": 4})
+}
+
+
+def _import_worker(harvester, object_ids, results):
+    ''' Import objects the way an import queue consumer does, with its own DB session '''
+    try:
+        for object_id in object_ids:
+            obj = HarvestObject.get(object_id)
+            obj.state = 'IMPORT'
+            obj.save()
+            success = harvester.import_stage(obj)
+            obj = HarvestObject.get(object_id)
+            obj.state = 'COMPLETE' if success else 'ERROR'
+            obj.import_finished = datetime.datetime.utcnow()
+            obj.save()
+            results.append(success)
+    finally:
+        model.Session.remove()
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index', 'harvest_setup', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+class TestConcurrentImport:
+
+    def test_import_workers_share_a_job(self):
+        harvester = DataverseTestHarvester()
+        with fake_dataverse(size=CATALOGUE_SIZE) as server:
+            source = factories.HarvestSourceObj(url=server.url, **SOURCE_DICT)
+            # two gathers before any import: every GUID gets two 'new' objects
+            first_job = factories.HarvestJobObj(source=source)
+            object_ids = harvester.gather_stage(first_job)
+            # only one unrun job per source is allowed
+            first_job.status = 'Running'
+            first_job.save()
+            second_job = factories.HarvestJobObj(source=source)
+            object_ids += harvester.gather_stage(second_job)
+
+        assert len(object_ids) == 2 * CATALOGUE_SIZE
+
+        results = []
+        threads = [
+            threading.Thread(target=_import_worker, args=(harvester, object_ids[n::WORKERS], results))
+            for n in range(WORKERS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == [True] * len(object_ids)
+
+        current = model.Session.query(HarvestObject.guid, HarvestObject.package_id). \
+            filter(HarvestObject.harvest_source_id == source.id). \
+            filter(HarvestObject.current == True).all()
+        assert len(current) == CATALOGUE_SIZE
+        assert len({guid for guid, package_id in current}) == CATALOGUE_SIZE
+
+        harvested_packages = model.Session.query(model.Package). \
+            filter(model.Package.type == 'dataset'). \
+            filter(model.Package.state == 'active').count()
+        assert harvested_packages == CATALOGUE_SIZE
+
+    def test_deferred_indexing_is_flushed_when_workers_finish_together(self):
+        harvester = DataverseTestHarvester()
+        config = dict(json.loads(SOURCE_DICT['config']), deferred_indexing=True, index_batch_size=1000)
+        with fake_dataverse(size=CATALOGUE_SIZE) as server:
+            source = factories.HarvestSourceObj(url=server.url, **dict(SOURCE_DICT, config=json.dumps(config)))
+            object_ids = harvester.gather_stage(factories.HarvestJobObj(source=source))
+
+        results = []
+        threads = [
+            threading.Thread(target=_import_worker, args=(harvester, object_ids[n::WORKERS], results))
+            for n in range(WORKERS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == [True] * CATALOGUE_SIZE
+        search = get_action('package_search')({'ignore_auth': True}, {'q': '*:*', 'rows': 0})
+        assert search['count'] == CATALOGUE_SIZE
+
+
+@pytest.mark.usefixtures('clean_db', 'clean_index')
+def test_automatic_indexing_is_disabled_for_the_current_thread_only():
+    indexed = {}
+
+    def _create(name):
+        indexed[name] = ckan_factories.Dataset(name=name)['id']
+        model.Session.remove()
+
+    with automatic_indexing_disabled():
+        _create('not-indexed')
+        thread = threading.Thread(target=_create, args=('indexed',))
+        thread.start()
+        thread.join()
+
+    search = get_action('package_search')({'ignore_auth': True}, {'q': '*:*'})
+    assert [package['name'] for package in search['results']] == ['indexed']
@@ -0,0 +1,43 @@
+import json
+
+from ckanext.dataverse.content import (
+    COMPRESSED_MARKER, decode_content, encode_content, load_content, trim_content,
+)
+from ckanext.dataverse.tests.fake_dataverse import FakeCatalogue
+
+CONTENT = dict(FakeCatalogue(10).search_item(3), dataset=FakeCatalogue(10, files_per_dataset=20).dataset(3))
+
+
+class TestContentEncoding:
+
+    def test_plain_encoding_is_canonical_json(self):
+        encoded = encode_content({'b': 1, 'a': [1, 2]})
+
+        assert encoded == '{"a":[1,2],"b":1}'
+        assert load_content(encoded) == {'a': [1, 2], 'b': 1}
+
+    def test_compressed_round_trip(self):
+        encoded = encode_content(CONTENT, compress=True)
+
+        assert encoded.startswith(COMPRESSED_MARKER)
+        assert len(encoded) < len(json.dumps(CONTENT)) / 2
+        assert load_content(encoded) == CONTENT
+        assert json.loads(decode_content(encoded)) == CONTENT
+
+    def test_legacy_content_is_decoded_as_is(self):
+        legacy = json.dumps(CONTENT, indent=2)
+
+        assert decode_content(legacy) == legacy
+        assert load_content(legacy) == CONTENT
+
+    def test_trim_content(self):
+        fields = {'name': True, 'dataset': {'latestVersion': {'files': {'label': True}}}}
+
+        trimmed = trim_content(CONTENT, fields)
+
+        assert trimmed == {
+            'name': CONTENT['name'],
+            'dataset': {'latestVersion': {'files': [{'label': f['label']}
+                                                    for f in CONTENT['dataset']['latestVersion']['files']]}},
+        }
+        assert trim_content(CONTENT, None) is CONTENT
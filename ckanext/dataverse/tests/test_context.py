@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+from ckan import model
+from ckan.tests import factories as ckan_factories
+
+from ckanext.dataverse import context as harvest_context
+from ckanext.dataverse.context import get_harvest_context
+from ckanext.dataverse.tests import factories
+
+SOURCE_DICT = {
+    "url": "http://dataverse.context.test",
+    "name": "context-dataverse-harvester",
+    "title": "Context Dataverse",
+    "notes": "Context Dataverse",
+    "source_type": "test-for-action",
+    "frequency": "MANUAL",
+    "config": json.dumps({"id_field_name": "global_id"}),
+}
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'harvest_setup')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+class TestHarvestContext:
+
+    def _source(self):
+        organization = ckan_factories.Organization()
+        return factories.HarvestSourceObj(owner_org=organization['id'], **SOURCE_DICT), organization
+
+    def test_owner_org_and_user_are_cached(self, monkeypatch):
+        source, organization = self._source()
+        lookups = []
+        get_harvest_user_name = harvest_context.get_harvest_user_name
+
+        def counted_user_name():
+            lookups.append(1)
+            return get_harvest_user_name()
+
+        monkeypatch.setattr(harvest_context, 'get_harvest_user_name', counted_user_name)
+        first = get_harvest_context(source)
+
+        # the organization changes, but the cached entry is used until it expires
+        other = ckan_factories.Organization()
+        model.Package.get(source.id).owner_org = other['id']
+        model.Session.commit()
+        second = get_harvest_context(source)
+
+        assert second is first
+        assert second.owner_org == organization['id']
+        assert second.user_name == get_harvest_user_name()[0]
+        assert second.ignore_auth
+        assert len(lookups) == 1
+
+    def test_editing_the_config_invalidates_the_entry(self):
+        source, _organization = self._source()
+        first = get_harvest_context(source)
+
+        source.config = json.dumps({'id_field_name': 'global_id', 'page_size': 5})
+        source.save()
+        second = get_harvest_context(source)
+
+        assert second is not first
+        assert second.config == {'id_field_name': 'global_id', 'page_size': 5}
+        assert get_harvest_context(source) is second
+
+    @pytest.mark.ckan_config('ckanext.dataverse.context_ttl', '0')
+    def test_entries_expire_after_the_ttl(self):
+        source, _organization = self._source()
+        first = get_harvest_context(source)
+
+        other = ckan_factories.Organization()
+        model.Package.get(source.id).owner_org = other['id']
+        model.Session.commit()
+        second = get_harvest_context(source)
+
+        assert second is not first
+        assert second.owner_org == other['id']
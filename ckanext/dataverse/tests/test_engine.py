@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+from ckan import model
+from ckanext.harvest.model import HarvestGatherError, HarvestJob, HarvestObject, HarvestObjectError
+
+from ckanext.dataverse.engine import AsyncHarvestEngine
+from ckanext.dataverse.tests import factories
+from ckanext.dataverse.tests.fake_dataverse import fake_dataverse
+from ckanext.dataverse.tests.harvesters import DataverseTestHarvester
+
+SOURCE_DICT = {
+    "name": "async-dataverse-harvester",
+    "title": "Async Dataverse",
+    "notes": "Async Dataverse",
+    "source_type": "test-for-action",
+    "frequency": "MANUAL",
+    "config": json.dumps({"id_field_name": "global_id", "page_size": 7, "max_retries": 0}),
+}
+
+
+def _object_states(job_id):
+    model.Session.expire_all()
+    return sorted(state for (state,) in model.Session.query(HarvestObject.state).
+                  filter(HarvestObject.harvest_job_id == job_id))
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index', 'harvest_setup', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+class TestAsyncHarvestEngine:
+
+    def test_job_is_run_with_failing_fetches(self, monkeypatch):
+        harvester = DataverseTestHarvester()
+        gather_stage = harvester.gather_stage
+        with fake_dataverse(size=20, latency=0.005) as server:
+
+            def gather_then_retire(harvest_job):
+                # five datasets are gone by the time they are fetched
+                ids = gather_stage(harvest_job)
+                server.catalogue.size = 15
+                return ids
+
+            monkeypatch.setattr(harvester, 'gather_stage', gather_then_retire)
+            source = factories.HarvestSourceObj(**dict(SOURCE_DICT, url=server.url))
+            job = factories.HarvestJobObj(source=source)
+            imported, errored = AsyncHarvestEngine(harvester, job.id, concurrency=4, batch_size=6).run()
+
+        assert (imported, errored) == (15, 5)
+        assert _object_states(job.id) == ['COMPLETE'] * 15 + ['ERROR'] * 5
+        assert model.Session.query(HarvestObjectError).filter_by(stage='Fetch').count() == 5
+        assert model.Session.query(model.Package).filter_by(state='active').count() == 15
+        assert HarvestJob.get(job.id).status == 'Finished'
+
+    def test_job_is_finished_when_the_run_fails(self, monkeypatch):
+        harvester = DataverseTestHarvester()
+
+        def failing_import(*args):
+            raise RuntimeError('database went away')
+
+        monkeypatch.setattr(harvester, '_import_batch', failing_import)
+        with fake_dataverse(size=10) as server:
+            source = factories.HarvestSourceObj(**dict(SOURCE_DICT, url=server.url))
+            job = factories.HarvestJobObj(source=source)
+            with pytest.raises(RuntimeError):
+                AsyncHarvestEngine(harvester, job.id, concurrency=2, batch_size=4).run()
+
+        model.Session.expire_all()
+        assert HarvestJob.get(job.id).status == 'Finished'
+        errors = model.Session.query(HarvestGatherError).filter_by(harvest_job_id=job.id).all()
+        assert len(errors) == 1
+        assert 'database went away' in errors[0].message
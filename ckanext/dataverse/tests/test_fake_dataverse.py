@@ -0,0 +1,64 @@
+import json
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+from ckanext.dataverse.tests.fake_dataverse import fake_dataverse
+
+
+def _get(url, headers=None):
+    with urlopen(Request(url, headers=headers or {})) as response:
+        return response.status, dict(response.headers), json.loads(response.read() or b'null')
+
+
+class TestFakeDataverse:
+
+    def test_search_pagination(self):
+        with fake_dataverse(size=25) as server:
+            status, headers, content = _get(f'{server.url}/api/search?q=*&start=20&per_page=10')
+
+        assert status == 200
+        assert content['data']['total_count'] == 25
+        assert [item['global_id'] for item in content['data']['items']] == [
+            f'doi:10.5072/FK2/{n:08d}' for n in range(20, 25)]
+
+    def test_dataset_revalidation(self):
+        with fake_dataverse(size=5) as server:
+            url = f'{server.url}/api/datasets/:persistentId/?persistentId=doi:10.5072/FK2/00000003'
+            status, headers, content = _get(url)
+            with pytest.raises(HTTPError) as e:
+                _get(url, {'If-None-Match': headers['ETag']})
+
+        assert content['data']['identifier'] == 'FK2/00000003'
+        assert e.value.code == 304
+
+    def test_date_filter(self):
+        with fake_dataverse(size=10) as server:
+            server.catalogue.updates = {3: '2024-06-01T00:00:00Z', 7: '2024-07-01T00:00:00Z'}
+            status, headers, content = _get(f'{server.url}/api/search?q=*&per_page=100'
+                                            f'&fq=dateSort:%5B2024-05-01T00:00:00Z%20TO%20*%5D')
+
+        assert [(item['global_id'], item['updatedAt']) for item in content['data']['items']] == [
+            ('doi:10.5072/FK2/00000003', '2024-06-01T00:00:00Z'),
+            ('doi:10.5072/FK2/00000007', '2024-07-01T00:00:00Z')]
+
+    def test_error_rate(self):
+        with fake_dataverse(size=5, error_rate=1) as server:
+            with pytest.raises(HTTPError) as e:
+                _get(f'{server.url}/api/search?q=*')
+
+        assert e.value.code == 503
+
+    def test_subdataverses(self):
+        with fake_dataverse(size=10, subdataverses=3) as server:
+            status, headers, contents = _get(f'{server.url}/api/dataverses/:root/contents')
+            status, headers, sub = _get(f'{server.url}/api/dataverses/101')
+            status, headers, subtree = _get(f'{server.url}/api/search?q=*&subtree=sub1&per_page=100')
+            status, headers, own = _get(f'{server.url}/api/search?q=*&subtree=root'
+                                        f'&fq=identifierOfDataverse:root&per_page=100')
+
+        assert [item['id'] for item in contents['data']] == [100, 101, 102]
+        assert sub['data']['alias'] == 'sub1'
+        assert [item['global_id'][-2:] for item in subtree['data']['items']] == ['01', '04', '07']
+        assert own['data']['total_count'] == 0
@@ -0,0 +1,351 @@
+import datetime
+import json
+
+import pytest
+
+from ckan import model
+from ckan.plugins import toolkit
+from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestObjectExtra
+
+from ckanext.dataverse.harvesters.dataverse_harvester import SOLR_DATE_FORMAT
+from ckanext.dataverse.model import DataverseHarvestJob
+from ckanext.dataverse.tests import factories
+from ckanext.dataverse.tests.fake_dataverse import fake_dataverse
+from ckanext.dataverse.tests.harvesters import DataverseTestHarvester, run_job
+
+SOURCE_DICT = {
+    "name": "gather-dataverse-harvester",
+    "title": "Gather Dataverse",
+    "notes": "Gather Dataverse",
+    "source_type": "test-for-action",
+    "frequency": "MANUAL",
+}
+
+
+def _gathered_guids(job):
+    return {guid for (guid,) in model.Session.query(HarvestObject.guid).
+            filter(HarvestObject.harvest_job_id == job.id)}
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'harvest_setup', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+class TestShardedGather:
+
+    def test_sharded_gather_covers_the_catalogue(self):
+        harvester = DataverseTestHarvester()
+        with fake_dataverse(size=50, subdataverses=4) as server:
+            source = factories.HarvestSourceObj(url=server.url, config=json.dumps({
+                'id_field_name': 'global_id', 'page_size': 5,
+                'shard_by_subdataverse': True, 'shard_workers': 3,
+            }), **SOURCE_DICT)
+            job = factories.HarvestJobObj(source=source)
+
+            ids = harvester.gather_stage(job)
+
+        assert len(ids) == 50
+        assert _gathered_guids(job) == {f'doi:10.5072/FK2/{n:08d}' for n in range(50)}
+
+    def test_concurrent_search_pages_are_yielded_in_order(self):
+        harvester = DataverseTestHarvester()
+        harvester._set_source_config(json.dumps({'id_field_name': 'global_id', 'page_size': 3,
+                                                 'search_workers': 4}))
+        with fake_dataverse(size=40, latency=0.01) as server:
+            pages = list(harvester._get_pages(server.url))
+
+            # one request per page, the first one alone
+            assert server.requests == 14
+
+        assert [len(page) for page in pages] == [3] * 13 + [1]
+        assert [doc['guid'] for page in pages for doc in page] == \
+            [f'doi:10.5072/FK2/{n:08d}' for n in range(40)]
+
+    def test_failing_shard_fails_the_gather(self):
+        harvester = DataverseTestHarvester()
+        with fake_dataverse(size=20, subdataverses=2) as server:
+            source = factories.HarvestSourceObj(url=server.url, config=json.dumps({
+                'id_field_name': 'global_id', 'shards': ['sub0', 'missing'],
+                'shard_retries': 0, 'max_retries': 0,
+            }), **SOURCE_DICT)
+            job = factories.HarvestJobObj(source=source)
+
+            ids = harvester.gather_stage(job)
+
+        assert ids is None
+        assert job.gather_errors
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'harvest_setup', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+class TestResumableGather:
+
+    def test_interrupted_gather_is_resumed_by_the_next_job(self):
+        harvester = DataverseTestHarvester()
+        with fake_dataverse(size=50) as server:
+            source = factories.HarvestSourceObj(url=server.url, config=json.dumps({
+                'id_field_name': 'global_id', 'page_size': 5, 'batch_size': 10, 'max_retries': 0,
+            }), **SOURCE_DICT)
+            first_job = factories.HarvestJobObj(source=source)
+
+            server.search_limit = 25
+            assert harvester.gather_stage(first_job) is None
+            assert len(_gathered_guids(first_job)) == 20
+            first_job.status = 'Finished'
+            first_job.save()
+
+            server.search_limit = None
+            server.requests = 0
+            second_job = factories.HarvestJobObj(source=source)
+            ids = harvester.gather_stage(second_job)
+
+            # the listing restarts at the checkpoint, not from scratch
+            assert server.requests == 6
+
+        assert len(ids) == 50
+        assert _gathered_guids(second_job) == {f'doi:10.5072/FK2/{n:08d}' for n in range(50)}
+        assert not _gathered_guids(first_job)
+        assert DataverseHarvestJob.get_or_create(second_job).mode == 'resumed'
+        assert 'checkpoint' not in DataverseHarvestJob.get_or_create(second_job).get_data()
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index', 'harvest_setup', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+class TestIncrementalGather:
+
+    def _source(self, server, **config):
+        return factories.HarvestSourceObj(url=server.url, config=json.dumps(dict(
+            {'id_field_name': 'global_id', 'incremental': True}, **config
+        )), **SOURCE_DICT)
+
+    @staticmethod
+    def _started(job, started):
+        job.gather_started = datetime.datetime.strptime(started, SOLR_DATE_FORMAT)
+        job.save()
+
+    def test_datasets_modified_since_the_last_job_are_listed(self):
+        harvester = DataverseTestHarvester()
+        with fake_dataverse(size=10) as server:
+            source = self._source(server)
+            first_job = factories.HarvestJobObj(source=source)
+            assert len(run_job(harvester, first_job)) == 10
+
+            later = (datetime.datetime.utcnow() + datetime.timedelta(days=1)).strftime(SOLR_DATE_FORMAT)
+            server.catalogue.updates = {2: later, 5: later}
+            second_job = factories.HarvestJobObj(source=source)
+            ids = run_job(harvester, second_job)
+
+        assert DataverseHarvestJob.get_or_create(first_job).mode == 'full'
+        assert DataverseHarvestJob.get_or_create(second_job).mode == 'incremental'
+        assert harvester._get_high_water_mark(second_job) == first_job.gather_started
+        assert len(ids) == 2
+        assert _gathered_guids(second_job) == {'doi:10.5072/FK2/00000002', 'doi:10.5072/FK2/00000005'}
+        # records left out of an incremental listing are not deleted
+        assert model.Session.query(HarvestObject).filter_by(current=True).count() == 10
+
+    @pytest.mark.parametrize('interval, mode', [(7, 'full'), (10, 'incremental')])
+    def test_full_gather_after_full_harvest_interval(self, interval, mode):
+        harvester = DataverseTestHarvester()
+        with fake_dataverse(size=10) as server:
+            source = self._source(server, full_harvest_interval=interval)
+            first_job = factories.HarvestJobObj(source=source)
+            run_job(harvester, first_job)
+            eight_days_ago = datetime.datetime.utcnow() - datetime.timedelta(days=8)
+            self._started(first_job, eight_days_ago.strftime(SOLR_DATE_FORMAT))
+
+            second_job = factories.HarvestJobObj(source=source)
+            run_job(harvester, second_job)
+
+        assert DataverseHarvestJob.get_or_create(second_job).mode == mode
+
+    def test_records_that_failed_are_listed_again(self, monkeypatch):
+        harvester = DataverseTestHarvester()
+        with fake_dataverse(size=10) as server:
+            source = self._source(server, full_harvest_interval=100000)
+            first_job = factories.HarvestJobObj(source=source)
+            run_job(harvester, first_job)
+            self._started(first_job, '2024-03-01T00:00:00Z')
+
+            # the only dataset modified since fails to be fetched
+            server.catalogue.updates = {2: '2024-04-01T00:00:00Z'}
+
+            def failing_fetch(harvest_object):
+                harvester._save_object_error('Could not fetch dataset', harvest_object, 'Fetch')
+                return False
+
+            monkeypatch.setattr(harvester, 'fetch_stage', failing_fetch)
+            second_job = factories.HarvestJobObj(source=source)
+            assert len(run_job(harvester, second_job)) == 1
+            self._started(second_job, '2024-05-01T00:00:00Z')
+
+            monkeypatch.undo()
+            third_job = factories.HarvestJobObj(source=source)
+            ids = run_job(harvester, third_job)
+
+        assert DataverseHarvestJob.get_or_create(third_job).mode == 'incremental'
+        assert harvester._get_high_water_mark(third_job) == first_job.gather_started
+        assert len(ids) == 1
+        assert _gathered_guids(third_job) == {'doi:10.5072/FK2/00000002'}
+        assert HarvestObject.get(ids[0]).state == 'COMPLETE'
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index', 'harvest_setup', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+class TestBulkDeletion:
+
+    def _harvest_shrinking_catalogue(self, **config):
+        harvester = DataverseTestHarvester()
+        with fake_dataverse(size=20) as server:
+            source = factories.HarvestSourceObj(url=server.url, config=json.dumps(dict(
+                {'id_field_name': 'global_id', 'bulk_delete': True, 'delete_batch_size': 2}, **config
+            )), **SOURCE_DICT)
+            run_job(harvester, factories.HarvestJobObj(source=source))
+            package_ids = {guid: package_id for guid, package_id in model.Session.query(
+                HarvestObject.guid, HarvestObject.package_id).filter(HarvestObject.current == True)}
+
+            # a sub-collection of five datasets is retired upstream
+            server.catalogue.size = 15
+            job = factories.HarvestJobObj(source=source)
+            ids = run_job(harvester, job)
+
+        deleted = {package_ids[f'doi:10.5072/FK2/{n:08d}'] for n in range(15, 20)}
+        delete_objects = model.Session.query(HarvestObject). \
+            join(HarvestObjectExtra, HarvestObjectExtra.harvest_object_id == HarvestObject.id). \
+            filter(HarvestObject.harvest_job_id == job.id). \
+            filter(HarvestObjectExtra.key == 'status'). \
+            filter(HarvestObjectExtra.value == 'delete').all()
+        return ids, deleted, delete_objects
+
+    def test_deletions_are_processed_in_bulk(self):
+        ids, deleted, delete_objects = self._harvest_shrinking_catalogue()
+
+        assert ids == []
+        assert len(delete_objects) == 5
+        assert {obj.state for obj in delete_objects} == {'COMPLETE'}
+        assert {obj.package_id for obj in delete_objects} == deleted
+        for package_id in deleted:
+            assert model.Package.get(package_id).state == 'deleted'
+        assert model.Session.query(model.Package).filter_by(state='active').count() == 15
+
+    def test_deletions_are_purged(self):
+        ids, deleted, delete_objects = self._harvest_shrinking_catalogue(purge_deleted=True)
+
+        assert ids == []
+        assert {obj.package_id for obj in delete_objects} == {None}
+        assert model.Session.query(model.Package).filter(model.Package.id.in_(deleted)).count() == 0
+        # only the objects of the job are left for the purged datasets
+        guids = [obj.guid for obj in delete_objects]
+        assert model.Session.query(HarvestObject).filter(HarvestObject.guid.in_(guids)).count() == 5
+
+    def test_deletions_imported_in_bulk_are_removed_from_the_index(self):
+        harvester = DataverseTestHarvester()
+        with fake_dataverse(size=10) as server:
+            source = factories.HarvestSourceObj(url=server.url, config=json.dumps({'id_field_name': 'global_id'}),
+                                                **SOURCE_DICT)
+            run_job(harvester, factories.HarvestJobObj(source=source))
+
+            server.catalogue.size = 6
+            imported, errored = harvester.run_bulk_job(factories.HarvestJobObj(source=source), batch_size=3)
+
+        assert (imported, errored) == (4, 0)
+        assert model.Session.query(model.Package).filter_by(state='deleted').count() == 4
+        assert toolkit.get_action('package_search')({}, {})['count'] == 6
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index', 'harvest_setup', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+class TestBulkImport:
+
+    def test_invalid_record_does_not_fail_its_batch(self, monkeypatch):
+        harvester = DataverseTestHarvester()
+        create_package_dict = harvester.create_package_dict
+
+        def create_invalid_package_dict(guid, content):
+            package_dict, metadata = create_package_dict(guid, content)
+            if guid == 'doi:10.5072/FK2/00000003':
+                package_dict['version'] = 'x' * 200
+            return package_dict, metadata
+
+        monkeypatch.setattr(harvester, 'create_package_dict', create_invalid_package_dict)
+        with fake_dataverse(size=6) as server:
+            source = factories.HarvestSourceObj(url=server.url, config=json.dumps({'id_field_name': 'global_id'}),
+                                                **SOURCE_DICT)
+            job = factories.HarvestJobObj(source=source)
+            imported, errored = harvester.run_bulk_job(job, batch_size=10)
+
+        assert (imported, errored) == (5, 1)
+        failed = model.Session.query(HarvestObject).filter_by(guid='doi:10.5072/FK2/00000003').one()
+        assert failed.state == 'ERROR' and not failed.current and failed.package_id is None
+        assert 'Validation Error' in failed.errors[0].message
+        assert model.Session.query(HarvestObject).filter_by(current=True, state='COMPLETE').count() == 5
+        assert model.Session.query(model.Package).filter_by(state='active').count() == 5
+        assert model.Session.query(HarvestJob).get(job.id).status == 'Finished'
+
+    def test_job_is_finished_when_the_run_fails(self, monkeypatch):
+        harvester = DataverseTestHarvester()
+
+        def failing_import(*args):
+            raise RuntimeError('database went away')
+
+        monkeypatch.setattr(harvester, '_import_batch', failing_import)
+        with fake_dataverse(size=4) as server:
+            source = factories.HarvestSourceObj(url=server.url, config=json.dumps({'id_field_name': 'global_id'}),
+                                                **SOURCE_DICT)
+            job = factories.HarvestJobObj(source=source)
+            with pytest.raises(RuntimeError):
+                harvester.run_bulk_job(job)
+
+        job = model.Session.query(HarvestJob).get(job.id)
+        assert job.status == 'Finished'
+        assert len(job.gather_errors) == 1
+        assert 'database went away' in job.gather_errors[0].message
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index', 'harvest_setup', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+class TestDiff:
+
+    def test_diff_counts_new_and_unchanged_records(self):
+        harvester = DataverseTestHarvester()
+        with fake_dataverse(size=20) as server:
+            source = factories.HarvestSourceObj(url=server.url, config=json.dumps({
+                'id_field_name': 'global_id', 'page_size': 7,
+            }), **SOURCE_DICT)
+            run_job(harvester, factories.HarvestJobObj(source=source))
+            object_count = model.Session.query(HarvestObject).count()
+
+            server.catalogue.size = 25
+            result = harvester.diff(source, list_guids=True)
+
+        assert {key: result[key] for key in ('new', 'change', 'unchanged', 'delete')} == \
+            {'new': 5, 'change': 0, 'unchanged': 20, 'delete': 0}
+        assert result['guids']['new'] == [f'doi:10.5072/FK2/{n:08d}' for n in range(20, 25)]
+        # nothing was written
+        assert model.Session.query(HarvestObject).count() == object_count
+
+    def test_diff_counts_changed_and_deleted_records(self):
+        harvester = DataverseTestHarvester()
+        with fake_dataverse(size=20) as server:
+            source = factories.HarvestSourceObj(url=server.url, config=json.dumps({
+                'id_field_name': 'global_id', 'page_size': 7,
+            }), **SOURCE_DICT)
+            run_job(harvester, factories.HarvestJobObj(source=source))
+
+            server.catalogue.size = 15
+            server.catalogue.modified = '2024-06-01T00:00:00Z'
+            result = harvester.diff(source, list_guids=True)
+
+        assert result['change'] == 15
+        assert result['delete'] == 5
+        assert result['guids']['delete'] == [f'doi:10.5072/FK2/{n:08d}' for n in range(15, 20)]
+        assert model.Session.query(HarvestObject).filter(HarvestObject.current == True).count() == 20
+
+    def test_diff_counts_every_record_as_changed_without_skip_unchanged(self):
+        harvester = DataverseTestHarvester()
+        with fake_dataverse(size=10) as server:
+            source = factories.HarvestSourceObj(url=server.url, config=json.dumps({
+                'id_field_name': 'global_id',
+            }), **SOURCE_DICT)
+            run_job(harvester, factories.HarvestJobObj(source=source))
+
+            result = harvester.diff(source, json.dumps({'id_field_name': 'global_id', 'skip_unchanged': False}))
+
+        assert result == {'new': 0, 'change': 10, 'unchanged': 0, 'delete': 0}
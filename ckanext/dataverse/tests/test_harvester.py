@@ -0,0 +1,58 @@
+from ckanext.dataverse.harvesters.dataverse_harvester import content_hash
+from ckanext.dataverse.tests.harvesters import DataverseTestHarvester, synthetic_items
+
+
+class TestGatherIndex:
+
+    def test_index_page_drops_missing_and_seen_guids(self):
+        page = synthetic_items(3) + [{'name': 'no guid', 'guid': None}]
+        seen = {page[0]['guid']}
+
+        page_index = DataverseTestHarvester._index_page(page, seen)
+
+        assert list(page_index) == [page[1]['guid'], page[2]['guid']]
+        assert page_index[page[1]['guid']] is page[1]
+
+    def test_classify_page(self):
+        page = synthetic_items(4)
+        page_index = DataverseTestHarvester._index_page(page, set())
+        guids_in_db = {page[0]['guid']: 'pkg-0', page[1]['guid']: 'pkg-1', 'other': 'pkg-x'}.keys()
+
+        new, change = DataverseTestHarvester._classify_page(page_index, guids_in_db)
+
+        assert new == {page[2]['guid'], page[3]['guid']}
+        assert change == {page[0]['guid'], page[1]['guid']}
+
+
+class TestContentHash:
+
+    def test_hash_ignores_key_order(self):
+        assert content_hash({'a': 1, 'b': [1, 2]}) == content_hash({'b': [1, 2], 'a': 1})
+
+    def test_hash_changes_with_content(self):
+        assert content_hash({'a': 1}) != content_hash({'a': 2})
+
+
+class TestFindUnchanged:
+
+    def test_unchanged_by_date_or_hash(self):
+        docs = synthetic_items(4)
+        for doc in docs:
+            doc['modified'] = '2024-01-01T00:00:00Z'
+        page_index = DataverseTestHarvester._index_page(docs, set())
+        guids = list(page_index)
+        fingerprints = {
+            guids[0]: ('2024-01-01T00:00:00Z', None),
+            guids[1]: ('2023-01-01T00:00:00Z', content_hash(docs[1])),
+            guids[2]: ('2023-01-01T00:00:00Z', 'stale'),
+        }
+
+        unchanged = DataverseTestHarvester()._find_unchanged(guids, page_index, fingerprints)
+
+        assert unchanged == {guids[0], guids[1]}
+
+
+class TestImportStage:
+
+    def test_missing_object_is_not_imported(self):
+        assert DataverseTestHarvester().import_stage(None) is False
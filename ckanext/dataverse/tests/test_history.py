@@ -0,0 +1,73 @@
+import datetime
+import json
+
+import pytest
+
+from ckan import model
+from ckan.model.types import make_uuid
+from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
+
+from ckanext.dataverse.history import compact_history, delete_orphans
+from ckanext.dataverse.tests import factories
+
+SOURCE_DICT = {
+    "url": "http://dataverse.history.test",
+    "name": "history-dataverse-harvester",
+    "title": "History Dataverse",
+    "notes": "History Dataverse",
+    "source_type": "test-for-action",
+    "frequency": "MANUAL",
+    "config": json.dumps({"id_field_name": "global_id"}),
+}
+
+
+def add_history(source, job, guids, revisions, state='COMPLETE'):
+    '''
+    Insert `revisions` objects per GUID, one day apart, the most recent one
+    being current; each object has a status extra
+    '''
+    now = datetime.datetime.utcnow()
+    objects = []
+    extras = []
+    for guid in guids:
+        for revision in range(revisions):
+            object_id = make_uuid()
+            objects.append({'id': object_id, 'guid': guid, 'current': revision == 0, 'state': state,
+                            'gathered': now - datetime.timedelta(days=revision),
+                            'harvest_source_id': source.id, 'harvest_job_id': job.id})
+            extras.append({'id': make_uuid(), 'harvest_object_id': object_id, 'key': 'status', 'value': 'change'})
+    model.Session.bulk_insert_mappings(HarvestObject, objects)
+    model.Session.bulk_insert_mappings(HarvestObjectExtra, extras)
+    model.Session.commit()
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'harvest_setup', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+class TestCompactHistory:
+
+    def test_old_revisions_are_deleted(self):
+        source = factories.HarvestSourceObj(**SOURCE_DICT.copy())
+        job = factories.HarvestJobObj(source=source)
+        add_history(source, job, ['guid-a', 'guid-b', 'guid-c'], revisions=4)
+
+        deleted = compact_history(source.id, keep=1, batch_size=2)
+
+        assert deleted == 6
+        for guid in ('guid-a', 'guid-b', 'guid-c'):
+            kept = model.Session.query(HarvestObject).filter_by(guid=guid). \
+                order_by(HarvestObject.gathered.desc()).all()
+            assert [obj.current for obj in kept] == [True, False]
+        assert model.Session.query(HarvestObjectExtra).count() == 6
+
+    def test_pending_objects_and_other_sources_are_kept(self):
+        source = factories.HarvestSourceObj(**SOURCE_DICT.copy())
+        job = factories.HarvestJobObj(source=source)
+        add_history(source, job, ['guid-a'], revisions=3, state='WAITING')
+        other_source = factories.HarvestSourceObj(**dict(SOURCE_DICT, name='other-source',
+                                                          url='http://other.history.test'))
+        other_job = factories.HarvestJobObj(source=other_source)
+        add_history(other_source, other_job, ['guid-a'], revisions=3)
+
+        assert compact_history(source.id, keep=0) == 0
+        assert model.Session.query(HarvestObject).count() == 6
+        assert delete_orphans() == (0, 0)
@@ -0,0 +1,76 @@
+import threading
+import time
+
+from ckanext.dataverse.activity import JobActivity
+from ckanext.dataverse.metrics import HarvestMetrics, merge_summaries
+
+
+class TestHarvestMetrics:
+
+    def test_summary_and_merge(self):
+        first = HarvestMetrics('job-1')
+        first.add_time('import', 2.0)
+        first.incr('import.objects', 4)
+        second = HarvestMetrics('job-1')
+        second.add_time('import', 6.0)
+        second.incr('import.objects', 12)
+        second.incr('db.queries', 30)
+
+        assert first.summary()['counters']['import.objects_per_second'] == 2.0
+
+        merged = merge_summaries(first.summary(), second.summary())
+
+        assert merged['timers']['import'] == {'count': 2, 'total': 8.0, 'max': 6.0}
+        assert merged['counters']['import.objects'] == 16
+        assert merged['counters']['import.objects_per_second'] == 2.0
+        assert merged['counters']['db.queries'] == 30
+
+    def test_processed_counts_survive_reset(self):
+        metrics = HarvestMetrics('job-1')
+        metrics.tick('fetch')
+        metrics.incr('import.objects')
+        metrics.tick('import')
+        metrics.reset()
+
+        assert metrics.counters == {}
+        assert metrics.tick('import') == 2
+        assert metrics.tick('fetch') == 2
+
+
+class TestJobActivity:
+
+    def _activity(self, idle_timeout=60):
+        flushed = []
+        activity = JobActivity(lambda job_id: f'state of {job_id}',
+                               lambda job_id, state: flushed.append((job_id, state)), idle_timeout)
+        return activity, flushed
+
+    def test_idle_jobs_are_flushed(self):
+        activity, flushed = self._activity(idle_timeout=0.05)
+        with activity.working('job-1'):
+            pass
+        with activity.working('job-1'):
+            pass
+
+        time.sleep(0.3)
+        assert flushed == [('job-1', 'state of job-1')]
+
+    def test_finish_waits_for_the_other_threads(self):
+        activity, flushed = self._activity()
+        started = threading.Event()
+        release = threading.Event()
+
+        def _work():
+            with activity.working('job-1'):
+                started.set()
+                release.wait()
+
+        thread = threading.Thread(target=_work)
+        thread.start()
+        started.wait()
+        activity.finish('job-1')
+        assert flushed == []
+
+        release.set()
+        thread.join()
+        assert flushed == [('job-1', 'state of job-1')]
@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+from ckan import model
+from ckan.tests import factories as ckan_factories
+from ckanext.harvest.model import HarvestObject
+
+from ckanext.dataverse.names import NameIndex, get_name_index
+from ckanext.dataverse.tests import factories
+from ckanext.dataverse.tests.fake_dataverse import fake_dataverse
+from ckanext.dataverse.tests.harvesters import DataverseTestHarvester, run_job
+
+SOURCE_DICT = {
+    "name": "names-dataverse-harvester",
+    "title": "Names Dataverse",
+    "notes": "Names Dataverse",
+    "source_type": "test-for-action",
+    "frequency": "MANUAL",
+}
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index', 'harvest_setup', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+class TestNameIndex:
+
+    def test_new_names_are_unique(self):
+        ckan_factories.Dataset(name='soil-samples')
+        ckan_factories.Dataset(name='soil-samples1')
+
+        names = NameIndex('job-id', 'source-id')
+
+        assert names.new_name('Air samples') == 'air-samples'
+        assert names.new_name('Air samples') == 'air-samples1'
+        assert names.new_name('Soil samples') == 'soil-samples2'
+        assert names.new_name('Soil samples') == 'soil-samples3'
+
+    @pytest.mark.ckan_config('ckanext.harvest.default_dataset_name_append', 'random-hex')
+    def test_random_hex_names(self):
+        ckan_factories.Dataset(name='soil-samples')
+
+        name = NameIndex('job-id', 'source-id').new_name('Soil samples')
+
+        assert name.startswith('soil-samples') and len(name) == len('soil-samples') + 5
+        assert name != 'soil-samples'
+
+    @pytest.mark.parametrize('bulk', [False, True])
+    def test_name_taken_after_the_index_was_loaded(self, bulk):
+        harvester = DataverseTestHarvester()
+        with fake_dataverse(size=5) as server:
+            source = factories.HarvestSourceObj(url=server.url, config=json.dumps({'id_field_name': 'global_id'}),
+                                                **SOURCE_DICT)
+            job = factories.HarvestJobObj(source=source)
+            get_name_index(job.id, source.id)
+            # another process creates a dataset with the same title
+            taken = ckan_factories.Dataset(name='dataset-3')
+            if bulk:
+                assert harvester.run_bulk_job(job) == (5, 0)
+            else:
+                run_job(harvester, job)
+
+        harvest_object = model.Session.query(HarvestObject). \
+            filter_by(guid='doi:10.5072/FK2/00000003', current=True).one()
+        package = model.Package.get(harvest_object.package_id)
+        assert harvest_object.state == 'COMPLETE'
+        assert package.name == 'dataset-31'
+        assert model.Package.get(taken['id']).name == 'dataset-3'
+        assert model.Session.query(model.Package).filter_by(type='dataset').count() == 6
+
+    def test_updated_datasets_keep_their_name(self):
+        harvester = DataverseTestHarvester()
+        with fake_dataverse(size=10) as server:
+            source = factories.HarvestSourceObj(url=server.url, config=json.dumps({'id_field_name': 'global_id'}),
+                                                **SOURCE_DICT)
+            run_job(harvester, factories.HarvestJobObj(source=source))
+            names = {package.id: package.name for package in model.Session.query(model.Package)}
+
+            server.catalogue.modified = '2025-01-01T00:00:00Z'
+            ids = run_job(harvester, factories.HarvestJobObj(source=source))
+
+        assert len(ids) == 10
+        assert model.Session.query(HarvestObject).filter_by(current=True).count() == 10
+        assert {package.id: package.name for package in model.Session.query(model.Package)} == names
@@ -0,0 +1,66 @@
+import json
+import os
+
+import pytest
+
+from ckanext.dataverse.profiling import ImportProfile, get_profile, substep_times
+from ckanext.dataverse.tests import factories
+from ckanext.dataverse.tests.fake_dataverse import fake_dataverse
+from ckanext.dataverse.tests.harvesters import DataverseTestHarvester, run_job
+
+
+def create_package_dict(count):
+    return sum(range(count))
+
+
+def test_profiles_are_aggregated_per_job(tmp_path):
+    profile = ImportProfile('job-1')
+    for _ in range(3):
+        with profile.profiled():
+            create_package_dict(1000)
+
+    calls = {label: count for label, count, _cumulative in substep_times(profile.stats())}
+    path = profile.write_report(str(tmp_path))
+
+    assert profile.objects == 3
+    assert calls['create_package_dict'] == 3
+    assert calls['package_create'] == 0
+    assert os.path.exists(path[:-len('.txt')] + '.prof')
+    with open(path) as f:
+        report = f.read()
+    assert '3 objects profiled' in report
+    assert 'create_package_dict' in report
+
+
+def test_workers_write_and_discard_their_profile_when_done(ckan_config, monkeypatch, tmp_path):
+    monkeypatch.setitem(ckan_config, 'ckanext.dataverse.profile_dir', str(tmp_path))
+    harvester = DataverseTestHarvester()
+    with get_profile('job-2').profiled():
+        create_package_dict(1000)
+
+    harvester._finish_detached_job('job-2', harvester._detach_job('job-2'))
+
+    assert get_profile('job-2', create=False) is None
+    assert sorted(os.listdir(tmp_path)) == [f'dataverse-import-job-2-{os.getpid()}.prof',
+                                            f'dataverse-import-job-2-{os.getpid()}.txt']
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index', 'harvest_setup', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+def test_import_profile_is_written_at_the_end_of_the_job(ckan_config, monkeypatch, tmp_path):
+    monkeypatch.setitem(ckan_config, 'ckanext.dataverse.profile_dir', str(tmp_path))
+    harvester = DataverseTestHarvester()
+    with fake_dataverse(size=5) as server:
+        source = factories.HarvestSourceObj(
+            url=server.url, name='profiled-dataverse', title='Profiled Dataverse',
+            source_type='test-for-action', frequency='MANUAL',
+            config=json.dumps({'id_field_name': 'global_id', 'profile_import': True}))
+        job = factories.HarvestJobObj(source=source)
+        run_job(harvester, job)
+
+    reports = [name for name in os.listdir(tmp_path) if name.endswith('.txt')]
+    assert reports == [f'dataverse-import-{job.id}-{os.getpid()}.txt']
+    with open(os.path.join(tmp_path, reports[0])) as f:
+        report = f.read()
+    assert '5 objects profiled' in report
+    assert 'package_create' in report
@@ -0,0 +1,71 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from ckan import model
+from ckanext.harvest.model import HarvestObject
+
+from ckanext.dataverse.client import get_client
+from ckanext.dataverse.scheduler import MultiSourceGather
+from ckanext.dataverse.tests import factories
+from ckanext.dataverse.tests.fake_dataverse import fake_dataverse
+from ckanext.dataverse.tests.harvesters import DataverseTestHarvester
+
+
+def _job(job_id, url):
+    return SimpleNamespace(id=job_id, source=SimpleNamespace(url=url))
+
+
+def test_hosts_are_scheduled_in_turn():
+    harvester = DataverseTestHarvester()
+    scheduler = MultiSourceGather([
+        (harvester, _job('a1', 'https://a.example.org')),
+        (harvester, _job('a2', 'https://a.example.org/dataverse')),
+        (harvester, _job('a3', 'https://A.example.org')),
+        (harvester, _job('b1', 'https://b.example.org')),
+    ], per_host=2)
+
+    order = []
+    while True:
+        job = scheduler._next_job()
+        if job is None:
+            break
+        host, _harvester, job_id = job
+        order.append(job_id)
+        with scheduler._condition:
+            scheduler._running[host] -= 1
+
+    assert scheduler.workers == 4
+    assert order == ['a1', 'b1', 'a2', 'a3']
+
+
+def test_clients_of_a_host_share_its_pool():
+    first = get_client('https://shared.example.org', requests_per_second=5)
+    second = get_client('https://shared.example.org/', requests_per_second=5, max_retries=0)
+
+    assert first is not second
+    assert first.host_pool is second.host_pool
+    assert first.rate_limiter is second.rate_limiter
+    assert get_client('https://other.example.org').host_pool is not first.host_pool
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'harvest_setup', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+def test_sources_of_several_hosts_are_gathered():
+    harvester = DataverseTestHarvester()
+    with fake_dataverse(size=30, latency=0.01) as first, fake_dataverse(size=12, latency=0.01) as second:
+        jobs = []
+        for n, server in enumerate((first, second, first)):
+            source = factories.HarvestSourceObj(
+                url=server.url, name=f'multi-source-{n}', title=f'Multi source {n}',
+                source_type='test-for-action', frequency='MANUAL',
+                config=json.dumps({'id_field_name': 'global_id', 'page_size': 5}))
+            jobs.append((harvester, factories.HarvestJobObj(source=source)))
+
+        results = MultiSourceGather(jobs).run()
+
+    assert [results[job.id] for _harvester, job in jobs] == [30, 12, 30]
+    for _harvester, job in jobs:
+        assert model.Session.query(HarvestObject).filter(HarvestObject.harvest_job_id == job.id).count() \
+            == results[job.id]
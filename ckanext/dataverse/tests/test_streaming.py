@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+from ckanext.dataverse.streaming import SearchResultStream
+
+ITEMS = [
+    {'name': 'Dataset 0', 'global_id': 'doi:10.5072/FK2/0', 'subjects': ['Physics']},
+    {'name': 'Données "1" \\ ✓', 'global_id': 'doi:10.5072/FK2/1', 'authors': [{'name': '[items]'}]},
+    {'name': 'Dataset 2', 'global_id': 'doi:10.5072/FK2/2', 'subjects': []},
+]
+
+
+def _answer(items=ITEMS):
+    return {'status': 'OK', 'data': {
+        'q': '*', 'total_count': 42, 'start': 0, 'spelling_alternatives': {'items': []},
+        'items': items, 'count_in_response': len(items),
+    }}
+
+
+def _chunks(document, size, indent=None):
+    body = json.dumps(document, indent=indent, ensure_ascii=False).encode('utf-8')
+    return [body[start:start + size] for start in range(0, len(body), size)]
+
+
+class TestSearchResultStream:
+
+    @pytest.mark.parametrize('chunk_size', [1, 7, 64, 100000])
+    def test_items_are_streamed_whatever_the_chunking(self, chunk_size):
+        stream = SearchResultStream(_chunks(_answer(), chunk_size, indent=2))
+
+        assert list(stream) == ITEMS
+        assert stream.data == dict(_answer()['data'], items=[])
+
+    def test_items_are_yielded_before_the_body_is_read(self):
+        read = []
+
+        def _body():
+            for chunk in _chunks(_answer(), 16):
+                read.append(chunk)
+                yield chunk
+
+        first = next(iter(SearchResultStream(_body())))
+
+        assert first == ITEMS[0]
+        assert len(b''.join(read)) < len(b''.join(_chunks(_answer(), 16)))
+
+    def test_empty_items(self):
+        stream = SearchResultStream(_chunks(_answer([]), 5))
+
+        assert list(stream) == []
+        assert stream.data['total_count'] == 42
+
+    def test_answer_without_items(self):
+        stream = SearchResultStream(_chunks({'status': 'ERROR', 'message': 'nope'}, 5))
+
+        assert list(stream) == []
+        assert stream.data == {'status': 'ERROR', 'message': 'nope', 'items': []}
+
+    def test_truncated_answer(self):
+        body = b''.join(_chunks(_answer(), 100))
+
+        with pytest.raises(ValueError):
+            list(SearchResultStream([body[:len(body) // 2]]))
@@ -28,7 +28,8 @@ setup(
     ],
     test_suite='nose.collector',
     entry_points="""
-        
+        [ckan.plugins]
+        dataverse=ckanext.dataverse.plugin:DataversePlugin
     """,
     message_extractors={
         'ckanext': [